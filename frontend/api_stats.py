@@ -0,0 +1,77 @@
+import re
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+# Per endpoint totals of Web API responses: calls, body bytes and time spent
+# parsing the JSON. Installed as a response hook on the requests session, it
+# wraps each response's json() so the parse spotipy does is what's measured.
+
+# Spotify ids (22 base62 characters) and device ids (40 hex) in a path
+ID_PATTERN = re.compile(r'/[0-9A-Za-z]{22,40}(?=/|$)')
+
+class ApiStats():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {} # endpoint -> [calls, bytes, parse seconds]
+
+    def install(self, session):
+        session.hooks['response'].append(self.on_response)
+
+    def endpoint(self, url):
+        return ID_PATTERN.sub('/{id}', urlparse(url).path)
+
+    def add(self, endpoint, calls, size, parse_time):
+        with self.lock:
+            totals = self.endpoints.setdefault(endpoint, [0, 0, 0.0])
+            totals[0] = totals[0] + calls
+            totals[1] = totals[1] + size
+            totals[2] = totals[2] + parse_time
+
+    def on_response(self, response, *args, **kwargs):
+        endpoint = response.request.method + " " + self.endpoint(response.url)
+        self.add(endpoint, 1, len(response.content), 0)
+        parse = response.json
+        def timed_json(**kwargs):
+            start = time.perf_counter()
+            value = parse(**kwargs)
+            self.add(endpoint, 0, 0, time.perf_counter() - start)
+            return value
+        response.json = timed_json
+
+    def report(self):
+        with self.lock:
+            rows = sorted(self.endpoints.items(), key=lambda row: -row[1][1])
+        lines = ["%-40s %6s %10s %9s" % ("endpoint", "calls", "KB", "parse ms")]
+        for endpoint, (calls, size, parse_time) in rows:
+            lines.append("%-40s %6d %10.1f %9.1f" % (endpoint, calls, size / 1024, parse_time * 1000))
+        return "\n".join(lines)
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+# Latencies of user facing operations over their most recent runs, summed
+# up per label: searches answered from the cache or fetched, commands by kind
+class LatencyStats():
+    def __init__(self, keep = 200):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=keep) # (seconds, label)
+
+    def record(self, seconds, label):
+        with self.lock:
+            self.samples.append((seconds, label))
+
+    def _summary(self, latencies):
+        if (len(latencies) == 0):
+            return {"count": 0}
+        latencies = sorted(latencies)
+        return {"count": len(latencies), "avg_ms": round(sum(latencies) / len(latencies) * 1000, 1),
+                "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1), "max_ms": round(latencies[-1] * 1000, 1)}
+
+    def stats(self):
+        with self.lock:
+            samples = list(self.samples)
+        labels = list(dict.fromkeys(label for _, label in samples))
+        return {label: self._summary([seconds for seconds, other in samples if other == label]) for label in labels}
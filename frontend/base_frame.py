@@ -48,7 +48,7 @@ class BaseFrame(tk.Frame):
         truncd_header = header if len(header) < 20 else header[0:17] + "..."
         self.header_label.configure(text=truncd_header)
         play_image = self.space_image
-        if now_playing is not None:
+        if now_playing:
             play_image = self.play_image if now_playing['is_playing'] else self.pause_image
         self.play_indicator.configure(image = play_image)
         self.play_indicator.image = play_image
@@ -0,0 +1,153 @@
+# Offline micro benchmarks for the library storage code.
+# Run: python3 benchmark.py [codec|backends|search]
+
+import os
+import sys
+import time
+import pickle
+import tempfile
+import tracemalloc
+import codec
+import datastore
+import search_index
+from models import *
+from config import DATASTORE_COMPRESS_MIN_BYTES
+
+def make_tracks(count):
+    return [UserTrack("Track title number " + str(i), "Artist " + str(i % 300),
+                      "Album name " + str(i % 900), "spotify:track:" + str(10**21 + i))
+            for i in range(count)]
+
+def make_records():
+    return {
+        'UserTrack': make_tracks(1)[0],
+        'UserAlbum': UserAlbum("Album name", "Artist", 12, "spotify:album:4aawyAB9vmqN3uQ7FjRGTy"),
+        'UserArtist': UserArtist("Artist", "spotify:artist:0OdUWJ0sBjDrqHygGUXeCF"),
+        'UserPlaylist': UserPlaylist("Playlist name", 17, "spotify:playlist:37i9dQZF1DXcBWIGoYBM5M", 250),
+        'UserDevice': UserDevice("0d1841b0976bae2a3a310dd74c0f3df354899bc8", "Spotifypod", True),
+    }
+
+def timed(fun, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fun()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+def report(name, value, repeat, compress = None):
+    p_blob = pickle.dumps(value)
+    c_blob = codec.dumps(value, compress)
+    print("%-22s pickle %7d B %9.1f us enc %9.1f us dec | codec %7d B %9.1f us enc %9.1f us dec" % (
+        name,
+        len(p_blob), timed(lambda: pickle.dumps(value), repeat), timed(lambda: pickle.loads(p_blob), repeat),
+        len(c_blob), timed(lambda: codec.dumps(value, compress), repeat), timed(lambda: codec.loads(c_blob), repeat)))
+
+def bench_codec():
+    print("Bytes per record and encode/decode time, pickle vs codec")
+    for name, record in make_records().items():
+        report(name, record, 5000)
+    for count in [50, 1000, 5000]:
+        tracks = make_tracks(count)
+        report("tracks[" + str(count) + "]", tracks, max(3, 20000 // count))
+        report("tracks[" + str(count) + "] zlib", tracks, max(3, 20000 // count), DATASTORE_COMPRESS_MIN_BYTES)
+
+def make_playlists(count, track_count):
+    tracks = make_tracks(track_count)
+    return [(UserPlaylist("Playlist " + str(i), i, "spotify:playlist:" + str(10**21 + i), track_count), tracks)
+            for i in range(count)]
+
+def redis_backend():
+    # a separate db so the benchmark never touches the real library
+    import redis
+    import datastore_redis
+    r = redis.Redis(db=15)
+    try:
+        r.flushdb()
+    except redis.exceptions.ConnectionError:
+        return None, None, None
+    return datastore_redis.RedisBackend(r), lambda: r.info("memory")["used_memory"], "in memory"
+
+def sqlite_backend():
+    import datastore_sqlite
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    backend = datastore_sqlite.SqliteBackend(path)
+    def size():
+        backend._conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return os.path.getsize(path)
+    return backend, size, "on disk"
+
+# Storage size is what each backend occupies where it keeps the library:
+# Redis' used memory, the SQLite file (after a WAL checkpoint). Reads are
+# timed on the backend itself, below the Datastore's object cache.
+def bench_backend(name, make_backend, count):
+    backend, memory, where = make_backend()
+    if (backend is None):
+        print("%-7s %7d tracks: skipped, no server" % (name, count))
+        return
+    store = datastore.Datastore(backend)
+    tracks = make_tracks(count)
+    playlists = make_playlists(max(1, count // 100), 100)
+    before = memory()
+    start = time.perf_counter()
+    for offset in range(0, count, 50): # the page size refresh_data writes with
+        store.setSavedTracks(offset, tracks[offset:offset + 50])
+    store.setPlaylists(0, playlists)
+    ingest = time.perf_counter() - start
+    size = memory() - before
+    middle = count // 2
+    playlist_id = playlists[0][0].uri.split(":")[-1]
+    print("%-7s %7d tracks: ingest %8.1f ms, %8.1f KB %-9s | count %7.1f us, window %7.1f us, all playlists %8.1f us, playlist tracks %7.1f us" % (
+        name, count, ingest * 1000, size / 1024, where,
+        timed(lambda: backend.countRows("track"), 200),
+        timed(lambda: backend.getRows("track", middle, 6), 200),
+        timed(lambda: backend.getContexts("playlist"), 20),
+        timed(lambda: backend.getContextTracks(playlist_id), 200)))
+    backend.clear()
+
+def bench_backends():
+    print("Library ingest, storage size and read latency per datastore backend")
+    for count in [1000, 10000, 100000]:
+        bench_backend("redis", redis_backend, count)
+        bench_backend("sqlite", sqlite_backend, count)
+
+def search_library(count):
+    backend, _, _ = sqlite_backend()
+    store = datastore.Datastore(backend)
+    tracks = make_tracks(count)
+    for offset in range(0, count, 1000):
+        store.setSavedTracks(offset, tracks[offset:offset + 1000])
+    store.setArtists(0, [UserArtist("Artist " + str(i), "spotify:artist:" + str(10**21 + i)) for i in range(count // 50)])
+    return store
+
+# Memory is what the built index retains: the records read while building
+# are freed again, and matches are read back from the datastore, which the
+# query latency includes
+def bench_search():
+    print("Local search index build time, memory and query latency")
+    queries = ["t", "track", "artist 12", "album name 4", "number 77777", "nothing"]
+    for count in [1000, 10000, 100000]:
+        store = search_library(count)
+        start = time.perf_counter()
+        index = search_index.build(store)
+        build = time.perf_counter() - start
+        del index
+        # built again for the memory, as tracing slows the build down
+        tracemalloc.start()
+        index = search_index.build(store)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        resolve = lambda kind, key: search_index.resolve(store, kind, key)
+        print("%7d tracks: build %8.1f ms, %8.1f KB | %s" % (
+            count, build * 1000, size / 1024,
+            ", ".join("%r %.1f us" % (query, timed(lambda: index.search(query, 5, resolve), 20)) for query in queries)))
+        store.backend.clear()
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'backends': bench_backends,
+    'search': bench_search,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
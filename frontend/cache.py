@@ -0,0 +1,78 @@
+import sys
+import threading
+from collections import OrderedDict
+
+# Read-through LRU cache for decoded library objects, bounded by the
+# approximate memory its values take rather than by entry count. Entries live
+# in namespaces so a write can drop everything it may have made stale.
+
+def sizeof(value):
+    # Shallow size of the value plus its direct contents: a record and its
+    # slot values, or a list and its records
+    if isinstance(value, list):
+        return sys.getsizeof(value) + sum(sizeof(item) for item in value)
+    size = sys.getsizeof(value)
+    for slot in getattr(type(value), '__slots__', ()):
+        size += sys.getsizeof(getattr(value, slot, None))
+    return size
+
+class ObjectCache():
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # (namespace, key) -> (value, size)
+        self.bytes = 0
+        # bumped by every invalidation, so a load that raced with a write
+        # doesn't store what it read before the write
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, namespace, key, load):
+        with self.lock:
+            entry = self.entries.get((namespace, key))
+            if (entry is not None):
+                self.entries.move_to_end((namespace, key))
+                self.hits = self.hits + 1
+                return entry[0]
+            self.misses = self.misses + 1
+            epoch = self.epoch
+        value = load()
+        if (value is not None):
+            self._put(namespace, key, value, epoch)
+        return value
+
+    def _put(self, namespace, key, value, epoch):
+        size = sizeof(value)
+        if (size > self.max_bytes):
+            return
+        with self.lock:
+            if (epoch != self.epoch):
+                return
+            old = self.entries.pop((namespace, key), None)
+            if (old is not None):
+                self.bytes = self.bytes - old[1]
+            self.entries[(namespace, key)] = (value, size)
+            self.bytes = self.bytes + size
+            while (self.bytes > self.max_bytes):
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes = self.bytes - evicted
+                self.evictions = self.evictions + 1
+
+    def invalidate(self, *namespaces):
+        with self.lock:
+            self.epoch = self.epoch + 1
+            for cache_key in [cache_key for cache_key in self.entries if cache_key[0] in namespaces]:
+                self.bytes = self.bytes - self.entries.pop(cache_key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.epoch = self.epoch + 1
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self.entries), "bytes": self.bytes}
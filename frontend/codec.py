@@ -0,0 +1,251 @@
+import io
+import pickle
+import zlib
+from itertools import starmap
+
+# Compact binary encoding for the library records kept in the datastore.
+#
+# Blob layout: MAGIC, FORMAT_VERSION, kind, then a column block (zlib-deflated
+# for kind COMPRESSED). A column block is: type tag, schema version, row
+# count, field count, then one column per field holding that field for every
+# row. Records carry neither class paths nor slot names, and columns decode
+# with a single split() instead of per value parsing. A single record (kind
+# ROW) skips the columns: type tag, schema version, then its fields one
+# value after the other, so it decodes without building lists. Values that start with
+# pickle's protocol marker are still decoded with pickle, for libraries
+# written before this format existed; their classes were defined in
+# spotify_manager then, and resolve to the registered type of the same name.
+
+MAGIC = b'V'
+FORMAT_VERSION = 2 # 2: single records as KIND_ROW
+
+KIND_RECORD = 1
+KIND_LIST = 2
+KIND_COMPRESSED = 3
+KIND_ROW = 4
+
+COLUMN_NONE = 0
+COLUMN_STR = 1
+COLUMN_INT = 2
+COLUMN_BOOL = 3
+COLUMN_MIXED = 4
+
+VALUE_NONE = 0
+VALUE_STR = 1
+VALUE_INT = 2
+VALUE_TRUE = 3
+VALUE_FALSE = 4
+
+SEPARATOR = '\x00'
+PICKLE_PROTO = 0x80
+# Modules the record classes of legacy pickles were defined in
+LEGACY_MODULES = {'spotify_manager'}
+
+# tag -> (cls, {schema version: field names}), cls -> (tag, current version).
+# Records are rebuilt by calling cls with the fields in order (by name for
+# older schema versions), so fields must match the constructor's parameters.
+_schemas = {}
+_tags = {}
+
+def register(tag, cls, fields = None, version = 1):
+    # fields defaults to the class slots; registering a new version of a type
+    # keeps blobs written with older versions decodable
+    fields = list(fields if fields is not None else cls.__slots__)
+    _, versions = _schemas.setdefault(tag, (cls, {}))
+    versions[version] = fields
+    current = _tags.get(cls)
+    if (current is None or version >= current[1]):
+        _tags[cls] = (tag, version)
+
+def _write_varint(out, n):
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+def _read_varint(data, pos):
+    shift = 0
+    result = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+def _write_value(out, value):
+    if value is None:
+        out.append(VALUE_NONE)
+    elif value is True:
+        out.append(VALUE_TRUE)
+    elif value is False:
+        out.append(VALUE_FALSE)
+    elif isinstance(value, int):
+        out.append(VALUE_INT)
+        _write_varint(out, (value << 1) ^ (value >> 63)) # zigzag, so -1 stays one byte
+    else:
+        raw = str(value).encode('utf-8')
+        out.append(VALUE_STR)
+        _write_varint(out, len(raw))
+        out += raw
+
+def _read_value(data, pos):
+    kind = data[pos]
+    pos += 1
+    if kind == VALUE_STR:
+        length, pos = _read_varint(data, pos)
+        return data[pos:pos + length].decode('utf-8'), pos + length
+    if kind == VALUE_INT:
+        n, pos = _read_varint(data, pos)
+        return (n >> 1) ^ -(n & 1), pos
+    if kind == VALUE_NONE:
+        return None, pos
+    return kind == VALUE_TRUE, pos
+
+def _encode_column(values):
+    types = set(map(type, values))
+    if types == {str} and not any(SEPARATOR in value for value in values):
+        return COLUMN_STR, SEPARATOR.join(values).encode('utf-8')
+    if types == {int}:
+        return COLUMN_INT, ",".join(map(str, values)).encode('ascii')
+    if types == {bool}:
+        return COLUMN_BOOL, bytes(values)
+    if types == {type(None)}:
+        return COLUMN_NONE, b''
+    mixed = bytearray()
+    for value in values:
+        _write_value(mixed, value)
+    return COLUMN_MIXED, mixed
+
+def _decode_column(column_type, payload, rows):
+    if column_type == COLUMN_STR:
+        return payload.decode('utf-8').split(SEPARATOR)
+    if column_type == COLUMN_INT:
+        return list(map(int, payload.split(b',')))
+    if column_type == COLUMN_BOOL:
+        return [byte == 1 for byte in payload]
+    if column_type == COLUMN_NONE:
+        return [None] * rows
+    values = []
+    pos = 0
+    for _ in range(rows):
+        value, pos = _read_value(payload, pos)
+        values.append(value)
+    return values
+
+def _write_block(out, records):
+    if len(records) == 0:
+        out += bytes([0, 0, 0, 0])
+        return
+    cls = type(records[0])
+    if any(type(record) is not cls for record in records):
+        raise TypeError("records in one blob must share a type")
+    tag, version = _tags[cls]
+    fields = _schemas[tag][1][version]
+    out.append(tag)
+    out.append(version)
+    _write_varint(out, len(records))
+    out.append(len(fields))
+    for field in fields:
+        column_type, payload = _encode_column([getattr(record, field, None) for record in records])
+        out.append(column_type)
+        _write_varint(out, len(payload))
+        out += payload
+
+def _read_block(data, pos):
+    tag = data[pos]
+    version = data[pos + 1]
+    rows, pos = _read_varint(data, pos + 2)
+    field_count = data[pos]
+    pos += 1
+    if rows == 0:
+        return []
+    columns = []
+    for _ in range(field_count):
+        column_type = data[pos]
+        length, pos = _read_varint(data, pos + 1)
+        columns.append(_decode_column(column_type, data[pos:pos + length], rows))
+        pos += length
+    cls, versions = _schemas[tag]
+    if _tags[cls][1] == version:
+        return list(starmap(cls, zip(*columns)))
+    return [_upgrade(cls, versions, version, values) for values in zip(*columns)]
+
+# A record written with an older schema: fields are mapped by name, the ones
+# added since then read as None
+def _upgrade(cls, versions, version, values):
+    kwargs = dict.fromkeys(versions[_tags[cls][1]])
+    kwargs.update((field, value) for field, value in zip(versions[version], values) if field in kwargs)
+    return cls(**kwargs)
+
+def _write_row(out, record):
+    tag, version = _tags[type(record)]
+    out.append(tag)
+    out.append(version)
+    for field in _schemas[tag][1][version]:
+        _write_value(out, getattr(record, field, None))
+
+def _read_row(data, pos):
+    cls, versions = _schemas[data[pos]]
+    version = data[pos + 1]
+    pos += 2
+    values = []
+    for _ in versions[version]:
+        if data[pos] == VALUE_STR and data[pos + 1] < 0x80:
+            # short strings (one byte length) inline, the common case
+            end = pos + 2 + data[pos + 1]
+            values.append(data[pos + 2:end].decode('utf-8'))
+            pos = end
+        else:
+            value, pos = _read_value(data, pos)
+            values.append(value)
+    if _tags[cls][1] == version:
+        return cls(*values)
+    return _upgrade(cls, versions, version, values)
+
+def dumps(value, compress_min_bytes = None):
+    out = bytearray(MAGIC)
+    out.append(FORMAT_VERSION)
+    if not isinstance(value, list):
+        out.append(KIND_ROW)
+        _write_row(out, value)
+        return bytes(out)
+    body = bytearray()
+    _write_block(body, value)
+    if compress_min_bytes is not None and len(body) >= compress_min_bytes:
+        out.append(KIND_COMPRESSED)
+        out += zlib.compress(bytes(body))
+    else:
+        out.append(KIND_LIST)
+        out += body
+    return bytes(out)
+
+class _LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module in LEGACY_MODULES:
+            for cls in _tags:
+                if cls.__name__ == name:
+                    return cls
+        return super().find_class(module, name)
+
+def loads(data):
+    if data[0] == PICKLE_PROTO:
+        return _LegacyUnpickler(io.BytesIO(data)).load()
+    if data[0:1] != MAGIC or data[1] > FORMAT_VERSION:
+        raise ValueError("unknown record format")
+    kind = data[2]
+    if kind == KIND_ROW:
+        return _read_row(data, 3)
+    if kind == KIND_RECORD: # single records of format version 1
+        return _read_block(data, 3)[0]
+    if kind == KIND_COMPRESSED:
+        return _read_block(zlib.decompress(data[3:]), 0)
+    return _read_block(data, 3)
+
+def is_legacy(data):
+    return data is not None and len(data) > 0 and data[0] == PICKLE_PROTO
@@ -0,0 +1,132 @@
+import threading
+import time
+from collections import deque
+from api_stats import LatencyStats
+
+# Runs user commands (playback controls, searches) one at a time on a worker
+# thread of its own, in the order they were given, instead of a thread per
+# button press racing the others to the Web API. What waits in the queue is
+# trimmed as newer input comes in:
+#
+#   skips    consecutive skips merge into one net count (next +1, previous -1),
+#            and a net count of 0 drops the skip
+#   latest   a command submitted with a kind (e.g. "play", "search") replaces
+#            the queued ones of that kind; the running one is marked
+#            cancelled, so it can drop its result
+
+class Command():
+    __slots__ = ['kind', 'fn', 'count', 'submitted_at', 'cancelled']
+    def __init__(self, kind, fn, count = 0):
+        self.kind = kind
+        self.fn = fn
+        self.count = count
+        self.submitted_at = time.monotonic()
+        self.cancelled = False
+
+class CommandExecutor():
+    def __init__(self, name, on_submit = None, on_error = None):
+        self.name = name
+        # called for every command submitted, e.g. to hold back background traffic
+        self.on_submit = on_submit
+        # called with the command and the exception when one fails
+        self.on_error = on_error
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.running = None
+        self.worker = None
+        # time.monotonic() the last command finished at
+        self.finished_at = 0
+        self.latencies = LatencyStats()
+        self.counters = {"submitted": 0, "run": 0, "coalesced": 0, "cancelled": 0, "failed": 0, "max_depth": 0}
+
+    # Queues fn(); with a kind, queued commands of that kind are dropped for it
+    def submit(self, fn, kind = None):
+        command = Command(kind or "command", fn)
+        with self.cond:
+            if (kind is not None):
+                self._cancel(kind)
+            self._enqueue(command)
+        return command
+
+    # Queues a skip of count tracks; run(net count) performs it
+    def submit_skip(self, count, run):
+        with self.cond:
+            last = self.queue[-1] if len(self.queue) > 0 else None
+            if (last is not None and last.kind == "skip"):
+                self._count("submitted")
+                self._count("coalesced")
+                last.count = last.count + count
+                if (last.count == 0):
+                    self.queue.pop()
+                if (self.on_submit is not None):
+                    self.on_submit()
+                return last
+            command = Command("skip", None, count)
+            command.fn = lambda: run(command.count)
+            self._enqueue(command)
+            return command
+
+    # Commands of the kind that haven't finished yet: the queued ones are
+    # dropped, the running one is told through its cancelled flag
+    def _cancel(self, kind):
+        stale = [command for command in self.queue if command.kind == kind]
+        for command in stale:
+            command.cancelled = True
+            self.queue.remove(command)
+            self._count("cancelled")
+        if (self.running is not None and self.running.kind == kind):
+            self.running.cancelled = True
+
+    def _enqueue(self, command):
+        self._count("submitted")
+        self.queue.append(command)
+        self.counters["max_depth"] = max(self.counters["max_depth"], len(self.queue))
+        if (self.worker is None):
+            self.worker = threading.Thread(target=self.run, name=self.name + "-commands")
+            self.worker.daemon = True
+            self.worker.start()
+        self.cond.notify_all()
+        if (self.on_submit is not None):
+            self.on_submit()
+
+    def _count(self, name):
+        self.counters[name] = self.counters[name] + 1
+
+    # The command running on the worker thread, e.g. to check if it was cancelled
+    def current(self):
+        return self.running
+
+    # True while commands are queued or running
+    def busy(self):
+        with self.cond:
+            return self.running is not None or len(self.queue) > 0
+
+    def run(self):
+        while True:
+            with self.cond:
+                while (len(self.queue) == 0):
+                    self.cond.wait()
+                command = self.queue.popleft()
+                self.running = command
+            try:
+                command.fn()
+                self._finished(command, "run")
+            except Exception as e:
+                print(self.name + " command " + command.kind + " failed: " + repr(e))
+                self._finished(command, "failed")
+                if (self.on_error is not None):
+                    self.on_error(command, e)
+
+    def _finished(self, command, outcome):
+        self.latencies.record(time.monotonic() - command.submitted_at, command.kind)
+        with self.cond:
+            self._count(outcome)
+            self.running = None
+            self.finished_at = time.monotonic()
+
+    # Queue depth, counters and submit to finish latency per kind of command
+    def stats(self):
+        with self.cond:
+            stats = dict(self.counters, depth=len(self.queue))
+        stats["latency"] = self.latencies.stats()
+        return stats
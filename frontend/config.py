@@ -28,3 +28,63 @@ UDP_IP = "localhost"
 UDP_PORT = 9090
 
 MENU_PAGE_SIZE = 6 if SCREEN_HEIGHT < 300 else 7
+
+# Datastore track lists at least this large (encoded bytes) are stored zlib-compressed
+DATASTORE_COMPRESS_MIN_BYTES = 2048
+
+# Flush and refetch the whole library at every boot instead of syncing only what changed
+LIBRARY_FULL_REFRESH = False
+
+# Library storage: "redis" (needs a running redis-server) or "sqlite" (a single local file)
+DATASTORE_BACKEND = "redis"
+DATASTORE_SQLITE_PATH = "library.db"
+
+# Memory budget (bytes) of the datastore's cache of decoded playlists, albums and track lists
+DATASTORE_CACHE_BYTES = 2 * 1024 * 1024
+
+# Threads fetching batches of full albums (saved albums, new releases) concurrently during a library sync
+REFRESH_WORKERS = 4
+
+# Pages of a paged Spotify endpoint fetched at once, ahead of the one being read
+PAGE_FETCH_WORKERS = 4
+
+# Request only the fields the app keeps from the Web API (False requests full objects, to compare)
+API_FIELD_FILTERS = True
+# Log bytes transferred and JSON parse time per Web API endpoint after each library sync
+LOG_API_STATS = False
+
+# Load playlist track lists in the background after a library sync, instead of only when opened
+PLAYLIST_PREFETCH = True
+# Seconds the playlist prefetcher waits between two playlists
+PLAYLIST_PREFETCH_DELAY = 1.0
+
+# Retries of a failed Web API request (rate limited, server error or connection error)
+HTTP_MAX_RETRIES = 3
+
+# Disk cache of Web API responses, revalidated with ETags (None disables it) and its size limit in bytes
+HTTP_CACHE_PATH = "http_cache.db"
+HTTP_CACHE_MAX_BYTES = 20 * 1024 * 1024
+
+# Web API request budget shared by the UI, the now playing poll and background syncs
+API_REQUESTS_PER_SECOND = 8
+API_MAX_IN_FLIGHT = 8
+# Seconds background requests wait after a button press
+API_INTERACTIVE_HOLD = 1.0
+
+# Longest seconds between now playing polls while a track plays (the end of a
+# track is polled for regardless), while paused or idle, and with the screen off
+NOW_PLAYING_POLL_INTERVAL = 15
+NOW_PLAYING_PAUSED_POLL_INTERVAL = 20
+NOW_PLAYING_ASLEEP_POLL_INTERVAL = 60
+
+# Unix socket the local player's event hook sends to (see player_events.py; None
+# disables it), the seconds between now playing polls while its events arrive,
+# and the seconds without an event (longer than most tracks) after which
+# polling adapts again
+PLAYER_EVENTS_SOCKET = "/tmp/vpod-player-events.sock"
+PLAYER_EVENTS_POLL_INTERVAL = 60
+PLAYER_EVENTS_TIMEOUT = 600
+
+# Seconds search results are reused for the same query, and how many queries are kept
+SEARCH_CACHE_TTL = 6 * 3600
+SEARCH_CACHE_ENTRIES = 100
@@ -1,142 +1,347 @@
-import redis
-import pickle
-from functools import lru_cache
+import json
+import threading
+import time
+from collections import OrderedDict
+from config import DATASTORE_BACKEND, DATASTORE_SQLITE_PATH, DATASTORE_CACHE_BYTES, SEARCH_CACHE_TTL, SEARCH_CACHE_ENTRIES
+from cache import ObjectCache
+from models import UserPlaylist, SearchResults, NowPlaying, TRACK_CHUNK_SIZE
+
+# Storage backends implement the record level operations below; Datastore
+# maps the app facing getters and setters onto them.
+#
+#   rows, kind "track" or "artist" (lists keyed by position):
+#     setRows(kind, start, items), getRows(kind, start, count) -> items or None,
+#     countRows(kind), trimRows(kind, count), prependRows(kind, items)
+#   contexts, kind "playlist", "album" or "nr" (objects with a track list,
+#   optionally at a library position; tracks None keeps the stored ones):
+#     setContexts(kind, start or None, [(context, tracks)]),
+#     prependContexts(kind, [(context, tracks)]), trimContexts(kind, count),
+#     countContexts(kind), hasContext(kind, id), getContext(kind, id),
+#     getContextAt(kind, index), getContexts(kind), getContextTracks(id),
+#     getContextTrackRange(id, start, count), countContextTracks(id) -> n or None,
+#     getContextTrackPosition(id, track_uri) -> first position or None,
+#     clearContextTracks(ids)
+#   devices: setDevices(devices), getDevices(), clearDevices()
+#   searches (outside the generations): getSearchResults(query) -> (expires_at,
+#     [tracks, artists, albums, album tracks], album track ids) or None,
+#     setSearchResults(query, expires_at, lists, album_track_ids, max_entries)
+#   sync bookkeeping: getSyncState(key), setSyncState(key, value),
+#     getPlaylistSnapshots(), setPlaylistSnapshots(snapshots)
+#   generations: generation, beginGeneration() -> backend,
+#     publishGeneration(backend), collectGenerations(), clear()
+#
+# The library lives in generations: a full refresh fills a new generation
+# while readers keep using the published one, then publishes it atomically.
+def create_backend(name = DATASTORE_BACKEND):
+    if (name == "sqlite"):
+        import datastore_sqlite
+        return datastore_sqlite.SqliteBackend(DATASTORE_SQLITE_PATH)
+    import datastore_redis
+    return datastore_redis.RedisBackend()
+
+def _id(uri):
+    return str(uri).split(":")[-1]
+
+def _searchKey(query):
+    return " ".join(query.lower().split())
 
 class Datastore():
-    def __init__(self):
-        self.now_playing = None
-        self.r = redis.Redis()
+    def __init__(self, backend = None):
+        self._now_playing = NowPlaying()
+        self.now_playing_lock = threading.Lock()
+        self.backend = backend if backend is not None else create_backend()
+        # bumped whenever a sync finishes, so pages holding library data can reload
+        self.revision = 0
+        # decoded playlists, albums, new releases ("playlist", "album", "nr")
+        # and their track lists ("tracks"); writes drop the namespaces they touch
+        self.cache = ObjectCache(DATASTORE_CACHE_BYTES)
+        # query -> (expires_at, SearchResults), least recently used first
+        self.searches = OrderedDict()
+        self.search_lock = threading.Lock()
+
+    # The current NowPlaying snapshot; replaced, never changed, by publishNowPlaying
+    @property
+    def now_playing(self):
+        return self._now_playing
+
+    # Makes now_playing (a dict of fields, a NowPlaying or None for nothing
+    # playing) the current snapshot, versioned one above the previous one, and
+    # returns it; with no change nothing is published. The UI redraws from
+    # now_playing on its own timer and compares versions.
+    def publishNowPlaying(self, now_playing):
+        fields = now_playing.fields() if isinstance(now_playing, NowPlaying) else (now_playing or {})
+        with self.now_playing_lock:
+            previous = self._now_playing
+            if (len(previous.changed_fields(fields)) == 0):
+                return previous
+            snapshot = NowPlaying(fields, previous.version + 1)
+            self._now_playing = snapshot
+        return snapshot
+
+    @property
+    def generation(self):
+        return self.backend.generation
+
+    # Returns a Datastore writing into a new, unpublished generation
+    def beginGeneration(self):
+        return Datastore(self.backend.beginGeneration())
+
+    # Makes store's generation the one every reader sees. Publishing this
+    # store itself only marks an in-place sync as finished.
+    def publishGeneration(self, store):
+        if (store is not self):
+            self.backend.publishGeneration(store.backend)
+            self.cache.clear()
+        self.revision = self.revision + 1
+
+    # Deletes every generation other than the published one: superseded
+    # libraries as well as ones left behind by an interrupted refresh
+    def collectGenerations(self):
+        self.backend.collectGenerations()
 
     def getPlaylistCount(self):
-        return len(self.r.keys("playlist-index:*"))
+        return self.backend.countContexts("playlist")
 
     def getSavedTrackCount(self):
-        return len(self.r.keys("track:*"))
+        return self.backend.countRows("track")
 
     def getArtistCount(self):
-        return len(self.r.keys("artist:*"))
+        return self.backend.countRows("artist")
 
     def getAlbumCount(self):
-        return len(self.r.keys("album-index:*"))
+        return self.backend.countContexts("album")
 
     def getNewReleasesCount(self):
-        return len(self.r.keys("nr-index:*"))
+        return self.backend.countContexts("nr")
 
-    def setNewRelease(self, album, tracks, index = -1):
-        album_id = album.uri.split(":")[-1]
-        self.r.set("nr-uri:"+str(album_id), pickle.dumps(album))
-        self.r.set("playlist-tracks:"+str(album_id), pickle.dumps(tracks))
-        if (index > -1):
-            self.r.set("nr-index:"+str(index), album_id)
+    # Called after every write to a context kind, so no read that started
+    # before the write can fill the cache with the old objects
+    def _writeContexts(self, kind):
+        self.cache.invalidate(kind, "tracks")
 
     def setAlbum(self, album, tracks, index = -1):
-        album_id = album.uri.split(":")[-1]
-        self.r.set("album-uri:"+str(album_id), pickle.dumps(album))
-        self.r.set("playlist-tracks:"+str(album_id), pickle.dumps(tracks))
-        if (index > -1):
-            self.r.set("album-index:"+str(index), album_id)
+        self.backend.setContexts("album", index if index > -1 else None, [(album, tracks)])
+        self._writeContexts("album")
 
     def setPlaylist(self, playlist, tracks, index = -1):
-        playlist_id = playlist.uri.split(":")[-1]
-        self.r.set("playlist-uri:"+str(playlist_id), pickle.dumps(playlist))
-        self.r.set("playlist-tracks:"+str(playlist_id), pickle.dumps(tracks))
-        if (index > -1):
-            self.r.set("playlist-index:"+str(index), playlist_id)
+        self.backend.setContexts("playlist", index if index > -1 else None, [(playlist, tracks)])
+        self._writeContexts("playlist")
+
+    # Bulk writers take one page of (item, tracks) pairs and commit it in a
+    # single transaction, indexed from start.
+    def setNewReleases(self, start, albums):
+        self.backend.setContexts("nr", start, albums)
+        self._writeContexts("nr")
 
-    def setArtist(self, index, artist):
-        self.r.set("artist:"+str(index), pickle.dumps(artist))
+    def setAlbums(self, start, albums):
+        self.backend.setContexts("album", start, albums)
+        self._writeContexts("album")
+
+    def setPlaylists(self, start, playlists):
+        self.backend.setContexts("playlist", start, playlists)
+        self._writeContexts("playlist")
+
+    # Inserts albums at the top of the saved albums, shifting existing ones down
+    def prependAlbums(self, albums):
+        if (len(albums) == 0):
+            return
+        self.backend.prependContexts("album", albums)
+        self._writeContexts("album")
+
+    def hasNewRelease(self, uri):
+        return self.backend.hasContext("nr", _id(uri))
+
+    def trimNewReleases(self, count):
+        self.backend.trimContexts("nr", count)
+        self._writeContexts("nr")
+
+    def trimAlbums(self, count):
+        self.backend.trimContexts("album", count)
+        self._writeContexts("album")
+
+    def trimPlaylists(self, count):
+        self.backend.trimContexts("playlist", count)
+        self._writeContexts("playlist")
+
+    def setArtists(self, start, artists):
+        self.backend.setRows("artist", start, artists)
+
+    def _getContextAt(self, kind, index):
+        return self.cache.get(kind, ("index", index), lambda: self.backend.getContextAt(kind, index))
+
+    def _getContext(self, kind, uri):
+        return self.cache.get(kind, ("uri", _id(uri)), lambda: self.backend.getContext(kind, _id(uri)))
 
-    @lru_cache(maxsize=50)
     def getPlaylist(self, index):
-        playlist_uri = self.r.get("playlist-index:"+str(index))
-        if (playlist_uri is None):
-            return None
-        return self.getPlaylistUri(playlist_uri.decode('utf-8'))
+        return self._getContextAt("playlist", index)
 
     def getPlaylistTracks(self, playlist_uri):
-        playlist_id = playlist_uri.split(":")[-1]
-        pickled_pl = self.r.get("playlist-tracks:"+str(playlist_id))
-        if (pickled_pl is None):
-            return None
-        return pickle.loads(pickled_pl)
+        return self.cache.get("tracks", _id(playlist_uri), lambda: self.backend.getContextTracks(_id(playlist_uri)))
+
+    # Tracks start..start+count of a playlist or album, read page by page so
+    # opening a long playlist doesn't load all of it
+    def getPlaylistTrackRange(self, playlist_uri, start, count):
+        tracks = []
+        for page in range(start // TRACK_CHUNK_SIZE, (start + count - 1) // TRACK_CHUNK_SIZE + 1):
+            tracks.extend(self._getTrackPage(_id(playlist_uri), page))
+        offset = start % TRACK_CHUNK_SIZE
+        return tracks[offset:offset + count]
+
+    def _getTrackPage(self, context_id, page):
+        return self.cache.get("tracks", (context_id, page), lambda: self.backend.getContextTrackRange(
+            context_id, page * TRACK_CHUNK_SIZE, TRACK_CHUNK_SIZE))
+
+    # Stores the track list of a playlist already in the library, e.g. one
+    # loaded on demand; its track_count follows the list
+    def setPlaylistTracks(self, playlist_uri, tracks):
+        playlist = self.getPlaylistUri(playlist_uri)
+        if (playlist is None):
+            return
+        playlist = UserPlaylist(playlist.name, playlist.idx, playlist.uri, len(tracks))
+        self.backend.setContexts("playlist", None, [(playlist, tracks)])
+        self._writeContexts("playlist")
+
+    # Drops stored track lists, e.g. of playlists that changed since they were loaded
+    def clearPlaylistTracks(self, playlist_uris):
+        if (len(playlist_uris) == 0):
+            return
+        self.backend.clearContextTracks([_id(uri) for uri in playlist_uris])
+        self.cache.invalidate("tracks")
+
+    def hasPlaylistTracks(self, playlist_uri):
+        return self.getPlaylistTrackCount(playlist_uri) is not None
+
+    # None while no track list is stored for the playlist
+    def getPlaylistTrackCount(self, playlist_uri):
+        return self.cache.get("tracks", (_id(playlist_uri), "count"), lambda: self.backend.countContextTracks(_id(playlist_uri)))
+
+    # Position of a track in a playlist or album from the index stored with
+    # its track list, None if it isn't stored there
+    def getPlaylistTrackPosition(self, playlist_uri, track_uri):
+        return self.cache.get("tracks", (_id(playlist_uri), track_uri), lambda: self.backend.getContextTrackPosition(
+            _id(playlist_uri), track_uri))
 
-    @lru_cache(maxsize=50)
     def getAlbum(self, index):
-        album_uri = self.r.get("album-index:"+str(index))
-        if (album_uri is None):
-            return None
-        return self.getAlbumUri(album_uri.decode('utf-8'))
+        return self._getContextAt("album", index)
 
-    @lru_cache(maxsize=50)
     def getNewRelease(self, index):
-        album_uri = self.r.get("nr-index:"+str(index))
-        if (album_uri is None):
-            return None
-        return self.getNewReleaseUri(album_uri.decode('utf-8'))
+        return self._getContextAt("nr", index)
 
-    @lru_cache(maxsize=50)
     def getPlaylistUri(self, uri):
-        playlist_id = str(uri).split(":")[-1]
-        pickled_pl = self.r.get("playlist-uri:"+str(playlist_id))
-        if (not pickled_pl):
-            return None
-        return pickle.loads(pickled_pl)
+        return self._getContext("playlist", uri)
 
-    @lru_cache(maxsize=50)
     def getAlbumUri(self, uri):
-        album_id = str(uri).split(":")[-1]
-        pickled_pl = self.r.get("album-uri:"+str(album_id))
-        if (not pickled_pl):
-            return None
-        return pickle.loads(pickled_pl)
+        return self._getContext("album", uri)
 
-    @lru_cache(maxsize=50)
     def getNewReleaseUri(self, uri):
-        album_id = str(uri).split(":")[-1]
-        pickled_pl = self.r.get("nr-uri:"+str(album_id))
-        if (not pickled_pl):
+        return self._getContext("nr", uri)
+
+    # Results of a recent search for query, or None. The SEARCH_CACHE_ENTRIES
+    # most recently used are kept in memory and the most recent ones in the
+    # backend as well, so they outlive a restart; all of them expire
+    # SEARCH_CACHE_TTL seconds after the search.
+    def getSearchResults(self, query):
+        query = _searchKey(query)
+        now = time.time()
+        with self.search_lock:
+            entry = self.searches.get(query)
+            if (entry is not None and entry[0] > now):
+                self.searches.move_to_end(query)
+                return entry[1]
+        stored = self.backend.getSearchResults(query)
+        if (stored is None or stored[0] <= now):
             return None
-        return pickle.loads(pickled_pl)
+        expires_at, (tracks, artists, albums, album_tracks), album_track_ids = stored
+        # album tracks are stored once each, with the track uris of every album
+        # as JSON: an album's declared track count needn't match the tracks
+        # the market gets
+        by_uri = {track.uri: track for track in album_tracks}
+        album_track_map = {uri: [by_uri[track_uri] for track_uri in track_uris]
+                           for uri, track_uris in json.loads(album_track_ids).items()}
+        results = SearchResults(tracks, artists, albums, album_track_map)
+        self._rememberSearch(query, expires_at, results)
+        return results
+
+    def setSearchResults(self, query, results):
+        query = _searchKey(query)
+        expires_at = time.time() + SEARCH_CACHE_TTL
+        album_track_ids = {album.uri: [track.uri for track in results.album_track_map[album.uri]] for album in results.albums}
+        album_tracks = list({track.uri: track for album in results.albums for track in results.album_track_map[album.uri]}.values())
+        self.backend.setSearchResults(query, expires_at, [results.tracks, results.artists, results.albums, album_tracks],
+                                      json.dumps(album_track_ids), SEARCH_CACHE_ENTRIES)
+        self._rememberSearch(query, expires_at, results)
+
+    def _rememberSearch(self, query, expires_at, results):
+        with self.search_lock:
+            self.searches[query] = (expires_at, results)
+            self.searches.move_to_end(query)
+            while (len(self.searches) > SEARCH_CACHE_ENTRIES):
+                self.searches.popitem(last=False)
+
+    # Hit, miss and eviction counters of the object cache
+    def getCacheStats(self):
+        return self.cache.stats()
+
+    def trimArtists(self, count):
+        self.backend.trimRows("artist", count)
 
     def getArtist(self, index):
-        pickled_pl = self.r.get("artist:"+str(index))
-        return pickle.loads(pickled_pl)
+        return self.backend.getRows("artist", index, 1)[0]
 
-    def setSavedTrack(self, index, track):
-        self.r.set("track:"+str(index), pickle.dumps(track))
+    def getArtists(self, start, count):
+        return self.backend.getRows("artist", start, count)
 
-    def getSavedTrack(self, index):
-        pickled_pl = self.r.get("track:"+str(index))
-        return pickle.loads(pickled_pl)
+    def setSavedTracks(self, start, tracks):
+        self.backend.setRows("track", start, tracks)
+
+    def prependSavedTracks(self, tracks):
+        if (len(tracks) == 0):
+            return
+        self.backend.prependRows("track", tracks)
+
+    def trimSavedTracks(self, count):
+        self.backend.trimRows("track", count)
 
-    def setUserDevice(self, device):
-        print("device:"+ str(device.id))
-        self.r.set("device:"+ str(device.id), pickle.dumps(device))
+    def getSavedTrack(self, index):
+        return self.backend.getRows("track", index, 1)[0]
 
-    def getSavedDevice(self, id):
-        return self._getSavedItem("device:"+id)
+    def getSavedTracks(self, start, count):
+        return self.backend.getRows("track", start, count)
 
-    def _getSavedItem(self, id):
-        pickled_device = self.r.get(id)
-        return pickle.loads(pickled_device)
+    def setUserDevices(self, devices):
+        self.backend.setDevices(devices)
 
     def getAllSavedDevices(self):
-        return list(map(lambda idx: self._getSavedItem(idx), self.r.keys("device:*")))
+        return self.backend.getDevices()
 
     def getAllSavedPlaylists(self):
-        return list(map(lambda idx: self._getSavedItem(idx), self.r.keys("playlist-uri:*")))
+        return self.backend.getContexts("playlist")
 
     def getAllSavedAlbums(self):
-        return list(map(lambda idx: self._getSavedItem(idx), self.r.keys("album-uri:*")))
+        return self.backend.getContexts("album")
 
     def getAllNewReleases(self):
-        return list(map(lambda idx: self._getSavedItem(idx), self.r.keys("nr-uri:*")))
+        return self.backend.getContexts("nr")
 
     def clearDevices(self):
-        devices = self.r.keys("device:*")
-        if (len(devices) == 0):
-            return
-        self.r.delete(*devices)
+        self.backend.clearDevices()
+
+    # Bookkeeping for incremental library syncs (watermarks, last sync time)
+    def getSyncState(self, key):
+        return self.backend.getSyncState(key)
+
+    def setSyncState(self, key, value):
+        self.backend.setSyncState(key, value)
+
+    def getPlaylistSnapshots(self):
+        return self.backend.getPlaylistSnapshots()
+
+    def setPlaylistSnapshots(self, snapshots):
+        self.backend.setPlaylistSnapshots(snapshots)
 
     def clear(self):
-        self.r.flushdb()
+        self.backend.clear()
+        self.cache.clear()
+        with self.search_lock:
+            self.searches.clear()
+        self.revision = self.revision + 1
@@ -0,0 +1,389 @@
+import redis
+import codec
+import models # registers the record types with codec
+from config import DATASTORE_COMPRESS_MIN_BYTES
+
+# Every key family keeps the ids written under it in a companion set
+# ("<family>-ids"), so counts are a SCARD and listings a SMEMBERS instead of
+# a KEYS walk over the whole keyspace.
+INDEXED_FAMILIES = ["track", "artist", "device", "playlist-index", "playlist-uri",
+                    "album-index", "album-uri", "nr-index", "nr-uri"]
+# Families holding playlists, albums and new releases (see _setContext)
+CONTEXT_FAMILIES = ["playlist", "album", "nr"]
+# Families whose values are encoded records (the -index families hold plain ids)
+RECORD_FAMILIES = ["track", "artist", "device", "playlist-uri", "album-uri", "nr-uri", "playlist-tracks"]
+# Track lists are stored in chunks of TRACK_CHUNK_SIZE tracks, one hash field
+# each ("context-tracks:<id>"), with the total under the "count" field. Next
+# to it "context-positions:<id>" maps each track uri to its first position.
+TRACK_CHUNK_SIZE = models.TRACK_CHUNK_SIZE
+# Library keys that aren't part of a family
+LIBRARY_KEYS = ["sync-state", "playlist-snapshots"]
+# Fields of a cached search ("search:<query>"), one codec blob each, next to
+# its "expires-at" time
+SEARCH_FIELDS = ["tracks", "artists", "albums", "album-tracks"]
+
+# 1: id sets per family, 2: records in the codec format instead of pickle,
+# 3: library keys namespaced by generation, 4: chunked track lists,
+# 5: track position indexes
+STORAGE_VERSION = 5
+
+# The library lives in generations: every library key is prefixed with
+# "gen:<n>:" and "library-generation" names the published one. A full refresh
+# fills a new generation while readers keep using the published one, then
+# flips the pointer in a single SET. Devices and cached searches stay outside
+# the generations.
+PUBLISHED_GENERATION = "library-generation"
+GENERATION_COUNTER = "library-generation-counter"
+
+class RedisBackend():
+    def __init__(self, r = None, generation = None):
+        self.r = r if r is not None else redis.Redis()
+        if (generation is None):
+            self._migrate()
+            generation = int(self.r.get(PUBLISHED_GENERATION) or 0)
+        self._setGeneration(generation)
+
+    def _setGeneration(self, generation):
+        self.generation = generation
+        self.prefix = "gen:" + str(generation) + ":"
+
+    def _key(self, name):
+        if (name.startswith("device") or name.startswith("search")):
+            return name
+        return self.prefix + name
+
+    def _migrate(self):
+        version = self.r.get("storage-version")
+        if (version is None):
+            # the id sets came first, versioned by an "index-version" key of their own
+            version = 0 if self.r.get("index-version") is None else 1
+        version = int(version)
+        if (version >= STORAGE_VERSION):
+            return
+        if (version < 1):
+            self._migrateIndexes()
+        if (version < 2):
+            self._migrateRecords()
+        if (version < 3):
+            self._migrateGenerations()
+        if (version < 4):
+            self._migrateTrackChunks()
+        if (version < 5):
+            self._migrateTrackPositions()
+        self.r.set("storage-version", STORAGE_VERSION)
+
+    def _migrateIndexes(self):
+        # One-off SCAN to build the id sets for libraries stored before they existed
+        pipe = self.r.pipeline()
+        for family in INDEXED_FAMILIES:
+            prefix = family + ":"
+            for key in self.r.scan_iter(match=prefix + "*", count=500):
+                pipe.sadd(family + "-ids", key.decode('utf-8')[len(prefix):])
+        pipe.execute()
+
+    def _migrateRecords(self):
+        # One-off rewrite of pickled values into the codec format; from here
+        # on "storage-version" versions the id sets too
+        self.r.delete("index-version")
+        migrated = 0
+        for family in RECORD_FAMILIES:
+            pipe = self.r.pipeline()
+            for key in self.r.scan_iter(match=family + ":*", count=500):
+                value = self.r.get(key)
+                if (codec.is_legacy(value)):
+                    pipe.set(key, self._encode(codec.loads(value)))
+                    migrated = migrated + 1
+            pipe.execute()
+        if (migrated > 0):
+            print("Migrated records: " + str(migrated))
+
+    def _migrateGenerations(self):
+        # One-off move of an existing library into generation 1
+        pipe = self.r.pipeline()
+        names = LIBRARY_KEYS[:]
+        for family in INDEXED_FAMILIES + ["playlist-tracks"]:
+            if (family != "device"):
+                names.append(family + "-ids")
+                names.extend(key.decode('utf-8') for key in self.r.scan_iter(match=family + ":*", count=500))
+        for name in names:
+            if (self.r.exists(name)):
+                pipe.rename(name, "gen:1:" + name)
+        pipe.set(GENERATION_COUNTER, 1)
+        pipe.set(PUBLISHED_GENERATION, 1)
+        pipe.execute()
+
+    def _migrateTrackChunks(self):
+        # One-off split of whole-list track blobs into chunks
+        pipe = self.r.pipeline()
+        for key in self.r.scan_iter(match="gen:*:playlist-tracks:*", count=500):
+            prefix, _, context_id = key.decode('utf-8').rpartition("playlist-tracks:")
+            self._writeTracks(prefix + "context-tracks:" + context_id, codec.loads(self.r.get(key)), pipe)
+            pipe.delete(key)
+        pipe.execute()
+
+    def _migrateTrackPositions(self):
+        # One-off build of the position index of every stored track list
+        pipe = self.r.pipeline()
+        for key in self.r.scan_iter(match="gen:*:context-tracks:*", count=500):
+            prefix, _, context_id = key.decode('utf-8').rpartition("context-tracks:")
+            chunks = self.r.hgetall(key)
+            tracks = []
+            for chunk in range(len(chunks) - 1):
+                tracks.extend(codec.loads(chunks[str(chunk).encode('utf-8')]))
+            self._writePositions(prefix + "context-positions:" + context_id, tracks, pipe)
+        pipe.execute()
+
+    def beginGeneration(self):
+        return RedisBackend(self.r, self.r.incr(GENERATION_COUNTER))
+
+    def publishGeneration(self, backend):
+        self.r.set(PUBLISHED_GENERATION, backend.generation)
+        self._setGeneration(backend.generation)
+        self.collectGenerations()
+
+    def collectGenerations(self):
+        pipe = self.r.pipeline()
+        for key in self.r.scan_iter(match="gen:*", count=500):
+            if (not key.decode('utf-8').startswith(self.prefix)):
+                pipe.delete(key)
+        pipe.execute()
+
+    def _encode(self, value):
+        return codec.dumps(value, DATASTORE_COMPRESS_MIN_BYTES)
+
+    def _decode(self, value):
+        return None if value is None else codec.loads(value)
+
+    def _setItem(self, family, id, value, pipe):
+        pipe.set(self._key(family + ":" + str(id)), value)
+        pipe.sadd(self._key(family + "-ids"), str(id))
+
+    def _removeItems(self, family, ids, pipe):
+        if (len(ids) == 0):
+            return
+        pipe.delete(*[self._key(family + ":" + str(id)) for id in ids])
+        pipe.srem(self._key(family + "-ids"), *[str(id) for id in ids])
+
+    # Multi-get for a list of ids in one MGET; missing entries come back as None
+    def _getItems(self, family, ids):
+        keys = [self._key(family + ":" + str(id)) for id in ids]
+        if (len(keys) == 0):
+            return []
+        return [self._decode(value) for value in self.r.mget(keys)]
+
+    # Fetches every item of a family in one round trip: SORT over the id set
+    # with a GET pattern dereferences each id server side.
+    def _getAllItems(self, family):
+        values = self.r.sort(self._key(family + "-ids"), by="nosort", get=self._key(family + ":*"))
+        return [codec.loads(value) for value in values if value]
+
+    # Rows: position-keyed lists ("track", "artist")
+
+    def setRows(self, kind, start, items):
+        pipe = self.r.pipeline()
+        for idx, item in enumerate(items):
+            self._setItem(kind, start + idx, self._encode(item), pipe)
+        pipe.execute()
+
+    def getRows(self, kind, start, count):
+        return self._getItems(kind, range(start, start + count))
+
+    def countRows(self, kind):
+        return self.r.scard(self._key(kind + "-ids"))
+
+    def trimRows(self, kind, count):
+        stale = [id.decode('utf-8') for id in self.r.smembers(self._key(kind + "-ids")) if int(id) >= count]
+        pipe = self.r.pipeline()
+        self._removeItems(kind, stale, pipe)
+        pipe.execute()
+
+    def prependRows(self, kind, items):
+        self.setRows(kind, 0, items + self.getRows(kind, 0, self.countRows(kind)))
+
+    # Contexts: playlists, albums and new releases ("playlist", "album", "nr")
+    # share the same layout: the object under "<kind>-uri:<id>", its tracks in
+    # chunks under "context-tracks:<id>" and, for library items, the sort
+    # position under "<kind>-index:<index>".
+
+    def _setContext(self, kind, context, tracks, index, pipe):
+        context_id = context.uri.split(":")[-1]
+        self._setItem(kind + "-uri", context_id, self._encode(context), pipe)
+        if (tracks is not None): # None keeps the stored tracks
+            self._writeTracks(self._key("context-tracks:" + str(context_id)), tracks, pipe)
+            self._writePositions(self._key("context-positions:" + str(context_id)), tracks, pipe)
+        if (index is not None):
+            self._setItem(kind + "-index", index, context_id, pipe)
+
+    def _getContextIds(self, kind, count):
+        if (count == 0):
+            return []
+        ids = self.r.mget([self._key(kind + "-index:" + str(i)) for i in range(count)])
+        return [id.decode('utf-8') for id in ids if id]
+
+    def setContexts(self, kind, start, contexts):
+        pipe = self.r.pipeline()
+        for idx, (context, tracks) in enumerate(contexts):
+            self._setContext(kind, context, tracks, None if start is None else start + idx, pipe)
+        pipe.execute()
+
+    def prependContexts(self, kind, contexts):
+        existing = self._getContextIds(kind, self.countContexts(kind))
+        pipe = self.r.pipeline()
+        for idx, (context, tracks) in enumerate(contexts):
+            self._setContext(kind, context, tracks, idx, pipe)
+        for idx, context_id in enumerate(existing):
+            self._setItem(kind + "-index", len(contexts) + idx, context_id, pipe)
+        pipe.execute()
+
+    # Drops index positions >= count and every context no longer referenced
+    # from the index. Track lists are kept while another kind still holds
+    # the same id (e.g. a saved album that is also a new release).
+    def trimContexts(self, kind, count):
+        kept = set(self._getContextIds(kind, count))
+        stale = [id.decode('utf-8') for id in self.r.smembers(self._key(kind + "-uri-ids")) if id.decode('utf-8') not in kept]
+        positions = [id.decode('utf-8') for id in self.r.smembers(self._key(kind + "-index-ids")) if int(id) >= count]
+        others = set()
+        for other in CONTEXT_FAMILIES:
+            if (other != kind):
+                others.update(id.decode('utf-8') for id in self.r.smembers(self._key(other + "-uri-ids")))
+        orphans = [id for id in stale if id not in others]
+        pipe = self.r.pipeline()
+        self._removeItems(kind + "-index", positions, pipe)
+        self._removeItems(kind + "-uri", stale, pipe)
+        if (len(orphans) > 0):
+            pipe.delete(*[self._key("context-tracks:" + id) for id in orphans])
+            pipe.delete(*[self._key("context-positions:" + id) for id in orphans])
+        pipe.execute()
+
+    def countContexts(self, kind):
+        return self.r.scard(self._key(kind + "-index-ids"))
+
+    def hasContext(self, kind, context_id):
+        return self.r.sismember(self._key(kind + "-uri-ids"), context_id)
+
+    def getContext(self, kind, context_id):
+        return self._decode(self.r.get(self._key(kind + "-uri:" + context_id)))
+
+    def getContextAt(self, kind, index):
+        context_id = self.r.get(self._key(kind + "-index:" + str(index)))
+        if (context_id is None):
+            return None
+        return self.getContext(kind, context_id.decode('utf-8'))
+
+    def getContexts(self, kind):
+        return self._getAllItems(kind + "-uri")
+
+    def _writeTracks(self, key, tracks, pipe):
+        chunks = {"count": len(tracks)}
+        for start in range(0, len(tracks), TRACK_CHUNK_SIZE):
+            chunks[start // TRACK_CHUNK_SIZE] = self._encode(tracks[start:start + TRACK_CHUNK_SIZE])
+        pipe.delete(key)
+        pipe.hset(key, mapping=chunks)
+
+    def _writePositions(self, key, tracks, pipe):
+        # reversed, so a track listed twice maps to its first position
+        positions = {track.uri: idx for idx, track in reversed(list(enumerate(tracks)))}
+        pipe.delete(key)
+        if (len(positions) > 0):
+            pipe.hset(key, mapping=positions)
+
+    def getContextTracks(self, context_id):
+        count = self.countContextTracks(context_id)
+        if (count is None):
+            return None
+        return self.getContextTrackRange(context_id, 0, count)
+
+    # Reads only the chunks overlapping start..start+count, in one HMGET
+    def getContextTrackRange(self, context_id, start, count):
+        if (count <= 0):
+            return []
+        first = start // TRACK_CHUNK_SIZE
+        last = (start + count - 1) // TRACK_CHUNK_SIZE
+        tracks = []
+        for chunk in self.r.hmget(self._key("context-tracks:" + context_id), list(range(first, last + 1))):
+            if (chunk is None):
+                break
+            tracks.extend(codec.loads(chunk))
+        offset = start - first * TRACK_CHUNK_SIZE
+        return tracks[offset:offset + count]
+
+    def getContextTrackPosition(self, context_id, track_uri):
+        position = self.r.hget(self._key("context-positions:" + context_id), track_uri)
+        return None if position is None else int(position)
+
+    def clearContextTracks(self, context_ids):
+        if (len(context_ids) == 0):
+            return
+        self.r.delete(*[self._key(family + ":" + id) for id in context_ids
+                        for family in ["context-tracks", "context-positions"]])
+
+    def countContextTracks(self, context_id):
+        count = self.r.hget(self._key("context-tracks:" + context_id), "count")
+        return None if count is None else int(count)
+
+    # Devices
+
+    def setDevices(self, devices):
+        pipe = self.r.pipeline()
+        for device in devices:
+            self._setItem("device", device.id, self._encode(device), pipe)
+        pipe.execute()
+
+    def getDevices(self):
+        return self._getAllItems("device")
+
+    def clearDevices(self):
+        devices = [self._key("device:" + id.decode('utf-8')) for id in self.r.smembers(self._key("device-ids"))]
+        if (len(devices) == 0):
+            return
+        self.r.delete(self._key("device-ids"), *devices)
+
+    # Cached searches: each query's hash expires by itself, and "search-recent"
+    # orders the queries by expiry so only the newest max_entries are kept
+
+    def getSearchResults(self, query):
+        values = self.r.hmget(self._key("search:" + query), SEARCH_FIELDS + ["album-track-ids", "expires-at"])
+        if (values[-1] is None or values[-2] is None):
+            return None # searches cached before the album track ids were stored are fetched again
+        return (float(values[-1]), [codec.loads(value) for value in values[:-2]], values[-2].decode('utf-8'))
+
+    def setSearchResults(self, query, expires_at, lists, album_track_ids, max_entries):
+        key = self._key("search:" + query)
+        mapping = dict(zip(SEARCH_FIELDS, [self._encode(items) for items in lists]))
+        mapping["album-track-ids"] = album_track_ids
+        mapping["expires-at"] = expires_at
+        pipe = self.r.pipeline()
+        pipe.hset(key, mapping=mapping)
+        pipe.expireat(key, int(expires_at) + 1)
+        pipe.zadd(self._key("search-recent"), {query: expires_at})
+        pipe.zrange(self._key("search-recent"), 0, -max_entries - 1)
+        stale = pipe.execute()[-1]
+        if (len(stale) > 0):
+            pipe.zrem(self._key("search-recent"), *stale)
+            pipe.delete(*[self._key("search:" + query.decode('utf-8')) for query in stale])
+            pipe.execute()
+
+    # Bookkeeping for incremental library syncs
+
+    def getSyncState(self, key):
+        value = self.r.hget(self._key("sync-state"), key)
+        return None if value is None else value.decode('utf-8')
+
+    def setSyncState(self, key, value):
+        self.r.hset(self._key("sync-state"), key, value)
+
+    def getPlaylistSnapshots(self):
+        snapshots = self.r.hgetall(self._key("playlist-snapshots"))
+        return {id.decode('utf-8'): snapshot.decode('utf-8') for id, snapshot in snapshots.items()}
+
+    def setPlaylistSnapshots(self, snapshots):
+        pipe = self.r.pipeline()
+        pipe.delete(self._key("playlist-snapshots"))
+        if (len(snapshots) > 0):
+            pipe.hset(self._key("playlist-snapshots"), mapping=snapshots)
+        pipe.execute()
+
+    def clear(self):
+        self.r.flushdb()
+        self.r.set("storage-version", STORAGE_VERSION)
+        self._setGeneration(0)
@@ -0,0 +1,354 @@
+import sqlite3
+import threading
+import codec
+from models import *
+
+# Embedded storage backend: one SQLite file, no server process. Every library
+# table carries the generation it belongs to in its key; the published one is
+# recorded in the meta table, so publishing is a single UPDATE and older
+# generations are removed with a DELETE per table. Devices and cached searches
+# live outside the generations. The number of saved tracks, artists and
+# library contexts of each generation is kept in the counts table, updated in
+# the transaction of every write, so counting is a primary key lookup.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS saved_tracks (
+    gen INTEGER NOT NULL, pos INTEGER NOT NULL,
+    title TEXT, artist TEXT, album TEXT, uri TEXT,
+    PRIMARY KEY (gen, pos)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS artists (
+    gen INTEGER NOT NULL, pos INTEGER NOT NULL,
+    name TEXT, uri TEXT,
+    PRIMARY KEY (gen, pos)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS playlists (
+    gen INTEGER NOT NULL, kind TEXT NOT NULL, id TEXT NOT NULL, pos INTEGER,
+    name TEXT, idx INTEGER, uri TEXT, track_count INTEGER,
+    PRIMARY KEY (gen, kind, id));
+CREATE INDEX IF NOT EXISTS playlists_pos ON playlists (gen, kind, pos);
+CREATE TABLE IF NOT EXISTS albums (
+    gen INTEGER NOT NULL, kind TEXT NOT NULL, id TEXT NOT NULL, pos INTEGER,
+    name TEXT, artist TEXT, track_count INTEGER, uri TEXT,
+    PRIMARY KEY (gen, kind, id));
+CREATE INDEX IF NOT EXISTS albums_pos ON albums (gen, kind, pos);
+CREATE TABLE IF NOT EXISTS context_tracks (
+    gen INTEGER NOT NULL, context_id TEXT NOT NULL, pos INTEGER NOT NULL,
+    title TEXT, artist TEXT, album TEXT, uri TEXT,
+    PRIMARY KEY (gen, context_id, pos)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS context_tracks_uri ON context_tracks (gen, context_id, uri);
+CREATE TABLE IF NOT EXISTS track_lists (
+    gen INTEGER NOT NULL, context_id TEXT NOT NULL, count INTEGER,
+    PRIMARY KEY (gen, context_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS devices (id TEXT PRIMARY KEY, name TEXT, is_active INTEGER);
+CREATE TABLE IF NOT EXISTS search_results (
+    query TEXT PRIMARY KEY, tracks BLOB, artists BLOB, albums BLOB, album_tracks BLOB,
+    album_track_ids TEXT, expires_at REAL);
+CREATE TABLE IF NOT EXISTS sync_state (
+    gen INTEGER NOT NULL, key TEXT NOT NULL, value TEXT,
+    PRIMARY KEY (gen, key)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS playlist_snapshots (
+    gen INTEGER NOT NULL, id TEXT NOT NULL, snapshot TEXT,
+    PRIMARY KEY (gen, id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS counts (
+    gen INTEGER NOT NULL, kind TEXT NOT NULL, count INTEGER NOT NULL,
+    PRIMARY KEY (gen, kind)) WITHOUT ROWID;
+"""
+
+LIBRARY_TABLES = ["saved_tracks", "artists", "playlists", "albums", "context_tracks",
+                  "track_lists", "sync_state", "playlist_snapshots", "counts"]
+
+# 1: the counts table, 2: album track ids of cached searches
+STORAGE_VERSION = 2
+
+# kind -> (table, record class, columns in constructor order)
+ROW_TABLES = {
+    "track": ("saved_tracks", UserTrack, ["title", "artist", "album", "uri"]),
+    "artist": ("artists", UserArtist, ["name", "uri"]),
+}
+CONTEXT_TABLES = {
+    "playlist": ("playlists", UserPlaylist, ["name", "idx", "uri", "track_count"]),
+    "album": ("albums", UserAlbum, ["name", "artist", "track_count", "uri"]),
+    "nr": ("albums", UserAlbum, ["name", "artist", "track_count", "uri"]),
+}
+TRACK_COLUMNS = ["title", "artist", "album", "uri"]
+
+class SqliteBackend():
+    def __init__(self, path, generation = None):
+        self.path = path
+        self.local = threading.local()
+        if (generation is None):
+            with self._conn() as conn:
+                conn.executescript(SCHEMA)
+            self._migrate()
+            generation = int(self._getMeta("library-generation") or 0)
+        self.generation = generation
+
+    def _migrate(self):
+        version = int(self._getMeta("storage-version") or 0)
+        if (version >= STORAGE_VERSION):
+            return
+        with self._conn() as conn:
+            if (version < 1):
+                # One-off count of the rows stored before the counts table existed
+                for kind, (table, _, _) in ROW_TABLES.items():
+                    conn.execute("INSERT OR REPLACE INTO counts (gen, kind, count)"
+                                 " SELECT gen, ?, COUNT(*) FROM " + table + " GROUP BY gen", (kind,))
+                for kind, (table, _, _) in CONTEXT_TABLES.items():
+                    conn.execute("INSERT OR REPLACE INTO counts (gen, kind, count) SELECT gen, ?, COUNT(*) FROM " + table +
+                                 " WHERE kind = ? AND pos IS NOT NULL GROUP BY gen", (kind, kind))
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(search_results)")]
+            if ("album_track_ids" not in columns):
+                # searches cached without them are fetched again
+                conn.execute("DELETE FROM search_results")
+                conn.execute("ALTER TABLE search_results ADD COLUMN album_track_ids TEXT")
+            self._setMeta(conn, "storage-version", STORAGE_VERSION)
+
+    # sqlite3 connections can't be shared between threads, so each thread
+    # (UI, poll loop, refresh) gets its own
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if (conn is None):
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def _getMeta(self, key):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _setMeta(self, conn, key, value):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def beginGeneration(self):
+        with self._conn() as conn:
+            counter = int(self._getMeta("library-generation-counter") or self.generation) + 1
+            self._setMeta(conn, "library-generation-counter", counter)
+        return SqliteBackend(self.path, counter)
+
+    def publishGeneration(self, backend):
+        with self._conn() as conn:
+            self._setMeta(conn, "library-generation", backend.generation)
+        self.generation = backend.generation
+        self.collectGenerations()
+
+    def collectGenerations(self):
+        with self._conn() as conn:
+            for table in LIBRARY_TABLES:
+                conn.execute("DELETE FROM " + table + " WHERE gen != ?", (self.generation,))
+
+    def _addCount(self, conn, kind, delta):
+        if (delta != 0):
+            conn.execute("INSERT INTO counts (gen, kind, count) VALUES (?, ?, ?)"
+                         " ON CONFLICT (gen, kind) DO UPDATE SET count = count + excluded.count",
+                         (self.generation, kind, delta))
+
+    def _getCount(self, kind):
+        row = self._conn().execute("SELECT count FROM counts WHERE gen = ? AND kind = ?", (self.generation, kind)).fetchone()
+        return 0 if row is None else row[0]
+
+    # Rows
+
+    def setRows(self, kind, start, items):
+        table, _, columns = ROW_TABLES[kind]
+        sql = "INSERT OR REPLACE INTO " + table + " (gen, pos, " + ", ".join(columns) + ") VALUES (?, ?" + ", ?" * len(columns) + ")"
+        with self._conn() as conn:
+            # positions already taken are replaced, the others add to the count
+            replaced = conn.execute("SELECT COUNT(*) FROM " + table + " WHERE gen = ? AND pos >= ? AND pos < ?",
+                                    (self.generation, start, start + len(items))).fetchone()[0]
+            self._addCount(conn, kind, len(items) - replaced)
+            conn.executemany(sql, [[self.generation, start + idx] + [getattr(item, c) for c in columns]
+                                   for idx, item in enumerate(items)])
+
+    def getRows(self, kind, start, count):
+        table, cls, columns = ROW_TABLES[kind]
+        rows = self._conn().execute("SELECT pos, " + ", ".join(columns) + " FROM " + table +
+                                    " WHERE gen = ? AND pos >= ? AND pos < ? ORDER BY pos",
+                                    (self.generation, start, start + count)).fetchall()
+        items = [None] * count
+        for row in rows:
+            items[row[0] - start] = cls(*row[1:])
+        return items
+
+    def countRows(self, kind):
+        return self._getCount(kind)
+
+    def trimRows(self, kind, count):
+        table = ROW_TABLES[kind][0]
+        with self._conn() as conn:
+            deleted = conn.execute("DELETE FROM " + table + " WHERE gen = ? AND pos >= ?", (self.generation, count)).rowcount
+            self._addCount(conn, kind, -deleted)
+
+    def prependRows(self, kind, items):
+        table = ROW_TABLES[kind][0]
+        with self._conn() as conn:
+            # shift through negative positions so no row collides with the primary key midway
+            conn.execute("UPDATE " + table + " SET pos = -(pos + ?) - 1 WHERE gen = ?", (len(items), self.generation))
+            conn.execute("UPDATE " + table + " SET pos = -pos - 1 WHERE gen = ? AND pos < 0", (self.generation,))
+        self.setRows(kind, 0, items)
+
+    # Contexts
+
+    def _setContext(self, conn, kind, context, tracks, pos):
+        table, _, columns = CONTEXT_TABLES[kind]
+        context_id = context.uri.split(":")[-1]
+        # counted are the contexts at a library position
+        row = conn.execute("SELECT pos FROM " + table + " WHERE gen = ? AND kind = ? AND id = ?",
+                           (self.generation, kind, context_id)).fetchone()
+        had_pos = row is not None and row[0] is not None
+        delta = 1 if pos is not None and not had_pos else 0
+        if (pos is not None):
+            delta -= conn.execute("UPDATE " + table + " SET pos = NULL WHERE gen = ? AND kind = ? AND pos = ? AND id != ?",
+                                  (self.generation, kind, pos, context_id)).rowcount
+        self._addCount(conn, kind, delta)
+        conn.execute("INSERT INTO " + table + " (gen, kind, id, pos, " + ", ".join(columns) + ") VALUES (?, ?, ?, ?" + ", ?" * len(columns) + ")"
+                     " ON CONFLICT (gen, kind, id) DO UPDATE SET pos = COALESCE(excluded.pos, pos), " +
+                     ", ".join(c + " = excluded." + c for c in columns),
+                     [self.generation, kind, context_id, pos] + [getattr(context, c) for c in columns])
+        if (tracks is not None): # None keeps the stored tracks
+            conn.execute("INSERT OR REPLACE INTO track_lists (gen, context_id, count) VALUES (?, ?, ?)",
+                         (self.generation, context_id, len(tracks)))
+            conn.execute("DELETE FROM context_tracks WHERE gen = ? AND context_id = ?", (self.generation, context_id))
+            conn.executemany("INSERT INTO context_tracks (gen, context_id, pos, " + ", ".join(TRACK_COLUMNS) + ") VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [[self.generation, context_id, idx] + [getattr(track, c) for c in TRACK_COLUMNS]
+                              for idx, track in enumerate(tracks)])
+
+    def _toContext(self, kind, row):
+        return None if row is None else CONTEXT_TABLES[kind][1](*row)
+
+    def setContexts(self, kind, start, contexts):
+        with self._conn() as conn:
+            for idx, (context, tracks) in enumerate(contexts):
+                self._setContext(conn, kind, context, tracks, None if start is None else start + idx)
+
+    def prependContexts(self, kind, contexts):
+        table = CONTEXT_TABLES[kind][0]
+        with self._conn() as conn:
+            conn.execute("UPDATE " + table + " SET pos = pos + ? WHERE gen = ? AND kind = ? AND pos IS NOT NULL",
+                         (len(contexts), self.generation, kind))
+            for idx, (context, tracks) in enumerate(contexts):
+                self._setContext(conn, kind, context, tracks, idx)
+
+    def trimContexts(self, kind, count):
+        table = CONTEXT_TABLES[kind][0]
+        with self._conn() as conn:
+            deleted = conn.execute("DELETE FROM " + table + " WHERE gen = ? AND kind = ? AND pos >= ?",
+                                   (self.generation, kind, count)).rowcount
+            self._addCount(conn, kind, -deleted)
+            conn.execute("DELETE FROM " + table + " WHERE gen = ? AND kind = ? AND pos IS NULL", (self.generation, kind))
+            for table in ["context_tracks", "track_lists"]:
+                conn.execute("DELETE FROM " + table + " WHERE gen = ? AND context_id NOT IN"
+                             " (SELECT id FROM playlists WHERE gen = ? UNION SELECT id FROM albums WHERE gen = ?)",
+                             (self.generation, self.generation, self.generation))
+
+    def countContexts(self, kind):
+        return self._getCount(kind)
+
+    def hasContext(self, kind, context_id):
+        table = CONTEXT_TABLES[kind][0]
+        return self._conn().execute("SELECT 1 FROM " + table + " WHERE gen = ? AND kind = ? AND id = ?",
+                                    (self.generation, kind, context_id)).fetchone() is not None
+
+    def _selectContexts(self, kind, where, args):
+        table, _, columns = CONTEXT_TABLES[kind]
+        return self._conn().execute("SELECT " + ", ".join(columns) + " FROM " + table +
+                                    " WHERE gen = ? AND kind = ? AND " + where, [self.generation, kind] + args)
+
+    def getContext(self, kind, context_id):
+        return self._toContext(kind, self._selectContexts(kind, "id = ?", [context_id]).fetchone())
+
+    def getContextAt(self, kind, index):
+        return self._toContext(kind, self._selectContexts(kind, "pos = ?", [index]).fetchone())
+
+    def getContexts(self, kind):
+        return [self._toContext(kind, row) for row in self._selectContexts(kind, "1", []).fetchall()]
+
+    def getContextTracks(self, context_id):
+        if (self.countContextTracks(context_id) is None):
+            return None
+        rows = self._conn().execute("SELECT " + ", ".join(TRACK_COLUMNS) + " FROM context_tracks"
+                                    " WHERE gen = ? AND context_id = ? ORDER BY pos", (self.generation, context_id)).fetchall()
+        return [UserTrack(*row) for row in rows]
+
+    def getContextTrackRange(self, context_id, start, count):
+        rows = self._conn().execute("SELECT " + ", ".join(TRACK_COLUMNS) + " FROM context_tracks"
+                                    " WHERE gen = ? AND context_id = ? AND pos >= ? AND pos < ? ORDER BY pos",
+                                    (self.generation, context_id, start, start + count)).fetchall()
+        return [UserTrack(*row) for row in rows]
+
+    def getContextTrackPosition(self, context_id, track_uri):
+        return self._conn().execute("SELECT MIN(pos) FROM context_tracks WHERE gen = ? AND context_id = ? AND uri = ?",
+                                    (self.generation, context_id, track_uri)).fetchone()[0]
+
+    # None when no track list is stored for the context
+    def countContextTracks(self, context_id):
+        row = self._conn().execute("SELECT count FROM track_lists WHERE gen = ? AND context_id = ?",
+                                   (self.generation, context_id)).fetchone()
+        return None if row is None else row[0]
+
+    def clearContextTracks(self, context_ids):
+        with self._conn() as conn:
+            for table in ["context_tracks", "track_lists"]:
+                conn.executemany("DELETE FROM " + table + " WHERE gen = ? AND context_id = ?",
+                                 [(self.generation, id) for id in context_ids])
+
+    # Devices
+
+    def setDevices(self, devices):
+        with self._conn() as conn:
+            conn.executemany("INSERT OR REPLACE INTO devices (id, name, is_active) VALUES (?, ?, ?)",
+                             [(device.id, device.name, 1 if device.is_active else 0) for device in devices])
+
+    def _toDevice(self, row):
+        return None if row is None else UserDevice(row[0], row[1], row[2] == 1)
+
+    def getDevices(self):
+        return [self._toDevice(row) for row in self._conn().execute("SELECT id, name, is_active FROM devices").fetchall()]
+
+    def clearDevices(self):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM devices")
+
+    # Cached searches, as codec blobs; only the max_entries expiring last are kept
+
+    def getSearchResults(self, query):
+        row = self._conn().execute("SELECT expires_at, tracks, artists, albums, album_tracks, album_track_ids"
+                                   " FROM search_results WHERE query = ?", (query,)).fetchone()
+        return None if row is None else (row[0], [codec.loads(blob) for blob in row[1:5]], row[5])
+
+    def setSearchResults(self, query, expires_at, lists, album_track_ids, max_entries):
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO search_results"
+                         " (query, tracks, artists, albums, album_tracks, album_track_ids, expires_at)"
+                         " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         [query] + [codec.dumps(items) for items in lists] + [album_track_ids, expires_at])
+            conn.execute("DELETE FROM search_results WHERE query NOT IN"
+                         " (SELECT query FROM search_results ORDER BY expires_at DESC LIMIT ?)", (max_entries,))
+
+    # Bookkeeping for incremental library syncs
+
+    def getSyncState(self, key):
+        row = self._conn().execute("SELECT value FROM sync_state WHERE gen = ? AND key = ?", (self.generation, key)).fetchone()
+        return None if row is None else row[0]
+
+    def setSyncState(self, key, value):
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO sync_state (gen, key, value) VALUES (?, ?, ?)", (self.generation, key, str(value)))
+
+    def getPlaylistSnapshots(self):
+        rows = self._conn().execute("SELECT id, snapshot FROM playlist_snapshots WHERE gen = ?", (self.generation,)).fetchall()
+        return {id: snapshot for id, snapshot in rows}
+
+    def setPlaylistSnapshots(self, snapshots):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM playlist_snapshots WHERE gen = ?", (self.generation,))
+            conn.executemany("INSERT INTO playlist_snapshots (gen, id, snapshot) VALUES (?, ?, ?)",
+                             [(self.generation, id, snapshot) for id, snapshot in snapshots.items()])
+
+    def clear(self):
+        with self._conn() as conn:
+            for table in LIBRARY_TABLES + ["devices", "search_results"]:
+                conn.execute("DELETE FROM " + table)
+            self._setMeta(conn, "library-generation", 0)
+        self.generation = 0
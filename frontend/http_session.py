@@ -0,0 +1,125 @@
+import random
+import threading
+import time
+import requests
+from contextlib import nullcontext
+from urllib.parse import urlparse
+
+# HTTP session shared by every Web API call (poll loop, UI commands, library
+# sync). Connections are pooled and kept alive, so a request normally reuses
+# an open TLS connection instead of paying a new handshake. Timeouts are set
+# per endpoint family, and failed requests are retried here with exponential
+# backoff: 429 responses after the Retry-After the server asked for,
+# connection errors and 5xx responses only for requests safe to repeat.
+# GETs go through the response cache when one is given (see response_cache),
+# and each request sent waits for a slot of the scheduler (see scheduler).
+# Nothing here is specific to api.spotify.com, so the behaviour can be tried
+# against a local stand-in server.
+
+# (path prefix, (connect, read) timeout); the first match wins
+TIMEOUTS = [
+    ("/v1/me/player", (3.05, 5)), # playback state and controls, polled and user facing
+    ("/v1/search", (3.05, 5)),
+    ("", (3.05, 15)),             # library pages can be large
+]
+
+RETRY_STATUSES = [500, 502, 503, 504]
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS"]
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+
+class ManagedSession(requests.Session):
+    def __init__(self, pool_size = 10, max_retries = 3, max_retry_after = 60, response_cache = None, scheduler = None):
+        super().__init__()
+        self.response_cache = response_cache
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+        # a longer wait than this is handed back as the 429 instead
+        self.max_retry_after = max_retry_after
+        # retries happen in request() so they can be counted and honour Retry-After
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.mount('http://', self.adapter)
+        self.mount('https://', self.adapter)
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "retries": 0, "rate_limited": 0, "errors": 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters[name] + 1
+
+    def timeout_for(self, url):
+        path = urlparse(url).path
+        return next(timeout for prefix, timeout in TIMEOUTS if path.startswith(prefix))
+
+    def backoff(self, attempt):
+        return min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)) * random.uniform(0.5, 1)
+
+    def retry_after(self, response):
+        try:
+            return float(response.headers.get("Retry-After", 1))
+        except ValueError:
+            return None
+
+    def request(self, method, url, **kwargs):
+        kwargs['timeout'] = self.timeout_for(url)
+        method = method.upper()
+        if (self.response_cache is None or method != "GET"):
+            return self._request(method, url, kwargs)
+        # cache entries are keyed by the URL with its query string
+        full_url = requests.Request(method, url, params=kwargs.pop('params', None)).prepare().url
+        def send(headers):
+            return self._request(method, full_url, dict(kwargs, headers=dict(kwargs.get('headers') or {}, **headers)))
+        return self.response_cache.fetch(full_url, send)
+
+    def _request(self, method, url, kwargs):
+        attempt = 0
+        while True:
+            self._count("requests")
+            try:
+                with (self.scheduler.slot() if self.scheduler is not None else nullcontext()):
+                    response = super().request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self._count("errors")
+                if (attempt >= self.max_retries or method not in IDEMPOTENT_METHODS):
+                    raise
+                delay = self.backoff(attempt)
+            else:
+                if (response.status_code == 429):
+                    self._count("rate_limited")
+                    delay = self.retry_after(response)
+                    if (delay is None or delay > self.max_retry_after):
+                        return response
+                    if (self.scheduler is not None):
+                        self.scheduler.pause(delay)
+                elif (response.status_code in RETRY_STATUSES and method in IDEMPOTENT_METHODS):
+                    delay = self.backoff(attempt)
+                else:
+                    return response
+                if (attempt >= self.max_retries):
+                    return response
+                response.close()
+            self._count("retries")
+            time.sleep(delay)
+            attempt = attempt + 1
+
+    # Connections opened against requests served, over every host's pool
+    def connection_stats(self):
+        pools = self.adapter.poolmanager.pools
+        opened = 0
+        served = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if (pool is not None):
+                opened = opened + pool.num_connections
+                served = served + pool.num_requests
+        return {"new_connections": opened, "reused_connections": served - opened}
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats.update(self.connection_stats())
+        if (self.response_cache is not None):
+            stats["cache"] = self.response_cache.stats()
+        if (self.scheduler is not None):
+            stats["queue_wait"] = self.scheduler.stats()
+        return stats
@@ -0,0 +1,111 @@
+import codec
+
+# Track lists are stored and read in chunks of this many tracks; the Redis
+# layout persists it, so changing it needs a migration
+TRACK_CHUNK_SIZE = 50
+
+class UserDevice():
+    __slots__ = ['id', 'name', 'is_active']
+    def __init__(self, id, name, is_active):
+        self.id = id
+        self.name = name
+        self.is_active = is_active
+
+class UserTrack():
+    __slots__ = ['title', 'artist', 'album', 'uri']
+    def __init__(self, title, artist, album, uri):
+        self.title = title
+        self.artist = artist
+        self.album = album
+        self.uri = uri
+
+    def __str__(self):
+        return self.title + " - " + self.artist + " - " + self.album
+
+class UserAlbum():
+    __slots__ = ['name', 'artist', 'track_count', 'uri']
+    def __init__(self, name, artist, track_count, uri):
+        self.name = name
+        self.artist = artist
+        self.uri = uri
+        self.track_count = track_count
+
+    def __str__(self):
+        return self.name + " - " + self.artist
+
+class UserArtist():
+    __slots__ = ['name', 'uri']
+    def __init__(self, name, uri):
+        self.name = name
+        self.uri = uri
+
+    def __str__(self):
+        return self.name
+
+class UserPlaylist():
+    __slots__ = ['name', 'idx', 'uri', 'track_count']
+    def __init__(self, name, idx, uri, track_count):
+        self.name = name
+        self.idx = idx
+        self.uri = uri
+        self.track_count = track_count
+
+    def __str__(self):
+        return self.name
+
+class SearchResults():
+    __slots__ = ['tracks', 'artists', 'albums', 'album_track_map', 'playlists', 'version']
+    def __init__(self, tracks, artists, albums, album_track_map, playlists = None):
+        self.tracks = tracks
+        self.artists = artists
+        self.albums = albums
+        self.album_track_map = album_track_map
+        self.playlists = playlists if playlists is not None else []
+        # bumped when more results are merged in (see spotify_manager.merge_search_results)
+        self.version = 0
+
+    def is_empty(self):
+        return len(self.tracks) + len(self.artists) + len(self.albums) + len(self.playlists) == 0
+
+# What is playing, as an immutable snapshot: Datastore.publishNowPlaying
+# publishes each one with a version above the one before, so readers can tell
+# whether anything changed. Fields read like a dict, replace() makes a changed
+# copy (keeping the version), and an empty snapshot means nothing is playing.
+class NowPlaying():
+    __slots__ = ['_fields', 'version']
+    def __init__(self, fields = None, version = 0):
+        object.__setattr__(self, '_fields', dict(fields or {}))
+        object.__setattr__(self, 'version', version)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("NowPlaying snapshots are immutable")
+
+    def __getitem__(self, key):
+        return self._fields[key]
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __bool__(self):
+        return len(self._fields) > 0
+
+    def get(self, key, default = None):
+        return self._fields.get(key, default)
+
+    def fields(self):
+        return dict(self._fields)
+
+    def replace(self, **changes):
+        return NowPlaying(dict(self._fields, **changes), self.version)
+
+    # Names of the fields that differ from other (a snapshot or a dict)
+    def changed_fields(self, other):
+        other = other._fields if isinstance(other, NowPlaying) else other
+        return set(key for key in self._fields.keys() | other.keys() if self._fields.get(key) != other.get(key))
+
+# Datastore record types; tags are persisted so they must never be reused
+codec.register(1, UserDevice)
+codec.register(2, UserTrack)
+codec.register(3, UserAlbum)
+codec.register(4, UserArtist)
+codec.register(5, UserPlaylist)
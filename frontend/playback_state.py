@@ -0,0 +1,112 @@
+import threading
+import time
+from poller import progress_at
+
+# The now playing state as the UI expects it, a step ahead of the Web API.
+# A playback command applies its expected effect (apply) to the published
+# snapshot the moment its button is pressed, so the next frame already shows
+# it; the request follows on the command executor.
+#
+# The expected fields stay on top of what polls return (polled) as long as a
+# poll can't have seen the commands yet: while any is queued or running, and
+# for polls started before the last one finished. The first poll started
+# after that is authoritative and replaces them. A failed command rolls them
+# back (failed) and leaves a notice in the snapshot for a few seconds. An
+# event of the local player (event) is authoritative for the fields it
+# reports, so the expected ones it changes give way to it; the rest stay on
+# top.
+#
+# Everything publishing now playing goes through here, under one lock, so an
+# update is never derived from a snapshot another one has replaced meanwhile.
+
+# Fields that only show where playback stands, not what a command changed
+TIMING_FIELDS = {'progress', 'timestamp', 'duration'}
+# Seconds a failed command's notice stays on screen
+NOTICE_SECONDS = 3
+
+class PlaybackState():
+    def __init__(self, datastore, executor):
+        self.datastore = datastore
+        # the commands the expected fields wait for
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.expected = {}
+        # the snapshot before the first of the expected fields, for rolling back
+        self.base = None
+        self.notice = None
+        self.counters = {"applied": 0, "confirmed": 0, "corrected": 0, "rolled_back": 0}
+
+    # Publishes now playing with changes applied straight away
+    def apply(self, changes):
+        with self.lock:
+            now_playing = self.datastore.now_playing
+            if (len(self.expected) == 0):
+                self.base = now_playing
+            self.expected.update(changes)
+            self.counters["applied"] = self.counters["applied"] + 1
+            return self.datastore.publishNowPlaying(now_playing.replace(**changes))
+
+    # Publishes now_playing (fields) as polled; started_at is the
+    # time.monotonic() the poll was sent at
+    def polled(self, now_playing, started_at):
+        with self.lock:
+            if (len(self.expected) > 0 and not self.executor.busy() and started_at >= self.executor.finished_at):
+                outcome = "confirmed" if self._matches(now_playing) else "corrected"
+                self.counters[outcome] = self.counters[outcome] + 1
+                self.expected = {}
+                self.base = None
+            fields = dict(now_playing or {})
+            if (now_playing):
+                fields.update(self.expected)
+            return self.datastore.publishNowPlaying(self._with_notice(fields))
+
+    # Publishes the fields update(now playing) returns, as (fields or None,
+    # whether to poll) like player_events.apply_event. Returns whether to poll.
+    def event(self, update):
+        with self.lock:
+            now_playing = self.datastore.now_playing
+            fields, poll = update(now_playing)
+            if (fields is not None):
+                reported = [key for key in self.expected if key in fields and fields[key] != now_playing.get(key)]
+                if (len(reported) > 0 and len(reported) == len(self.expected)):
+                    outcome = "confirmed" if self._matches(fields) else "corrected"
+                    self.counters[outcome] = self.counters[outcome] + 1
+                    self.base = None
+                for key in reported:
+                    del self.expected[key]
+                fields.update(self.expected)
+                self.datastore.publishNowPlaying(self._with_notice(fields))
+            return poll
+
+    def _matches(self, now_playing):
+        return bool(now_playing) and all(now_playing.get(key) == value for key, value in self.expected.items()
+                                         if key not in TIMING_FIELDS)
+
+    # Rolls the expected fields back to the state before them, with notice
+    # shown for NOTICE_SECONDS
+    def failed(self, notice):
+        with self.lock:
+            self.notice = (notice, time.time() + NOTICE_SECONDS)
+            fields = self.datastore.now_playing.fields()
+            if (self.base is not None):
+                for key in self.expected:
+                    if (key in self.base):
+                        fields[key] = self.base[key]
+                    else:
+                        fields.pop(key, None)
+                if (self.base):
+                    fields.update(progress=progress_at(self.base), timestamp=time.time())
+                self.counters["rolled_back"] = self.counters["rolled_back"] + 1
+            self.expected = {}
+            self.base = None
+            return self.datastore.publishNowPlaying(self._with_notice(fields))
+
+    def _with_notice(self, fields):
+        if (self.notice is not None and self.notice[1] > time.time()):
+            fields.update(notice=self.notice[0], notice_until=self.notice[1])
+        return fields
+
+    # Expected effects applied, and how the authoritative polls found them
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, pending=len(self.expected))
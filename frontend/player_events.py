@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from poller import progress_at
+
+# Events of the local player (raspotify/librespot), so the now playing state
+# follows track changes, play/pause and seeks as they happen instead of at
+# the next Web API poll.
+#
+# librespot runs its --onevent program (LIBRESPOT_ONEVENT in raspotify's
+# config) for every player event, with the details in environment
+# variables. Run as that program, this file forwards them as one JSON
+# datagram to the Unix socket PlayerEventListener listens on:
+#
+#   LIBRESPOT_ONEVENT="/home/pi/vPod/frontend/player_events.py"
+#
+# Running it by hand with the variables set emits a fake event, e.g.
+#
+#   PLAYER_EVENT=paused TRACK_ID=4uLU6hMCjMI75M1A2tKUQC POSITION_MS=30000 ./player_events.py
+
+# The variables librespot sets; older versions only send the ids
+EVENT_VARIABLES = ["PLAYER_EVENT", "TRACK_ID", "OLD_TRACK_ID", "URI", "NAME", "ARTISTS", "ALBUM",
+                   "DURATION_MS", "POSITION_MS", "VOLUME"]
+
+# A new track: "track_changed" carries its details, the older "changed"
+# and "started" only its id
+TRACK_EVENTS = ["track_changed", "changed", "started"]
+# Events with the playback position; None keeps whether it plays
+POSITION_EVENTS = {"playing": True, "paused": False, "seeked": None, "position_correction": None}
+STOP_EVENTS = ["stopped", "session_disconnected"]
+
+def track_uri(event):
+    if (event.get("URI")):
+        return event["URI"]
+    return "spotify:track:" + event["TRACK_ID"] if event.get("TRACK_ID") else None
+
+# The now playing fields after event, from the now_playing snapshot before
+# it, as (fields or None if nothing changed, whether to poll). Polls tell
+# what an event can't: the details of a track on players that only send its
+# id, or a new context. context_position(fields, context_uri, track_uri)
+# fills in the track's position in its context.
+def apply_event(event, now_playing, context_position):
+    kind = event.get("PLAYER_EVENT")
+    uri = track_uri(event)
+    if (kind in TRACK_EVENTS):
+        if (not event.get("NAME") or not now_playing):
+            return None, True
+        artist = event.get("ARTISTS", "").split("\n")[0]
+        fields = dict(now_playing.fields(), name=event["NAME"], track_uri=uri, artist=artist,
+                      album=event.get("ALBUM", ""), duration=int(event.get("DURATION_MS") or 0),
+                      progress=int(event.get("POSITION_MS") or 0), timestamp=time.time(), track_index=-1)
+        if ('context_uri' not in fields):
+            return fields, False
+        context_position(fields, fields['context_uri'], uri)
+        # not part of the context that was playing
+        return fields, fields['track_index'] < 0
+    if (kind in POSITION_EVENTS):
+        if (not now_playing or (uri is not None and uri != now_playing['track_uri'])):
+            return None, True
+        is_playing = POSITION_EVENTS[kind]
+        return dict(now_playing.fields(), progress=int(event.get("POSITION_MS") or 0), timestamp=time.time(),
+                    is_playing=now_playing['is_playing'] if is_playing is None else is_playing), False
+    if (kind in STOP_EVENTS and now_playing):
+        return dict(now_playing.fields(), progress=progress_at(now_playing), timestamp=time.time(), is_playing=False), False
+    return None, False
+
+def send_event(path, event):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(json.dumps(event).encode('utf-8'), path)
+    finally:
+        sock.close()
+
+class PlayerEventListener():
+    def __init__(self, path, on_event, on_close = None):
+        self.path = path
+        self.on_event = on_event
+        # called once no more events can be received
+        self.on_close = on_close
+        self.sock = None
+        self.events = 0
+
+    def start(self):
+        if (os.path.exists(self.path)):
+            os.remove(self.path) # left behind by an earlier run
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        # the player runs as a user of its own
+        os.chmod(self.path, 0o666)
+        thread = threading.Thread(target=self.run, name="player-events")
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                # closed by stop(), or the socket failed
+                if (self.on_close is not None):
+                    self.on_close()
+                return
+            try:
+                event = json.loads(data.decode('utf-8'))
+            except ValueError:
+                print("bad player event: " + repr(data[:100]))
+                continue
+            self.events = self.events + 1
+            try:
+                self.on_event(event)
+            except Exception as e:
+                print("player event " + str(event.get("PLAYER_EVENT")) + " failed: " + repr(e))
+
+    def stop(self):
+        if (self.sock is not None):
+            self.sock.close()
+            self.sock = None
+            os.remove(self.path)
+
+if __name__ == "__main__":
+    from config import PLAYER_EVENTS_SOCKET
+    event = {name: os.environ[name] for name in EVENT_VARIABLES if name in os.environ}
+    try:
+        send_event(sys.argv[1] if len(sys.argv) > 1 else PLAYER_EVENTS_SOCKET, event)
+    except OSError:
+        pass # the UI isn't running
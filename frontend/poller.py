@@ -0,0 +1,129 @@
+import threading
+import time
+
+# Decides when the now playing state is polled next. Between polls the
+# progress is extrapolated from the last poll (progress_at), so a playing
+# track only needs a poll around its expected end, plus an occasional one to
+# notice seeks and skips made elsewhere. After a user command a few quick
+# polls pick up its effect. Paused, idle or with the screen asleep it polls
+# rarely. When the local player reports its events (see player_events), those
+# keep the state current and polls are only an occasional consistency check,
+# plus one after each user command to confirm its expected effect. Without an
+# event for a while, or once the player stopped, polling adapts again.
+
+# Seconds past the expected end of a track before polling for the next one
+BOUNDARY_DELAY = 0.5
+# Quick polls after a user command, the first after COMMAND_DELAY and each
+# following one twice as late
+FOLLOW_UP_POLLS = 3
+COMMAND_DELAY = 0.4
+
+# Playback position in ms of now_playing at time now, extrapolated from when
+# it was polled
+def progress_at(now_playing, now = None):
+    if (not now_playing['is_playing']):
+        return now_playing['progress']
+    elapsed = (now if now is not None else time.time()) - now_playing['timestamp']
+    return min(now_playing['duration'], now_playing['progress'] + elapsed * 1000)
+
+class NowPlayingPoller():
+    def __init__(self, playing_interval, paused_interval, asleep_interval, baseline_interval):
+        # longest wait while playing, so changes made on other devices show up
+        self.playing_interval = playing_interval
+        self.paused_interval = paused_interval
+        self.asleep_interval = asleep_interval
+        # the fixed interval the poll count is compared against
+        self.baseline_interval = baseline_interval
+        self.cond = threading.Condition()
+        self.next_poll = 0
+        self.follow_ups = 0
+        self.asleep = False
+        # set while player events arrive, see follow_events
+        self.check_interval = None
+        self.events_timeout = None
+        self.last_event = 0
+        self.polls = 0
+        self.started_at = time.monotonic()
+
+    # Seconds from a poll that returned now_playing to the next one
+    def interval(self, now_playing, now = None):
+        if (self.follow_ups > 0):
+            return COMMAND_DELAY * 2 ** (FOLLOW_UP_POLLS - self.follow_ups)
+        if (self.asleep):
+            return self.asleep_interval
+        if (self._following_events()):
+            return self.check_interval
+        if (not now_playing or not now_playing['is_playing']):
+            return self.paused_interval
+        remaining = (now_playing['duration'] - progress_at(now_playing, now)) / 1000
+        return max(COMMAND_DELAY, min(self.playing_interval, remaining + BOUNDARY_DELAY))
+
+    # Blocks until the next poll is due
+    def wait(self):
+        with self.cond:
+            while True:
+                delay = self.next_poll - time.monotonic()
+                if (delay <= 0):
+                    return
+                self.cond.wait(delay)
+
+    # Records a poll that returned now_playing and schedules the next one
+    def polled(self, now_playing):
+        with self.cond:
+            self.polls = self.polls + 1
+            self.next_poll = time.monotonic() + self.interval(now_playing)
+            if (self.follow_ups > 0):
+                self.follow_ups = self.follow_ups - 1
+            self.cond.notify_all()
+
+    # Called after a user command changed playback: the following polls come
+    # in quick succession, starting COMMAND_DELAY from now. While player
+    # events arrive they report the effect, and the one poll only confirms it.
+    def command(self):
+        with self.cond:
+            if (not self._following_events()):
+                self.follow_ups = FOLLOW_UP_POLLS
+            self.next_poll = min(self.next_poll, time.monotonic() + COMMAND_DELAY)
+            self.cond.notify_all()
+
+    # Polls as soon as possible, e.g. for what a player event couldn't tell
+    def poll_now(self):
+        with self.cond:
+            self.next_poll = time.monotonic()
+            self.cond.notify_all()
+
+    # Called for every event of the local player: polls are check_interval
+    # seconds apart until timeout seconds pass without another one
+    def follow_events(self, check_interval, timeout):
+        with self.cond:
+            self.check_interval = check_interval
+            self.events_timeout = timeout
+            self.last_event = time.monotonic()
+            self.cond.notify_all()
+
+    # Called when the local player's events stop telling what plays: it
+    # stopped, e.g. as playback moved to another device, or its events can't
+    # be received any more
+    def unfollow_events(self):
+        with self.cond:
+            self.check_interval = None
+            self.cond.notify_all()
+
+    def _following_events(self):
+        return self.check_interval is not None and time.monotonic() - self.last_event < self.events_timeout
+
+    def set_asleep(self, asleep):
+        with self.cond:
+            self.asleep = asleep
+            if (not asleep):
+                # the screen shows the state again, so bring it up to date
+                self.next_poll = time.monotonic()
+                self.cond.notify_all()
+
+    # Polls made against the number a fixed baseline_interval would have made
+    def stats(self):
+        with self.cond:
+            elapsed = time.monotonic() - self.started_at
+            baseline = int(elapsed / self.baseline_interval) + 1
+            return {"polls": self.polls, "baseline_polls": baseline, "seconds": round(elapsed),
+                    "saved": round(1 - self.polls / baseline, 3)}
@@ -0,0 +1,133 @@
+import sqlite3
+import threading
+import time
+import requests
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import urlparse
+
+# Disk cache of Web API GET responses, so a reboot doesn't download library
+# data that hasn't changed. Entries are keyed by the full request URL. While
+# an entry is within its endpoint family's TTL it is served without a
+# request; after that it is revalidated with If-None-Match when the response
+# carried an ETag, and a 304 costs no body. The file is kept under a byte
+# budget by evicting the least recently used entries.
+
+# (path prefix, TTL in seconds); the first match wins and paths matching none
+# aren't cached. A TTL of 0 revalidates on every use.
+TTLS = [
+    ("/v1/me/player", None),                # live playback state
+    ("/v1/browse/new-releases", 6 * 3600),
+    ("/v1/albums", 7 * 24 * 3600),          # album contents practically never change
+    ("/v1/artists", 24 * 3600),
+    ("/v1/me/following", 3600),
+    ("/v1/playlists", 0),                   # edited any time, but cheap to revalidate
+    ("/v1/me/tracks", 0),
+    ("/v1/me/albums", 0),
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY, etag TEXT, content_type TEXT, body BLOB,
+    size INTEGER, expires_at REAL, last_used REAL);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+class ResponseCache():
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.counters = {"fresh_hits": 0, "revalidated": 0, "misses": 0, "evictions": 0}
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if (conn is None):
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters[name] + 1
+
+    def ttl_for(self, url):
+        path = urlparse(url).path
+        return next((ttl for prefix, ttl in TTLS if path.startswith(prefix)), None)
+
+    # Serves a GET from the cache where it can. send(headers) performs the
+    # request with the given extra headers and returns the response.
+    def fetch(self, url, send):
+        ttl = self.ttl_for(url)
+        if (ttl is None):
+            return send({})
+        now = time.time()
+        entry = self._conn().execute("SELECT etag, content_type, body, expires_at FROM responses WHERE url = ?",
+                                     (url,)).fetchone()
+        if (entry is not None and entry[3] > now):
+            self._count("fresh_hits")
+            self._touch(url, None, now)
+            return self._response(url, entry)
+        headers = {"If-None-Match": entry[0]} if entry is not None and entry[0] else {}
+        response = send(headers)
+        if (response.status_code == 304 and entry is not None):
+            self._count("revalidated")
+            self._touch(url, now + ttl, now)
+            return self._response(url, entry)
+        self._count("misses")
+        if (response.status_code == 200):
+            self._store(url, response, now + ttl, now)
+        return response
+
+    def _response(self, url, entry):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers = CaseInsensitiveDict({"Content-Type": entry[1] or "application/json"})
+        if (entry[0]):
+            response.headers["ETag"] = entry[0]
+        response._content = bytes(entry[2])
+        response.encoding = "utf-8"
+        return response
+
+    def _touch(self, url, expires_at, now):
+        with self._conn() as conn:
+            if (expires_at is None):
+                conn.execute("UPDATE responses SET last_used = ? WHERE url = ?", (now, url))
+            else:
+                conn.execute("UPDATE responses SET last_used = ?, expires_at = ? WHERE url = ?", (now, expires_at, url))
+
+    def _store(self, url, response, expires_at, now):
+        body = response.content
+        if (len(body) > self.max_bytes):
+            return
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO responses (url, etag, content_type, body, size, expires_at, last_used)"
+                         " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (url, response.headers.get("ETag"), response.headers.get("Content-Type"), body, len(body), expires_at, now))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if (total <= self.max_bytes):
+            return
+        for url, size in conn.execute("SELECT url, size FROM responses ORDER BY last_used").fetchall():
+            conn.execute("DELETE FROM responses WHERE url = ?", (url,))
+            self._count("evictions")
+            total = total - size
+            if (total <= self.max_bytes):
+                return
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = stats["fresh_hits"] + stats["revalidated"] + stats["misses"]
+        stats["hit_rate"] = round((stats["fresh_hits"] + stats["revalidated"]) / lookups, 3) if lookups else 0
+        row = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        stats["entries"] = row[0]
+        stats["bytes"] = row[1]
+        return stats
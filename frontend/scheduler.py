@@ -0,0 +1,129 @@
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+# Admission control for Web API requests. Every request waits for a slot,
+# and slots go to the waiting request of the highest class first:
+# interactive (button presses), now playing (the poll loop), prefetch, bulk
+# (library sync). All classes draw from one token bucket, so background
+# crawls can't use up the rate limit a button press needs; a 429 pauses
+# everyone for its Retry-After. Background classes also keep one connection
+# free and hold off for a moment after each user interaction.
+#
+# A thread's class is set with priority(); it defaults to interactive, so
+# the UI thread needs nothing. Work handed to pools keeps its caller's class
+# when wrapped with bind().
+
+INTERACTIVE = 0
+NOW_PLAYING = 1
+PREFETCH = 2
+BULK = 3
+CLASS_NAMES = ["interactive", "now_playing", "prefetch", "bulk"]
+
+class RequestScheduler():
+    def __init__(self, rate, burst, max_in_flight, interactive_hold):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.interactive_hold = interactive_hold
+        self.cond = threading.Condition()
+        self.tokens = burst
+        self.refilled_at = time.monotonic()
+        self.waiting = [] # heap of (class, arrival)
+        self.arrivals = itertools.count()
+        self.in_flight = 0
+        self.paused_until = 0
+        self.held_until = 0
+        self.local = threading.local()
+        self.waits = [[0, 0.0, 0.0] for _ in CLASS_NAMES] # requests, total wait, longest wait
+
+    def current(self):
+        return getattr(self.local, 'priority', INTERACTIVE)
+
+    @contextmanager
+    def priority(self, priority):
+        previous = self.current()
+        self.local.priority = priority
+        try:
+            yield
+        finally:
+            self.local.priority = previous
+
+    # fn, run under the calling thread's class wherever it ends up running
+    def bind(self, fn):
+        priority = self.current()
+        def run(*args, **kwargs):
+            with self.priority(priority):
+                return fn(*args, **kwargs)
+        return run
+
+    # Called on user input: background requests wait until it has settled
+    def interact(self):
+        with self.cond:
+            self.held_until = time.monotonic() + self.interactive_hold
+            self.cond.notify_all()
+
+    # Called on a 429: nothing is sent until the server's Retry-After passed
+    def pause(self, seconds):
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    # 0 when entry may go now, otherwise how long to wait (None: until notified)
+    def _delay(self, entry):
+        now = time.monotonic()
+        self._refill(now)
+        if (self.waiting[0] != entry):
+            return None
+        if (now < self.paused_until):
+            return self.paused_until - now
+        if (entry[0] >= PREFETCH):
+            if (now < self.held_until):
+                return self.held_until - now
+            if (self.in_flight >= self.max_in_flight - 1):
+                return None
+        elif (self.in_flight >= self.max_in_flight):
+            return None
+        if (self.tokens < 1):
+            return (1 - self.tokens) / self.rate
+        return 0
+
+    @contextmanager
+    def slot(self):
+        priority = self.current()
+        start = time.monotonic()
+        with self.cond:
+            entry = (priority, next(self.arrivals))
+            heapq.heappush(self.waiting, entry)
+            while True:
+                delay = self._delay(entry)
+                if (delay == 0):
+                    break
+                self.cond.wait(delay)
+            heapq.heappop(self.waiting)
+            self.tokens = self.tokens - 1
+            self.in_flight = self.in_flight + 1
+            wait = time.monotonic() - start
+            waits = self.waits[priority]
+            waits[0] = waits[0] + 1
+            waits[1] = waits[1] + wait
+            waits[2] = max(waits[2], wait)
+            self.cond.notify_all()
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.in_flight = self.in_flight - 1
+                self.cond.notify_all()
+
+    # Queue wait per class: requests, average and longest wait in ms
+    def stats(self):
+        with self.cond:
+            return {name: {"requests": count, "avg_wait_ms": round(total / count * 1000, 1) if count else 0,
+                           "max_wait_ms": round(longest * 1000, 1)}
+                    for name, (count, total, longest) in zip(CLASS_NAMES, self.waits)}
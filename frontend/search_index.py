@@ -0,0 +1,134 @@
+import re
+import unicodedata
+from array import array
+from bisect import bisect_left
+
+# In-memory search index over the library in the datastore, so search can
+# answer from what is already synced, instantly and without a connection.
+#
+# Titles and names are normalized (case and accents folded, punctuation
+# dropped) and split into words. Each word maps to the ascending ids of the
+# records containing it; the words are also kept sorted, so every word
+# starting with a prefix is one bisect range. A query matches the records
+# that have, for each of its words, some word starting with it.
+#
+# The index doesn't hold the records themselves, only where to read them:
+# the position of a saved track or artist, the uri of an album or playlist.
+# Matches are read back from the datastore (see resolve) and checked against
+# the query again, so a position a sync moved since the index was built
+# drops out instead of showing another record.
+
+TRACK = "track"
+ARTIST = "artist"
+ALBUM = "album"
+PLAYLIST = "playlist"
+KINDS = [TRACK, ARTIST, ALBUM, PLAYLIST]
+
+# The texts a record of each kind is found by
+TEXTS = {
+    TRACK: lambda track: (track.title, track.artist, track.album),
+    ARTIST: lambda artist: (artist.name,),
+    ALBUM: lambda album: (album.name, album.artist),
+    PLAYLIST: lambda playlist: (playlist.name,),
+}
+# Datastore getters reading a record of each kind back, by position for the
+# saved tracks and artists and by uri for albums and playlists
+READERS = {TRACK: "getSavedTrack", ARTIST: "getArtist", ALBUM: "getAlbumUri", PLAYLIST: "getPlaylistUri"}
+
+NON_WORD = re.compile(r'[\W_]+')
+# sorts after every word, so [prefix, prefix + LAST) spans the words starting with prefix
+LAST = chr(0x10FFFF)
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', str(text).lower())
+    return NON_WORD.sub(' ', "".join(char for char in text if not unicodedata.combining(char)))
+
+def words(text):
+    return normalize(text).split()
+
+def matches(words, prefixes):
+    return all(any(word.startswith(prefix) for word in words) for prefix in prefixes)
+
+class SearchIndex():
+    def __init__(self, revision = None):
+        # the Datastore revision the index was built from
+        self.revision = revision
+        self.kinds = array('B') # index into KINDS per record id
+        self.keys = array('I') # position, or index into self.uris, per record id
+        self.uris = []
+        self.postings = {} # word -> ascending record ids
+        self.words = []
+
+    # Adds the record at key (a position or a uri) of kind
+    def add(self, kind, key, *texts):
+        id = len(self.kinds)
+        if (isinstance(key, str)):
+            self.uris.append(key)
+            key = len(self.uris) - 1
+        self.kinds.append(KINDS.index(kind))
+        self.keys.append(key)
+        for word in set(words(" ".join(texts))):
+            postings = self.postings.get(word)
+            if (postings is None):
+                postings = self.postings[word] = array('I')
+            postings.append(id)
+
+    # Called once everything is added, before the first search
+    def finish(self):
+        self.words = sorted(self.postings)
+        return self
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def _matches(self, prefix):
+        ids = set()
+        for word in self.words[bisect_left(self.words, prefix):bisect_left(self.words, prefix + LAST)]:
+            ids.update(self.postings[word])
+        return ids
+
+    # Records matching query as {kind: records}, at most limit of each kind,
+    # in the order they were added (library order); resolve(kind, key) reads
+    # a record back, None if it's gone
+    def search(self, query, limit, resolve):
+        found = {kind: [] for kind in KINDS}
+        prefixes = set(words(query))
+        ids = None
+        # longer words match fewer records, so the set shrinks quickly
+        for prefix in sorted(prefixes, key=len, reverse=True):
+            ids = self._matches(prefix) if ids is None else ids & self._matches(prefix)
+            if (len(ids) == 0):
+                return found
+        for id in sorted(ids or []):
+            kind = KINDS[self.kinds[id]]
+            records = found[kind]
+            if (len(records) >= limit):
+                continue
+            key = self.keys[id] if kind in (TRACK, ARTIST) else self.uris[self.keys[id]]
+            record = resolve(kind, key)
+            if (record is not None and matches(words(" ".join(TEXTS[kind](record))), prefixes)):
+                records.append(record)
+        return found
+
+# Reads the record at key of kind back from store
+def resolve(store, kind, key):
+    return getattr(store, READERS[kind])(key)
+
+# Index over a datastore's saved tracks, followed artists, saved albums and
+# playlists, as of its current revision
+def build(store):
+    index = SearchIndex(store.revision)
+    track_count = store.getSavedTrackCount()
+    for start in range(0, track_count, 1000):
+        for position, track in enumerate(store.getSavedTracks(start, min(1000, track_count - start)), start):
+            if (track is not None):
+                index.add(TRACK, position, *TEXTS[TRACK](track))
+    artist_count = store.getArtistCount()
+    for position, artist in enumerate(store.getArtists(0, artist_count) if artist_count > 0 else []):
+        if (artist is not None):
+            index.add(ARTIST, position, *TEXTS[ARTIST](artist))
+    for album in store.getAllSavedAlbums():
+        index.add(ALBUM, album.uri, *TEXTS[ALBUM](album))
+    for playlist in sorted(store.getAllSavedPlaylists(), key=lambda playlist: playlist.idx):
+        index.add(PLAYLIST, playlist.uri, *TEXTS[PLAYLIST](playlist))
+    return index.finish()
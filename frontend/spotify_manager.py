@@ -1,67 +1,28 @@
 import spotipy
+import requests
 import datastore
+import api_stats
+import http_session
+import response_cache
+import scheduler
+import search_index
+import poller
+import player_events
+import commands
+import playback_state
+from models import *
+from config import LIBRARY_FULL_REFRESH, REFRESH_WORKERS, PAGE_FETCH_WORKERS, API_FIELD_FILTERS, LOG_API_STATS, \
+    PLAYLIST_PREFETCH, PLAYLIST_PREFETCH_DELAY, HTTP_MAX_RETRIES, HTTP_CACHE_PATH, HTTP_CACHE_MAX_BYTES, \
+    API_REQUESTS_PER_SECOND, API_MAX_IN_FLIGHT, API_INTERACTIVE_HOLD, NOW_PLAYING_POLL_INTERVAL, \
+    NOW_PLAYING_PAUSED_POLL_INTERVAL, NOW_PLAYING_ASLEEP_POLL_INTERVAL, PLAYER_EVENTS_SOCKET, PLAYER_EVENTS_POLL_INTERVAL, \
+    PLAYER_EVENTS_TIMEOUT
 from spotipy.oauth2 import SpotifyOAuth
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import threading
 import time
 import json
 
-class UserDevice():
-    __slots__ = ['id', 'name', 'is_active']
-    def __init__(self, id, name, is_active):
-        self.id = id
-        self.name = name
-        self.is_active = is_active
-
-class UserTrack():
-    __slots__ = ['title', 'artist', 'album', 'uri']
-    def __init__(self, title, artist, album, uri):
-        self.title = title
-        self.artist = artist
-        self.album = album
-        self.uri = uri
-
-    def __str__(self):
-        return self.title + " - " + self.artist + " - " + self.album
-
-class UserAlbum():
-    __slots__ = ['name', 'artist', 'track_count', 'uri']
-    def __init__(self, name, artist, track_count, uri):
-        self.name = name
-        self.artist = artist
-        self.uri = uri
-        self.track_count = track_count
-
-    def __str__(self):
-        return self.name + " - " + self.artist
-
-class UserArtist():
-    __slots__ = ['name', 'uri']
-    def __init__(self, name, uri):
-        self.name = name
-        self.uri = uri
-
-    def __str__(self):
-        return self.name
-
-class UserPlaylist():
-    __slots__ = ['name', 'idx', 'uri', 'track_count']
-    def __init__(self, name, idx, uri, track_count):
-        self.name = name
-        self.idx = idx
-        self.uri = uri
-        self.track_count = track_count
-
-    def __str__(self):
-        return self.name
-
-class SearchResults():
-    __slots__ = ['tracks', 'artists', 'albums', 'album_track_map']
-    def __init__(self, tracks, artists, albums, album_track_map):
-        self.tracks = tracks
-        self.artists = artists
-        self.albums = albums
-        self.album_track_map = album_track_map
-
 scope = "user-follow-read," \
         "user-library-read," \
         "user-library-modify," \
@@ -77,24 +38,102 @@ scope = "user-follow-read," \
 
 DATASTORE = datastore.Datastore()
 
-sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scope))
+SCHEDULER = scheduler.RequestScheduler(rate=API_REQUESTS_PER_SECOND, burst=API_REQUESTS_PER_SECOND,
+                                       max_in_flight=API_MAX_IN_FLIGHT, interactive_hold=API_INTERACTIVE_HOLD)
+# Enough connections for every sync phase, the page fetches of each refresh
+# worker, the poll loop and a UI command at once
+HTTP_SESSION = http_session.ManagedSession(pool_size=6 + REFRESH_WORKERS * PAGE_FETCH_WORKERS + 2,
+                                           max_retries=HTTP_MAX_RETRIES,
+                                           response_cache=response_cache.ResponseCache(HTTP_CACHE_PATH, HTTP_CACHE_MAX_BYTES)
+                                           if HTTP_CACHE_PATH else None,
+                                           scheduler=SCHEDULER)
+sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scope), requests_session=HTTP_SESSION)
 pageSize = 50
+ALBUM_BATCH_SIZE = 20 # the most ids the several albums endpoint takes
+SEARCH_LIMIT = 5 # results per type
 has_internet = False
 
+API_STATS = api_stats.ApiStats()
+SEARCH_STATS = api_stats.LatencyStats()
+# built for the library's current revision when first needed, see library_index
+LIBRARY_INDEX = search_index.SearchIndex().finish()
+LIBRARY_INDEX_LOCK = threading.Lock()
+# User commands run in order on a worker each, playback apart from searches so
+# a slow search never holds back a skip; submitting one holds background
+# traffic back for a moment
+PLAYBACK_COMMANDS = commands.CommandExecutor("playback", on_submit=SCHEDULER.interact,
+                                             on_error=lambda command, error: playback_failed(command))
+SEARCH_COMMANDS = commands.CommandExecutor("search", on_submit=SCHEDULER.interact)
+if (LOG_API_STATS):
+    API_STATS.install(sp._session)
+
+# Only what UserTrack, UserPlaylist and UserAlbum keep. Endpoints without a
+# fields parameter get a market instead, which drops the available_markets
+# lists that make up much of every track and album object.
+TRACK_FIELDS = "name,uri,artists(name),album(name)"
+PLAYLIST_TRACKS_FIELDS = "items(track(" + TRACK_FIELDS + ")),total,offset,limit,next"
+PLAYLIST_FIELDS = "name,uri,tracks(" + PLAYLIST_TRACKS_FIELDS + ")"
+MARKET = "from_token"
+
+def fields(value):
+    return value if API_FIELD_FILTERS else None
+
+def market():
+    return MARKET if API_FIELD_FILTERS else None
+
 def check_internet(request):
     global has_internet
     try:
         result = request()
         has_internet = True
-    except Exception as _:
-        print("no ints")
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        print("no ints: " + type(e).__name__)
+        result = None
+        has_internet = False
+    except spotipy.SpotifyException as e:
+        # the API answered, so the connection is fine
+        print("Web API error " + str(e.http_status) + ": " + str(e.msg))
+        result = None
+        has_internet = True
+    except Exception as e:
+        print("no ints: " + repr(e))
         result = None
         has_internet = False
     return result
 
+# Pages of an offset paged endpoint, in order; request(offset, limit) fetches
+# one. The first page's total gives every remaining offset, so the rest are
+# fetched up to PAGE_FETCH_WORKERS at a time ahead of the caller. Nothing past
+# the first page is requested before the caller asks for the second, and
+# pages still pending when the caller stops early are cancelled.
+def iter_pages(request, limit = pageSize):
+    first = request(0, limit)
+    yield first
+    offsets = range(limit, first['total'], limit)
+    if (len(offsets) == 0):
+        return
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=PAGE_FETCH_WORKERS, thread_name_prefix="page-fetch") as pool:
+        try:
+            for offset in offsets:
+                pending.append(pool.submit(SCHEDULER.bind(request), offset, limit))
+                if (len(pending) >= PAGE_FETCH_WORKERS):
+                    yield pending.popleft().result()
+            while (pending):
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+# All items of an offset paged endpoint, in order
+def fetch_all_items(request, limit = pageSize):
+    items = []
+    for page in iter_pages(request, limit):
+        items.extend(page['items'])
+    return items
+
 def get_playlist(id):
-    # TODO optimize query
-    results = sp.playlist(id)
+    results = sp.playlist(id, fields=fields(PLAYLIST_FIELDS), market=market())
     tracks = []
     for _, item in enumerate(results['tracks']['items']):
         track = item['track']
@@ -102,49 +141,34 @@ def get_playlist(id):
     return (UserPlaylist(results['name'], 0, results['uri'], len(tracks)), tracks) # return playlist index as 0 because it won't have a idx parameter when fetching directly from Spotify (and we don't need it here anyway)
 
 def get_album(id):
-    # TODO optimize query
-    results = sp.album(id)
-    album = results['name']
-    artist = results['artists'][0]['name']
-    tracks = []
-    for _, item in enumerate(results['tracks']['items']):
-        tracks.append(UserTrack(item['name'], artist, album, item['uri']))
-    return (UserAlbum(results['name'], artist, len(tracks), results['uri']), tracks)
+    return parse_album(sp.album(id, market=market()))
+
+# Full album objects for ids, in order, ALBUM_BATCH_SIZE per request; pool
+# fetches the batches concurrently
+def get_albums(ids, pool = None):
+    batches = [ids[start:start + ALBUM_BATCH_SIZE] for start in range(0, len(ids), ALBUM_BATCH_SIZE)]
+    fetch = lambda batch: sp.albums(batch, market=market())['albums']
+    results = pool.map(SCHEDULER.bind(fetch), batches) if pool else map(fetch, batches)
+    return [album for result in results for album in result]
 
 def get_playlist_tracks(id):
-    tracks = []
-    results = sp.playlist_tracks(id, limit=pageSize)
-    while(results['next']):
-        for _, item in enumerate(results['items']):
-            track = item['track']
-            tracks.append(UserTrack(track['name'], track['artists'][0]['name'], track['album']['name'], track['uri']))
-        results = sp.next(results)
-    for _, item in enumerate(results['items']):
-        track = item['track']
-        tracks.append(UserTrack(track['name'], track['artists'][0]['name'], track['album']['name'], track['uri']))
-    return tracks
+    items = fetch_all_items(lambda offset, limit: sp.playlist_tracks(id, fields=fields(PLAYLIST_TRACKS_FIELDS), limit=limit, offset=offset, market=market()))
+    return [parse_track(item['track']) for item in items]
 
-def get_album_tracks(id):
-    tracks = []
-    results = sp.playlist_tracks(id, limit=pageSize)
-    while(results['next']):
-        for _, item in enumerate(results['items']):
-            track = item['track']
-            tracks.append(UserTrack(track['name'], track['artists'][0]['name'], track['album']['name'], track['uri']))
-        results = sp.next(results)
-    for _, item in enumerate(results['items']):
-        track = item['track']
-        tracks.append(UserTrack(track['name'], track['artists'][0]['name'], track['album']['name'], track['uri']))
-    return tracks
+# Album track objects carry no album, so its name and artist are passed in
+def get_album_tracks(id, artist, album_name):
+    items = fetch_all_items(lambda offset, limit: sp.album_tracks(id, limit=limit, offset=offset, market=market()))
+    return [UserTrack(item['name'], artist, album_name, item['uri']) for item in items]
 
 def refresh_devices(out_queue = None):
     results = sp.devices()
     DATASTORE.clearDevices()
+    devices = []
     for _, item in enumerate(results['devices']):
         if "Spotifypod" in item['name']:
             print(item['name'])
-            device = UserDevice(item['id'], item['name'], item['is_active'])
-            DATASTORE.setUserDevice(device)
+            devices.append(UserDevice(item['id'], item['name'], item['is_active']))
+    DATASTORE.setUserDevices(devices)
     if(out_queue is not None) :
         out_queue.put(True)
 
@@ -153,89 +177,290 @@ def parse_album(album):
     tracks = []
     if 'tracks' not in album :
         return get_album(album['id'])
+    if album['tracks']['next']:
+        # longer than the first page of tracks embedded in the album
+        return (UserAlbum(album['name'], artist, album['tracks']['total'], album['uri']),
+                get_album_tracks(album['id'], artist, album['name']))
     for _, track in enumerate(album['tracks']['items']):
         tracks.append(UserTrack(track['name'], artist, album['name'], track['uri']))
     return (UserAlbum(album['name'], artist, len(tracks), album['uri']), tracks)
 
-def refresh_data(out_queue):
-    DATASTORE.clear()
-    results = sp.current_user_saved_tracks(limit=pageSize, offset=0)
-    while(results['next']):
-        offset = results['offset']
-        for idx, item in enumerate(results['items']):
-            track = item['track']
-            DATASTORE.setSavedTrack(idx + offset, UserTrack(track['name'], track['artists'][0]['name'], track['album']['name'], track['uri']))
-        results = sp.next(results)
-
-    offset = results['offset']
-    for idx, item in enumerate(results['items']):
-        track = item['track']
-        DATASTORE.setSavedTrack(idx + offset, UserTrack(track['name'], track['artists'][0]['name'], track['album']['name'], track['uri']))
-
-    print("Spotify tracks fetched")
-
-    offset = 0
+# parse_album over a list of albums; the ones listed without their tracks
+# (new releases, search results) are fetched together with get_albums
+# instead of one request each
+def parse_albums(albums, pool = None):
+    missing = [album['id'] for album in albums if 'tracks' not in album]
+    full = dict(zip(missing, get_albums(missing, pool)))
+    return [parse_album(full.get(album['id']) or album) for album in albums]
+
+def parse_track(track):
+    return UserTrack(track['name'], track['artists'][0]['name'], track['album']['name'], track['uri'])
+
+def watermark_of(item, uri):
+    return item['added_at'] + " " + uri
+
+def is_past_watermark(item, uri, watermark):
+    added_at, watermark_uri = watermark.split(" ", 1)
+    return item['added_at'] < added_at or (item['added_at'] == added_at and uri == watermark_uri)
+
+# Walks a newest-first saved items endpoint until it reaches the item recorded
+# in the watermark. Returns (items, is_delta): with is_delta the items are the
+# ones added since, otherwise they are the complete list. The latter happens
+# on a first sync, or when the counts show something older was removed, in
+# which case paging carries on to the end.
+def fetch_added_since(request, watermark, known_count, get_uri):
+    items = []
+    reached = watermark is None
+    for results in iter_pages(request):
+        for _, item in enumerate(results['items']):
+            if (not reached and is_past_watermark(item, get_uri(item), watermark)):
+                reached = True
+                if (known_count + len(items) == results['total']):
+                    return (items, True)
+            items.append(item)
+    return (items, False)
+
+def sync_saved_tracks(store):
+    watermark = store.getSyncState("saved-tracks")
+    get_uri = lambda item: item['track']['uri']
+    request = lambda offset, limit: sp.current_user_saved_tracks(limit=limit, offset=offset, market=market())
+    items, is_delta = fetch_added_since(request, watermark, store.getSavedTrackCount(), get_uri)
+    tracks = [parse_track(item['track']) for item in items]
+    if is_delta:
+        store.prependSavedTracks(tracks)
+    else:
+        for start in range(0, len(tracks), pageSize):
+            store.setSavedTracks(start, tracks[start:start + pageSize])
+        store.trimSavedTracks(len(tracks))
+    if (len(items) > 0):
+        store.setSyncState("saved-tracks", watermark_of(items[0], get_uri(items[0])))
+    print("Spotify tracks fetched: " + str(len(tracks)) + (" new" if is_delta else ""))
+
+def sync_artists(store):
+    # cursor paged, so pages can only be fetched one after the other
     results = sp.current_user_followed_artists(limit=pageSize)
     artistList = []
     while(results['artists']['next']):
-        for idx, item in enumerate(results['artists']['items']):
-            artistList.append({'id': idx + offset, 'artist' : UserArtist(item['name'], item['uri'])})
+        for _, item in enumerate(results['artists']['items']):
+            artistList.append(UserArtist(item['name'], item['uri']))
         results = sp.next(results['artists'])
-        offset = offset + pageSize
 
-    for idx, item in enumerate(results['artists']['items']):
-            artistList.append({'id': idx + offset, 'artist' : UserArtist(item['name'], item['uri'])})
+    for _, item in enumerate(results['artists']['items']):
+        artistList.append(UserArtist(item['name'], item['uri']))
 #   Once all pages fetched sort them
-    artistList.sort(key=lambda h: h['artist'].name)
+    artistList.sort(key=lambda artist: artist.name)
 #   Insert them in DB in the right order
-    for idx, item in enumerate(artistList) :
-        DATASTORE.setArtist(idx, item['artist'])
-
-    print("Spotify artists fetched: " + str(DATASTORE.getArtistCount()))
-
-    results = sp.current_user_playlists(limit=pageSize)
+    store.setArtists(0, artistList)
+    store.trimArtists(len(artistList))
+
+    print("Spotify artists fetched: " + str(store.getArtistCount()))
+
+# Only playlist metadata is synced; track lists are loaded when a playlist is
+# opened or by the prefetcher (see PlaylistLoader). Stored track lists of
+# playlists whose snapshot_id changed are dropped, to be loaded again.
+def sync_playlists(store):
+    snapshots = store.getPlaylistSnapshots()
+    new_snapshots = {}
+    changed = 0
     totalindex = 0 # variable to preserve playlist sort index when calling offset loop down below
-    while(results['next']):
-        offset = results['offset']
-        for idx, item in enumerate(results['items']):
-            tracks = get_playlist_tracks(item['id'])
-            DATASTORE.setPlaylist(UserPlaylist(item['name'], totalindex, item['uri'], len(tracks)), tracks, index=idx + offset)
+    for results in iter_pages(lambda offset, limit: sp.current_user_playlists(limit=limit, offset=offset)):
+        playlists = []
+        stale = []
+        for _, item in enumerate(results['items']):
+            if (snapshots.get(item['id']) != item['snapshot_id']):
+                stale.append(item['uri'])
+            playlists.append((UserPlaylist(item['name'], totalindex, item['uri'], item['tracks']['total']), None))
+            new_snapshots[item['id']] = item['snapshot_id']
             totalindex = totalindex + 1
-        results = sp.next(results)
-
-    offset = results['offset']
-    for idx, item in enumerate(results['items']):
-        tracks = get_playlist_tracks(item['id'])
-        DATASTORE.setPlaylist(UserPlaylist(item['name'], totalindex, item['uri'], len(tracks)), tracks, index=idx + offset)
-        totalindex = totalindex + 1
-
-    print("Spotify playlists fetched: " + str(DATASTORE.getPlaylistCount()))
-
-    results = sp.current_user_saved_albums(limit=pageSize)
-    while(results['next']):
-        offset = results['offset']
-        for idx, item in enumerate(results['items']):
-            album, tracks = parse_album(item['album'])
-            DATASTORE.setAlbum(album, tracks, index=idx + offset)
-        results = sp.next(results)
-
-    offset = results['offset']
-    for idx, item in enumerate(results['items']):
-        album, tracks = parse_album(item['album'])
-        DATASTORE.setAlbum(album, tracks, index=idx + offset)
+        store.setPlaylists(results['offset'], playlists)
+        store.clearPlaylistTracks(stale)
+        changed = changed + len(stale)
+    store.trimPlaylists(totalindex)
+    store.setPlaylistSnapshots(new_snapshots)
+
+    print("Spotify playlists fetched: " + str(store.getPlaylistCount()) + ", changed " + str(changed))
+
+def sync_saved_albums(store, pool):
+    watermark = store.getSyncState("saved-albums")
+    get_uri = lambda item: item['album']['uri']
+    request = lambda offset, limit: sp.current_user_saved_albums(limit=limit, offset=offset, market=market())
+    items, is_delta = fetch_added_since(request, watermark, store.getAlbumCount(), get_uri)
+    albums = parse_albums([item['album'] for item in items], pool)
+    if is_delta:
+        store.prependAlbums(albums)
+    else:
+        for start in range(0, len(albums), pageSize):
+            store.setAlbums(start, albums[start:start + pageSize])
+        store.trimAlbums(len(albums))
+    if (len(items) > 0):
+        store.setSyncState("saved-albums", watermark_of(items[0], get_uri(items[0])))
 
-    print("Refreshed user albums")
+    print("Refreshed user albums: " + str(len(albums)) + (" new" if is_delta else ""))
 
+def sync_new_releases(store, pool):
     results = sp.new_releases(limit=pageSize)
-    for idx, item in enumerate(results['albums']['items']):
-        album, tracks = parse_album(item)
-        DATASTORE.setNewRelease(album, tracks, index=idx)
+    items = results['albums']['items']
+    # releases already stored with their tracks only get the entry itself refreshed
+    known = [store.hasNewRelease(item['uri']) for item in items]
+    parsed = iter(parse_albums([item for item, is_known in zip(items, known) if not is_known], pool))
+    albums = [(UserAlbum(item['name'], item['artists'][0]['name'], item['total_tracks'], item['uri']), None)
+              if is_known else next(parsed) for item, is_known in zip(items, known)]
+    store.setNewReleases(0, albums)
+    store.trimNewReleases(len(albums))
 
     print("Refreshed new releases")
 
-    refresh_devices()
-    print("Refreshed devices")
-    out_queue.put(True)
+def timed_phase(name, sync, *args):
+    start = time.time()
+    sync(*args)
+    return name + " " + str(round(time.time() - start, 1)) + "s"
+
+# Syncs the library into the datastore. Unless full is set (or nothing was
+# synced yet) this only fetches what changed since the last sync. A full
+# refresh is built in a new generation while the UI keeps reading the current
+# one, and the UI is let in straight away whenever a synced library exists.
+#
+# The phases don't depend on each other and run side by side, each writing
+# its results as they arrive; the album batch fetches inside them share a
+# pool of REFRESH_WORKERS threads. Phases never wait on a worker of their own pool,
+# so a full pool can't deadlock them. All of it is bulk traffic for the
+# request scheduler, behind anything the user is waiting for.
+def refresh_data(out_queue, full = LIBRARY_FULL_REFRESH):
+    with SCHEDULER.priority(scheduler.BULK):
+        sync_library(out_queue, full)
+
+def sync_library(out_queue, full):
+    DATASTORE.collectGenerations()
+    has_library = DATASTORE.getSyncState("synced-at") is not None
+    if (has_library):
+        out_queue.put(True)
+    store = DATASTORE.beginGeneration() if full or not has_library else DATASTORE
+    if (store is not DATASTORE):
+        store.setSyncState("recent-playlists", DATASTORE.getSyncState("recent-playlists") or "[]")
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix="refresh-fetch") as pool:
+        phases = [
+            ("saved tracks", sync_saved_tracks, store),
+            ("artists", sync_artists, store),
+            ("playlists", sync_playlists, store),
+            ("albums", sync_saved_albums, store, pool),
+            ("new releases", sync_new_releases, store, pool),
+            ("devices", refresh_devices),
+        ]
+        with ThreadPoolExecutor(max_workers=len(phases), thread_name_prefix="refresh-phase") as runner:
+            timings = [future.result() for future in [runner.submit(SCHEDULER.bind(timed_phase), *phase) for phase in phases]]
+    store.setSyncState("synced-at", time.time())
+    DATASTORE.publishGeneration(store)
+    library_index()
+    print("Library synced in " + str(round(time.time() - start, 1)) + "s (" + ", ".join(timings) + ")")
+    print("Datastore cache: " + json.dumps(DATASTORE.getCacheStats()))
+    print("HTTP: " + json.dumps(HTTP_SESSION.stats()))
+    if (LOG_API_STATS):
+        print(API_STATS.report())
+
+    if (not has_library):
+        out_queue.put(True)
+    if (PLAYLIST_PREFETCH):
+        PLAYLIST_LOADER.start_prefetch()
+
+# The local search index of the published library, rebuilt only once the
+# library's revision changed since the last build. Searches before the first
+# sync (or without a connection) build it from the library stored last time.
+def library_index():
+    global LIBRARY_INDEX
+    with LIBRARY_INDEX_LOCK:
+        if (LIBRARY_INDEX.revision != DATASTORE.revision):
+            start = time.time()
+            LIBRARY_INDEX = search_index.build(DATASTORE)
+            print("Search index: " + str(len(LIBRARY_INDEX)) + " entries in " + str(round(time.time() - start, 1)) + "s")
+        return LIBRARY_INDEX
+
+# Loads playlist track lists, which library syncs leave out. A playlist opened
+# in the UI is fetched straight away on a thread of its own; the prefetcher
+# fills in the rest one playlist at a time, most recently opened first, and
+# holds back while any of those on-demand loads runs.
+class PlaylistLoader():
+    RECENT_COUNT = 20
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loading = set()
+        self.prefetching = False
+
+    # Starts loading the playlist's tracks unless they're stored or already
+    # on their way; True once they're stored
+    def request(self, uri):
+        if (DATASTORE.hasPlaylistTracks(uri)):
+            return True
+        if (self._claim(uri)):
+            # loads the poll thread starts (see set_context_position) keep its
+            # class; only a user opening the playlist holds the rest back
+            if (SCHEDULER.current() == scheduler.INTERACTIVE):
+                SCHEDULER.interact()
+            threading.Thread(target=SCHEDULER.bind(self._load), args=(uri,)).start()
+        return False
+
+    def _claim(self, uri):
+        with self.lock:
+            if (uri in self.loading):
+                return False
+            self.loading.add(uri)
+            return True
+
+    def _load(self, uri):
+        try:
+            DATASTORE.setPlaylistTracks(uri, get_playlist_tracks(uri.split(":")[-1]))
+        except Exception as e:
+            print("Failed to load playlist " + uri + ": " + str(e))
+        finally:
+            with self.lock:
+                self.loading.discard(uri)
+
+    # Ids of the playlists opened last, most recent first
+    def recent(self):
+        value = DATASTORE.getSyncState("recent-playlists")
+        # lists stored before held uris
+        return [entry.split(":")[-1] for entry in json.loads(value)] if value else []
+
+    # Called each time the user opens a playlist; moves it to the front of
+    # the recently used ones
+    def mark_used(self, uri):
+        id = uri.split(":")[-1]
+        recent = self.recent()
+        if (recent[:1] == [id]):
+            return
+        recent = [id] + [other for other in recent if other != id]
+        DATASTORE.setSyncState("recent-playlists", json.dumps(recent[:self.RECENT_COUNT]))
+
+    def start_prefetch(self):
+        with self.lock:
+            if (self.prefetching):
+                return
+            self.prefetching = True
+        thread = threading.Thread(target=self._prefetch, args=())
+        thread.daemon = True
+        thread.start()
+
+    def _prefetch(self):
+        with SCHEDULER.priority(scheduler.PREFETCH):
+            self._prefetch_all()
+
+    def _prefetch_all(self):
+        try:
+            playlists = [playlist.uri for playlist in sorted(DATASTORE.getAllSavedPlaylists(), key=lambda playlist: playlist.idx)]
+            rank = {id: i for i, id in enumerate(self.recent())}
+            recent = sorted([uri for uri in playlists if uri.split(":")[-1] in rank], key=lambda uri: rank[uri.split(":")[-1]])
+            for uri in recent + [uri for uri in playlists if uri not in recent]:
+                while (len(self.loading) > 0):
+                    time.sleep(PLAYLIST_PREFETCH_DELAY)
+                if (DATASTORE.hasPlaylistTracks(uri) or not self._claim(uri)):
+                    continue
+                self._load(uri)
+                time.sleep(PLAYLIST_PREFETCH_DELAY)
+        finally:
+            self.prefetching = False
+
+PLAYLIST_LOADER = PlaylistLoader()
 
 def play_artist(artist_uri, device_id = None):
     if (not device_id):
@@ -245,7 +470,7 @@ def play_artist(artist_uri, device_id = None):
             return
         device_id = devices[0].id
     response = sp.start_playback(device_id=device_id, context_uri=artist_uri)
-    refresh_now_playing()
+    NOW_PLAYING_POLLER.command()
     print(response)
 
 def play_track(track_uri, device_id = None):
@@ -256,6 +481,7 @@ def play_track(track_uri, device_id = None):
             return
         device_id = devices[0].id
     sp.start_playback(device_id=device_id, uris=[track_uri])
+    NOW_PLAYING_POLLER.command()
 
 def play_from_playlist(playist_uri, track_uri, device_id = None):
     print("playing ", playist_uri, track_uri)
@@ -266,10 +492,10 @@ def play_from_playlist(playist_uri, track_uri, device_id = None):
             return
         device_id = devices[0].id
     sp.start_playback(device_id=device_id, context_uri=playist_uri, offset={"uri": track_uri})
-    refresh_now_playing()
+    NOW_PLAYING_POLLER.command()
 
 def get_now_playing():
-    response = check_internet(lambda: sp.current_playback())
+    response = check_internet(lambda: sp.current_playback(market=market()))
     if (not response or not response['item']):
         return None
     context = response['context']
@@ -293,92 +519,207 @@ def get_now_playing():
     if (context['type'] == 'playlist'):
         uri = context['uri']
         playlist = DATASTORE.getPlaylistUri(uri)
-        tracks = DATASTORE.getPlaylistTracks(uri)
         if (not playlist):
             playlist, tracks = get_playlist(uri.split(":")[-1])
             DATASTORE.setPlaylist(playlist, tracks)
-        now_playing['track_index'] = next(x for x, val in enumerate(tracks)
-                                  if val.uri == track_uri) + 1
-        now_playing['track_total'] = len(tracks)
+        set_context_position(now_playing, uri, track_uri)
         now_playing['context_name'] = playlist.name
     elif (context['type'] == 'album'):
         uri = context['uri']
         album = DATASTORE.getAlbumUri(uri)
-        tracks = DATASTORE.getPlaylistTracks(uri)
         if (not album):
             album, tracks = get_album(uri.split(":")[-1])
             DATASTORE.setAlbum(album, tracks)
-        now_playing['track_index'] = next(x for x, val in enumerate(tracks)
-                                  if val.uri == track_uri) + 1
-        now_playing['track_total'] = len(tracks)
+        set_context_position(now_playing, uri, track_uri)
         now_playing['context_name'] = album.name
     return now_playing
 
+# "N of M" from the position index stored with the context's track list
+def set_context_position(now_playing, context_uri, track_uri):
+    now_playing['context_uri'] = context_uri
+    position = DATASTORE.getPlaylistTrackPosition(context_uri, track_uri)
+    if (position is None):
+        if (context_uri.startswith("spotify:playlist:")):
+            PLAYLIST_LOADER.request(context_uri)
+        return
+    now_playing['track_index'] = position + 1
+    now_playing['track_total'] = DATASTORE.getPlaylistTrackCount(context_uri)
+
+# Repeated searches (and going back to one) are answered from the search
+# cache; the rest take one search request for all three types, plus one for
+# the album tracks
 def search(query):
-    track_results = sp.search(query, limit=5, type='track')
+    start = time.perf_counter()
+    results = DATASTORE.getSearchResults(query)
+    cached = results is not None
+    if (not cached):
+        results = fetch_search(query)
+        DATASTORE.setSearchResults(query, results)
+    elapsed = time.perf_counter() - start
+    SEARCH_STATS.record(elapsed, "cached" if cached else "fetched")
+    if (LOG_API_STATS):
+        print("Search %r: %.0f ms%s" % (query, elapsed * 1000, " (cached)" if cached else ""))
+    return results
+
+def fetch_search(query):
+    results = sp.search(query, limit=SEARCH_LIMIT, type='track,artist,album', market=market())
     tracks = []
-    for _, item in enumerate(track_results['tracks']['items']):
+    for _, item in enumerate(results['tracks']['items']):
         tracks.append(UserTrack(item['name'], item['artists'][0]['name'], item['album']['name'], item['uri']))
-    artist_results = sp.search(query, limit=5, type='artist')
     artists = []
-    for _, item in enumerate(artist_results['artists']['items']):
+    for _, item in enumerate(results['artists']['items']):
         artists.append(UserArtist(item['name'], item['uri']))
-    album_results = sp.search(query, limit=5, type='album')
     albums = []
     album_track_map = {}
-    for _, item in enumerate(album_results['albums']['items']):
-        album, album_tracks = parse_album(item)
+    for album, album_tracks in parse_albums(results['albums']['items']):
         albums.append(album)
         album_track_map[album.uri] = album_tracks
     return SearchResults(tracks, artists, albums, album_track_map)
 
-def refresh_now_playing():
-    DATASTORE.now_playing = get_now_playing()
+# Library matches for query from the local search index; needs no connection
+def search_library(query):
+    found = library_index().search(query, SEARCH_LIMIT, lambda kind, key: search_index.resolve(DATASTORE, kind, key))
+    album_track_map = {album.uri: DATASTORE.getPlaylistTracks(album.uri) or [] for album in found[search_index.ALBUM]}
+    return SearchResults(found[search_index.TRACK], found[search_index.ARTIST], found[search_index.ALBUM],
+                         album_track_map, found[search_index.PLAYLIST])
+
+# Adds the results of a Web API search to the library matches already shown
+# for the same query, leaving out what the library had found
+def merge_search_results(results, remote):
+    results.album_track_map = dict(remote.album_track_map, **results.album_track_map)
+    for name in ["tracks", "artists", "albums"]:
+        items = getattr(results, name)
+        known = set(item.uri for item in items)
+        setattr(results, name, items + [item for item in getattr(remote, name) if item.uri not in known])
+    results.version = results.version + 1
 
-def play_next():
-    global sleep_time
-    sp.next_track()
-    sleep_time = 0.4
-    refresh_now_playing()
+def refresh_now_playing():
+    started_at = time.monotonic()
+    NOW_PLAYING_POLLER.polled(PLAYBACK_STATE.polled(get_now_playing(), started_at))
 
-def play_previous():
-    global sleep_time
-    sp.previous_track()
-    sleep_time = 0.4
-    refresh_now_playing()
+# Skips count tracks forward, or back for a negative count, as the net of
+# the skips PLAYBACK_COMMANDS coalesced
+def skip(count):
+    for _ in range(abs(count)):
+        sp.next_track() if count > 0 else sp.previous_track()
+    NOW_PLAYING_POLLER.command()
 
 def pause():
-    global sleep_time
     sp.pause_playback()
-    sleep_time = 0.4
-    refresh_now_playing()
+    NOW_PLAYING_POLLER.command()
 
 def resume():
-    global sleep_time
     sp.start_playback()
-    sleep_time = 0.4
-    refresh_now_playing()
-
-def toggle_play():
+    NOW_PLAYING_POLLER.command()
+
+# The buttons' playback commands: the expected effect shows at once through
+# PLAYBACK_STATE, the request follows on PLAYBACK_COMMANDS and the polls
+# after it confirm or correct what was shown
+def queue_skip(count):
+    changes = expected_skip(DATASTORE.now_playing, count)
+    if (changes is not None):
+        PLAYBACK_STATE.apply(changes)
+    if (PLAYBACK_COMMANDS.submit_skip(count, skip).count == 0):
+        # skips that cancelled out are never sent; a poll undoes what they showed
+        NOW_PLAYING_POLLER.poll_now()
+
+def queue_toggle_play():
     now_playing = DATASTORE.now_playing
     if not now_playing:
         return
-    if now_playing['is_playing']:
-        pause()
+    playing = now_playing['is_playing']
+    PLAYBACK_STATE.apply({'is_playing': not playing, 'progress': poller.progress_at(now_playing), 'timestamp': time.time()})
+    # decided now, as the state the command runs against is already the expected one
+    PLAYBACK_COMMANDS.submit(pause if playing else resume)
+
+# Queues fn, a play command replacing queued older ones, with the changes
+# it is expected to make (see expected_play) shown straight away
+def queue_play(fn, changes = None):
+    if (changes is not None):
+        PLAYBACK_STATE.apply(changes)
+    PLAYBACK_COMMANDS.submit(fn, kind="play")
+
+# Spotify's previous restarts the track when it played for longer than this
+PREVIOUS_RESTART_MS = 3000
+
+# Now playing fields expected after skipping count tracks of now_playing's
+# context; None if the track skipped to isn't known from the stored track list
+def expected_skip(now_playing, count):
+    if (not now_playing):
+        return None
+    if (count < 0 and poller.progress_at(now_playing) > PREVIOUS_RESTART_MS):
+        count = count + 1
+        if (count == 0):
+            return {'progress': 0, 'timestamp': time.time(), 'is_playing': True}
+    index = now_playing['track_index'] - 1 + count
+    if (now_playing['track_index'] < 0 or 'context_uri' not in now_playing or
+            now_playing.get('track_total') is None or index < 0 or index >= now_playing['track_total']):
+        return None
+    tracks = DATASTORE.getPlaylistTrackRange(now_playing['context_uri'], index, 1)
+    if (len(tracks) == 0 or tracks[0] is None):
+        return None
+    return dict(expected_track(tracks[0]), track_index=index + 1)
+
+# Now playing fields expected once track starts playing, in context (a
+# playlist or album, None for the track alone)
+def expected_play(track, context = None):
+    changes = expected_track(track)
+    changes.update(context_name=track.artist, track_index=-1)
+    if (context is not None):
+        changes['context_name'] = context.name
+        set_context_position(changes, context.uri, track.uri)
+    return changes
+
+def expected_track(track):
+    return {'name': track.title, 'track_uri': track.uri, 'artist': track.artist, 'album': track.album,
+            'duration': 0, 'progress': 0, 'timestamp': time.time(), 'is_playing': True}
+
+# Takes back what a failed playback command showed, with a notice on the now
+# playing screen, and polls for where playback really stands
+def playback_failed(command):
+    PLAYBACK_STATE.failed(PLAYBACK_FAILED_NOTICES.get(command.kind, "Couldn't reach Spotify"))
+    NOW_PLAYING_POLLER.poll_now()
+
+PLAYBACK_FAILED_NOTICES = {"skip": "Couldn't skip", "play": "Couldn't play"}
+
+# Applies an event of the local player to the now playing state straight
+# away (see player_events.apply_event). The track's position in its context
+# comes from the stored track list. Once the player stopped, e.g. as playback
+# moved to another device, its events tell nothing more and polls take over.
+def on_player_event(event):
+    stopped = event.get("PLAYER_EVENT") in player_events.STOP_EVENTS
+    if (stopped):
+        NOW_PLAYING_POLLER.unfollow_events()
     else:
-        resume()
+        NOW_PLAYING_POLLER.follow_events(PLAYER_EVENTS_POLL_INTERVAL, PLAYER_EVENTS_TIMEOUT)
+    if (PLAYBACK_STATE.event(lambda now_playing: player_events.apply_event(event, now_playing, set_context_position)) or stopped):
+        NOW_PLAYING_POLLER.poll_now()
 
+# Polls the now playing state whenever NOW_PLAYING_POLLER says so
 def bg_loop():
-    global sleep_time
+    SCHEDULER.local.priority = scheduler.NOW_PLAYING # the thread does nothing else
     while True:
+        NOW_PLAYING_POLLER.wait()
         refresh_now_playing()
-        time.sleep(sleep_time)
-        sleep_time = min(4, sleep_time * 2)
-
-sleep_time = 0.3
+        if (LOG_API_STATS and NOW_PLAYING_POLLER.polls % 100 == 0):
+            print("Now playing polls: " + json.dumps(NOW_PLAYING_POLLER.stats()))
+            print("Playback commands: " + json.dumps(PLAYBACK_COMMANDS.stats()))
+            print("Search commands: " + json.dumps(SEARCH_COMMANDS.stats()))
+            print("Expected playback: " + json.dumps(PLAYBACK_STATE.stats()))
+
+# compared against polling every 4s, the interval the poll loop used to settle at
+NOW_PLAYING_POLLER = poller.NowPlayingPoller(NOW_PLAYING_POLL_INTERVAL, NOW_PLAYING_PAUSED_POLL_INTERVAL,
+                                             NOW_PLAYING_ASLEEP_POLL_INTERVAL, baseline_interval=4)
+PLAYBACK_STATE = playback_state.PlaybackState(DATASTORE, PLAYBACK_COMMANDS)
 thread = threading.Thread(target=bg_loop, args=())
 thread.daemon = True                            # Daemonize thread
 thread.start()
 
-def run_async(fun):
-    threading.Thread(target=fun, args=()).start()
+PLAYER_EVENTS = player_events.PlayerEventListener(PLAYER_EVENTS_SOCKET, on_player_event, NOW_PLAYING_POLLER.unfollow_events) \
+    if PLAYER_EVENTS_SOCKET else None
+if (PLAYER_EVENTS is not None):
+    try:
+        PLAYER_EVENTS.start()
+    except OSError as e:
+        print("no player events: " + repr(e))
+
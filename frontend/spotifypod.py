@@ -14,6 +14,7 @@ from about_view import *
 from PIL import ImageTk, Image
 from sys import platform
 import os
+import poller
 from base_frame import *
 from config import *
 
@@ -37,6 +38,7 @@ screen_on = True
 def screen_sleep():
     global screen_on
     screen_on = False
+    spotify_manager.NOW_PLAYING_POLLER.set_asleep(True)
     if(gpio is not None):
         os.system("echo '0' > /sys/class/gpio/gpio18/value")
     os.system('xset -display :0 dpms force off')
@@ -44,6 +46,7 @@ def screen_sleep():
 def screen_wake():
     global screen_on
     screen_on = True
+    spotify_manager.NOW_PLAYING_POLLER.set_asleep(False)
     if(gpio is not None):
         os.system("echo '1' > /sys/class/gpio/gpio18/value")
     os.system('xset -display :0 dpms force on')
@@ -264,8 +267,10 @@ class NowPlayingFrame(BaseFrame):
         self.remaining_time = tk.Label(self.time_frame, text ="-00:00", font = LARGEFONT, background=SPOT_BLACK, foreground=SPOT_GREEN)
         self.remaining_time.grid(row=0, column=1, sticky ="ne", padx = int(60 * SCALE))
 
-        self.cached_album = None
-        self.cached_artist = None
+        # the snapshot on screen; only fields that differ from it are redrawn
+        self.shown = spotify_manager.NowPlaying()
+        # a failed command's notice, shown in place of the track position
+        self.shown_notice = None
 
     def update_now_playing(self, now_playing):
         if not self.inflated:
@@ -280,43 +285,48 @@ class NowPlayingFrame(BaseFrame):
                 self.inflated = True
         if not now_playing:
             return
-
-        self.header_volume_label.configure(text=now_playing['volume'])
-        self.track_label.set_text(now_playing['name'])
-        artist = now_playing['artist']
-        if self.cached_artist != artist:
+        # the same snapshot again means only the progress moved on
+        changed = set() if now_playing is self.shown else now_playing.changed_fields(self.shown)
+        self.shown = now_playing
+
+        if 'volume' in changed:
+            self.header_volume_label.configure(text=now_playing['volume'])
+        if 'name' in changed:
+            self.track_label.set_text(now_playing['name'])
+        if 'artist' in changed:
+            artist = now_playing['artist']
             truncd_artist = artist if len(artist) < 20 else artist[0:17] + "..."
             self.artist_label.configure(text=truncd_artist)
-            self.cached_artist = artist
-        album = now_playing['album']
-        if self.cached_album != album:
+        if 'album' in changed:
+            album = now_playing['album']
             truncd_album = album if len(album) < 20 else album[0:17] + "..."
             self.album_label.configure(text=truncd_album)
-            self.cached_album = album
-        context_name = now_playing['context_name']
-        truncd_context = context_name if context_name else "Now Playing"
-        truncd_context = truncd_context if len(truncd_context) < 20 else truncd_context[0:17] + "..."
-        self.header_label.configure(text=truncd_context)
+        if 'context_name' in changed:
+            context_name = now_playing['context_name']
+            truncd_context = context_name if context_name else "Now Playing"
+            truncd_context = truncd_context if len(truncd_context) < 20 else truncd_context[0:17] + "..."
+            self.header_label.configure(text=truncd_context)
 
         adjusted_progress_ms = now_playing['progress']
 
         if (now_playing['is_playing'] == 'volume'):
-            self.volume_down_indicator.configure(image = self.volume_down_image)
-            self.volume_down_indicator.image = self.volume_down_image
-            self.volume_up_indicator.configure(image = self.volume_up_image)
-            self.volume_up_indicator.image = self.volume_up_image
+            if 'is_playing' in changed:
+                self.volume_down_indicator.configure(image = self.volume_down_image)
+                self.volume_down_indicator.image = self.volume_down_image
+                self.volume_up_indicator.configure(image = self.volume_up_image)
+                self.volume_up_indicator.image = self.volume_up_image
 
             self.elapsed_time.configure(text="0")
             self.remaining_time.configure(text="100")
             self.update_time = True
         else:
-            self.volume_down_indicator.configure(image = self.volume_space_image)
-            self.volume_down_indicator.image = self.volume_space_image
-            self.volume_up_indicator.configure(image = self.volume_space_image)
-            self.volume_up_indicator.image = self.volume_space_image
+            if 'is_playing' in changed:
+                self.volume_down_indicator.configure(image = self.volume_space_image)
+                self.volume_down_indicator.image = self.volume_space_image
+                self.volume_up_indicator.configure(image = self.volume_space_image)
+                self.volume_up_indicator.image = self.volume_space_image
 
-            update_delta = 0 if not now_playing['is_playing'] else (time.time() - now_playing["timestamp"]) * 1000.0
-            adjusted_progress_ms = now_playing['progress'] + update_delta
+            adjusted_progress_ms = poller.progress_at(now_playing)
             adjusted_remaining_ms = max(0, now_playing['duration'] - adjusted_progress_ms)
             if self.update_time:
                 progress_txt = ":".join(str(timedelta(milliseconds=adjusted_progress_ms)).split('.')[0].split(':')[1:3])
@@ -326,8 +336,16 @@ class NowPlayingFrame(BaseFrame):
             self.update_time = not self.update_time
 
         if self.inflated:
-            adjusted_progress_pct = min(1.0, adjusted_progress_ms / now_playing['duration'])
+            # the duration is 0 while a track is only expected to play
+            adjusted_progress_pct = min(1.0, adjusted_progress_ms / now_playing['duration']) if now_playing['duration'] else 0
             self.progress_frame.coords(self.progress, self.progress_start_x, 0, self.progress_width * adjusted_progress_pct + self.progress_start_x, int(72 * SCALE))
+        notice = now_playing.get('notice') if now_playing.get('notice_until', 0) > time.time() else None
+        if not changed & {'track_index', 'track_total'} and notice == self.shown_notice:
+            return
+        self.shown_notice = notice
+        if notice:
+            self.context_label.configure(text=notice)
+            return
         if(now_playing['track_index'] < 0):
             self.context_label.configure(text="")
             return
@@ -427,7 +445,7 @@ class StartPage(BaseFrame):
         truncd_header = header if len(header) < 20 else header[0:17] + "..."
         self.header_label.configure(text=truncd_header)
         play_image = self.space_image
-        if now_playing is not None:
+        if now_playing:
             play_image = self.play_image if now_playing['is_playing'] else self.pause_image
         self.play_indicator.configure(image = play_image)
         self.play_indicator.image = play_image
@@ -0,0 +1,134 @@
+import pickle
+import sys
+import types
+import pytest
+import codec
+from models import *
+
+def fields(record):
+    return [getattr(record, name) for name in type(record).__slots__]
+
+def same(a, b):
+    if isinstance(a, list):
+        return type(b) is list and len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    return type(a) is type(b) and fields(a) == fields(b)
+
+RECORDS = [
+    UserDevice("0d1841b0976bae2a3a310dd74c0f3df354899bc8", "Spotifypod", True),
+    UserTrack("Track title", "Artist", "Album name", "spotify:track:4uLU6hMCjMI75M1A2tKUQC"),
+    UserAlbum("Album name", "Artist", 12, "spotify:album:4aawyAB9vmqN3uQ7FjRGTy"),
+    UserArtist("Artist", "spotify:artist:0OdUWJ0sBjDrqHygGUXeCF"),
+    UserPlaylist("Playlist name", 17, "spotify:playlist:37i9dQZF1DXcBWIGoYBM5M", 250),
+]
+
+# Unusual values for every field of every record type
+ODD_VALUES = [None, "", "Björk – Jóga ♫ 日本語 🎧", "a\x00b", "x" * 300, 0, -1, 2**40, True, False]
+
+def test_every_registered_type_is_covered():
+    assert set(type(record) for record in RECORDS) == set(codec._tags)
+
+@pytest.mark.parametrize("record", RECORDS, ids=lambda record: type(record).__name__)
+def test_record_round_trip(record):
+    assert same(codec.loads(codec.dumps(record)), record)
+
+@pytest.mark.parametrize("record", RECORDS, ids=lambda record: type(record).__name__)
+def test_list_round_trip(record):
+    records = [type(record)(*fields(record)) for _ in range(3)]
+    assert same(codec.loads(codec.dumps(records)), records)
+    assert same(codec.loads(codec.dumps(records, 1)), records) # compressed
+
+@pytest.mark.parametrize("record", RECORDS, ids=lambda record: type(record).__name__)
+def test_odd_values_round_trip(record):
+    cls = type(record)
+    for value in ODD_VALUES:
+        odd = cls(*[value] * len(cls.__slots__))
+        assert same(codec.loads(codec.dumps(odd)), odd), value
+    # one column mixing every kind of value
+    columns = [cls(*[value] * len(cls.__slots__)) for value in ODD_VALUES]
+    assert same(codec.loads(codec.dumps(columns)), columns)
+
+def test_empty_list():
+    assert codec.loads(codec.dumps([])) == []
+    assert codec.loads(codec.dumps([], 0)) == []
+
+def test_mixed_types_in_one_list_are_refused():
+    with pytest.raises(TypeError):
+        codec.dumps(RECORDS[:2])
+
+def test_format_version_1_records_still_decode():
+    # version 1 wrote single records as a one row column block
+    out = bytearray(codec.MAGIC)
+    out += bytes([1, codec.KIND_RECORD])
+    codec._write_block(out, [RECORDS[1]])
+    assert same(codec.loads(bytes(out)), RECORDS[1])
+
+def test_newer_format_is_refused():
+    blob = bytearray(codec.dumps(RECORDS[1]))
+    blob[1] = codec.FORMAT_VERSION + 1
+    with pytest.raises(ValueError):
+        codec.loads(bytes(blob))
+
+class Versioned():
+    __slots__ = ['name', 'uri', 'added']
+    def __init__(self, name, uri, added):
+        self.name = name
+        self.uri = uri
+        self.added = added
+
+def test_older_schema_versions_decode_by_name():
+    codec.register(250, Versioned, ["uri", "name"], version=1)
+    old_single = codec.dumps(Versioned("a", "spotify:x:1", None))
+    old_list = codec.dumps([Versioned("b", "spotify:x:2", None)])
+    codec.register(250, Versioned, version=2)
+    try:
+        assert fields(codec.loads(old_single)) == ["a", "spotify:x:1", None]
+        assert fields(codec.loads(old_list)[0]) == ["b", "spotify:x:2", None]
+        assert fields(codec.loads(codec.dumps(Versioned("c", "u", 3)))) == ["c", "u", 3]
+    finally:
+        del codec._schemas[250]
+        del codec._tags[Versioned]
+
+# Pickles value the way libraries of the first layout stored it, with the
+# record classes defined in spotify_manager. Afterwards spotify_manager is an
+# empty module, so decoding can't lean on the shim (or import the real one).
+def legacy_pickle(monkeypatch, value):
+    shim = types.ModuleType("spotify_manager")
+    for cls in set(type(record) for record in RECORDS):
+        setattr(shim, cls.__name__, type(cls.__name__, (), {'__slots__': cls.__slots__, '__module__': shim.__name__}))
+    def old(record):
+        copy = object.__new__(getattr(shim, type(record).__name__))
+        for name in type(record).__slots__:
+            setattr(copy, name, getattr(record, name))
+        return copy
+    monkeypatch.setitem(sys.modules, shim.__name__, shim)
+    blob = pickle.dumps([old(record) for record in value] if isinstance(value, list) else old(value))
+    monkeypatch.setitem(sys.modules, shim.__name__, types.ModuleType(shim.__name__))
+    assert b"spotify_manager" in blob
+    return blob
+
+@pytest.mark.parametrize("value", [RECORDS[1], RECORDS, [RECORDS[2]] * 4], ids=["record", "mixed", "list"])
+def test_legacy_pickles_decode(monkeypatch, value):
+    blob = legacy_pickle(monkeypatch, value)
+    assert codec.is_legacy(blob)
+    assert not codec.is_legacy(codec.dumps(RECORDS[1]))
+    decoded = codec.loads(blob)
+    assert same(decoded, value)
+
+def test_redis_migrates_legacy_pickles(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    import datastore_redis
+    r = fakeredis.FakeRedis()
+    # a library of the first layout: pickled records and id sets, no generations
+    tracks = [UserTrack("T" + str(i), "A", "B", "spotify:track:" + str(i)) for i in range(3)]
+    for i, track in enumerate(tracks):
+        r.set("track:" + str(i), legacy_pickle(monkeypatch, track))
+        r.sadd("track-ids", str(i))
+    r.set("device:d1", legacy_pickle(monkeypatch, RECORDS[0]))
+    r.sadd("device-ids", "d1")
+    r.set("index-version", 1)
+    backend = datastore_redis.RedisBackend(r)
+    assert not any(codec.is_legacy(r.get(key)) for key in r.scan_iter("*track:*"))
+    assert not codec.is_legacy(r.get("device:d1"))
+    assert same(backend.getRows("track", 0, 3), tracks)
+    assert same(backend.getDevices(), [RECORDS[0]])
+    assert r.get("index-version") is None
@@ -0,0 +1,105 @@
+import sqlite3
+import datastore_sqlite
+from models import *
+
+def tracks(count, prefix = "t"):
+    return [UserTrack(prefix + str(i), "A", "B", "spotify:track:" + prefix + str(i)) for i in range(count)]
+
+def playlist(i):
+    return UserPlaylist("P" + str(i), i, "spotify:playlist:p" + str(i), 2)
+
+# The counts the backend keeps against counting the rows themselves
+def check_counts(backend):
+    conn = backend._conn()
+    for kind, (table, _, _) in datastore_sqlite.ROW_TABLES.items():
+        assert backend.countRows(kind) == conn.execute("SELECT COUNT(*) FROM " + table + " WHERE gen = ?",
+                                                       (backend.generation,)).fetchone()[0], kind
+    for kind, (table, _, _) in datastore_sqlite.CONTEXT_TABLES.items():
+        assert backend.countContexts(kind) == conn.execute("SELECT COUNT(*) FROM " + table + " WHERE gen = ? AND kind = ?"
+                                                           " AND pos IS NOT NULL", (backend.generation, kind)).fetchone()[0], kind
+
+def test_row_counts_follow_writes(tmp_path):
+    backend = datastore_sqlite.SqliteBackend(str(tmp_path / "library.db"))
+    assert backend.countRows("track") == 0
+    backend.setRows("track", 0, tracks(50))
+    backend.setRows("track", 40, tracks(30)) # overlaps 10 stored rows
+    assert backend.countRows("track") == 70
+    backend.prependRows("track", tracks(5, "new"))
+    assert backend.countRows("track") == 75
+    backend.trimRows("track", 60)
+    assert backend.countRows("track") == 60
+    backend.setRows("artist", 0, [UserArtist("A" + str(i), "spotify:artist:" + str(i)) for i in range(7)])
+    check_counts(backend)
+
+def test_context_counts_follow_writes(tmp_path):
+    backend = datastore_sqlite.SqliteBackend(str(tmp_path / "library.db"))
+    backend.setContexts("playlist", 0, [(playlist(i), tracks(2)) for i in range(5)])
+    # rewritten in place, without a position (kept) and at another one's position
+    backend.setContexts("playlist", 1, [(playlist(1), None)])
+    backend.setContexts("playlist", None, [(playlist(2), None), (playlist(9), tracks(1))])
+    backend.setContexts("playlist", 0, [(playlist(4), None)])
+    assert backend.countContexts("playlist") == 4
+    check_counts(backend)
+    backend.prependContexts("playlist", [(playlist(7), tracks(1))])
+    check_counts(backend)
+    backend.trimContexts("playlist", 3)
+    assert backend.countContexts("playlist") == 3
+    backend.setContexts("album", 0, [(UserAlbum("Al", "A", 2, "spotify:album:a"), tracks(2))])
+    backend.setContexts("nr", 0, [(UserAlbum("N", "A", 2, "spotify:album:n"), None)])
+    check_counts(backend)
+
+def test_counts_are_per_generation(tmp_path):
+    backend = datastore_sqlite.SqliteBackend(str(tmp_path / "library.db"))
+    backend.setRows("track", 0, tracks(10))
+    new = backend.beginGeneration()
+    new.setRows("track", 0, tracks(3))
+    assert (backend.countRows("track"), new.countRows("track")) == (10, 3)
+    backend.publishGeneration(new)
+    assert backend.countRows("track") == 3
+    assert backend._conn().execute("SELECT COUNT(*) FROM counts WHERE gen != ?", (backend.generation,)).fetchone()[0] == 0
+    backend.clear()
+    assert backend.countRows("track") == 0
+
+def test_existing_library_is_counted_once(tmp_path):
+    path = str(tmp_path / "library.db")
+    backend = datastore_sqlite.SqliteBackend(path)
+    backend.setRows("track", 0, tracks(12))
+    backend.setContexts("album", 0, [(UserAlbum("Al", "A", 2, "spotify:album:a"), tracks(2))])
+    # as written before the counts table existed
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("DROP TABLE counts")
+        conn.execute("DELETE FROM meta WHERE key = 'storage-version'")
+    conn.close()
+    reopened = datastore_sqlite.SqliteBackend(path)
+    assert (reopened.countRows("track"), reopened.countContexts("album")) == (12, 1)
+    check_counts(reopened)
+
+def test_cached_search_keeps_each_albums_tracks(tmp_path):
+    import datastore
+    path = str(tmp_path / "library.db")
+    store = datastore.Datastore(datastore_sqlite.SqliteBackend(path))
+    # declared counts that don't match what the market returned, and a track on two albums
+    albums = [UserAlbum("Al", "A", 5, "spotify:album:a"), UserAlbum("Bl", "B", 1, "spotify:album:b")]
+    album_tracks = {albums[0].uri: tracks(2, "a"), albums[1].uri: tracks(3, "b") + tracks(1, "a")}
+    store.setSearchResults("Query", SearchResults(tracks(1), [], albums, album_tracks))
+    results = datastore.Datastore(datastore_sqlite.SqliteBackend(path)).getSearchResults("query")
+    assert [album.uri for album in results.albums] == [album.uri for album in albums]
+    assert {uri: [track.uri for track in items] for uri, items in results.album_track_map.items()} == \
+        {uri: [track.uri for track in items] for uri, items in album_tracks.items()}
+
+def test_searches_cached_without_album_track_ids_are_dropped(tmp_path):
+    path = str(tmp_path / "library.db")
+    datastore_sqlite.SqliteBackend(path)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("DROP TABLE search_results")
+        conn.execute("CREATE TABLE search_results (query TEXT PRIMARY KEY, tracks BLOB, artists BLOB, albums BLOB,"
+                     " album_tracks BLOB, expires_at REAL)")
+        conn.execute("INSERT INTO search_results (query, expires_at) VALUES ('old', 1e12)")
+        conn.execute("UPDATE meta SET value = '1' WHERE key = 'storage-version'")
+    conn.close()
+    reopened = datastore_sqlite.SqliteBackend(path)
+    assert reopened.getSearchResults("old") is None
+    reopened.setSearchResults("new", 1e12, [[], [], [], []], "{}", 10)
+    assert reopened.getSearchResults("new") == (1e12, [[], [], [], []], "{}")
@@ -0,0 +1,82 @@
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import http_session
+
+# A local stand-in for the Web API: each path answers with the statuses
+# queued for it, then 200, and every request and new connection is recorded
+class StandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive
+
+    def setup(self):
+        super().setup()
+        self.server.connections = self.server.connections + 1
+
+    def _answer(self):
+        self.server.requests.append((self.command, self.path))
+        length = int(self.headers.get("Content-Length") or 0)
+        if (length):
+            self.rfile.read(length)
+        status, headers = self.server.script.get(self.path, []).pop(0) if self.server.script.get(self.path) else (200, {})
+        body = b'{"ok": true}'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _answer
+    do_PUT = _answer
+    do_POST = _answer
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.script = {}
+    server.requests = []
+    server.connections = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = "http://127.0.0.1:%d" % server.server_address[1]
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def session():
+    session = http_session.ManagedSession(pool_size=2, max_retries=3)
+    session.backoff = lambda attempt: 0
+    yield session
+    session.close()
+
+def test_rate_limited_request_is_retried_after_retry_after(server, session):
+    server.script["/v1/me/player"] = [(429, {"Retry-After": "0"}), (429, {"Retry-After": "0"})]
+    response = session.get(server.url + "/v1/me/player")
+    assert response.status_code == 200
+    assert len(server.requests) == 3
+    assert session.stats()["rate_limited"] == 2 and session.stats()["retries"] == 2
+
+def test_too_long_retry_after_is_handed_back(server, session):
+    server.script["/v1/me/player"] = [(429, {"Retry-After": "3600"})]
+    assert session.get(server.url + "/v1/me/player").status_code == 429
+    assert len(server.requests) == 1
+
+def test_server_error_retried_only_when_safe_to_repeat(server, session):
+    server.script["/v1/me/player/play"] = [(503, {})]
+    response = session.put(server.url + "/v1/me/player/play", json={})
+    assert response.status_code == 503
+    assert server.requests == [("PUT", "/v1/me/player/play")]
+    server.script["/v1/me/playlists"] = [(503, {})]
+    assert session.get(server.url + "/v1/me/playlists").status_code == 200
+    assert server.requests[1:] == [("GET", "/v1/me/playlists")] * 2
+
+def test_connections_are_reused(server, session):
+    for _ in range(5):
+        assert session.get(server.url + "/v1/me/player").status_code == 200
+    assert server.connections == 1
+    assert session.connection_stats() == {"new_connections": 1, "reused_connections": 4}
@@ -0,0 +1,88 @@
+import time
+import datastore
+import datastore_sqlite
+import playback_state
+
+class Executor():
+    def __init__(self):
+        self.running = False
+        self.finished_at = 0
+
+    def busy(self):
+        return self.running
+
+    def run(self):
+        self.running = True
+
+    def finish(self):
+        self.running = False
+        self.finished_at = time.monotonic()
+
+def polled(name, is_playing = True):
+    return {'name': name, 'is_playing': is_playing, 'progress': 1000, 'duration': 200000,
+            'timestamp': time.time(), 'track_index': -1}
+
+def make(tmp_path):
+    store = datastore.Datastore(datastore_sqlite.SqliteBackend(str(tmp_path / "library.db")))
+    executor = Executor()
+    state = playback_state.PlaybackState(store, executor)
+    state.polled(polled("One"), time.monotonic())
+    return store, executor, state
+
+def test_expected_fields_stay_until_an_authoritative_poll(tmp_path):
+    store, executor, state = make(tmp_path)
+    state.apply({'is_playing': False})
+    executor.run()
+    assert store.now_playing['is_playing'] is False
+    started = time.monotonic()
+    state.polled(polled("One"), started) # sent while the command runs
+    assert store.now_playing['is_playing'] is False
+    executor.finish()
+    state.polled(polled("One"), started) # sent before the command finished
+    assert store.now_playing['is_playing'] is False
+    state.polled(polled("One", False), time.monotonic())
+    assert store.now_playing['is_playing'] is False
+    assert state.stats() == dict(applied=1, confirmed=1, corrected=0, rolled_back=0, pending=0)
+
+def test_failed_command_rolls_back_with_a_notice(tmp_path):
+    store, executor, state = make(tmp_path)
+    state.apply({'name': "Two", 'progress': 0})
+    state.failed("Couldn't skip")
+    now_playing = store.now_playing
+    assert now_playing['name'] == "One" and now_playing['progress'] >= 1000
+    assert now_playing['notice'] == "Couldn't skip" and now_playing['notice_until'] > time.time()
+    assert state.stats()["rolled_back"] == 1
+
+def test_events_keep_the_expected_fields(tmp_path):
+    store, executor, state = make(tmp_path)
+    state.apply({'is_playing': False})
+    executor.run()
+    poll = state.event(lambda now_playing: (dict(now_playing.fields(), name="Two"), True))
+    assert poll
+    assert (store.now_playing['name'], store.now_playing['is_playing']) == ("Two", False)
+
+def test_events_update_the_latest_snapshot(tmp_path):
+    store, executor, state = make(tmp_path)
+    seen = []
+    def update(now_playing):
+        seen.append(now_playing)
+        return None, False
+    state.apply({'name': "Two"})
+    assert not state.event(update)
+    assert seen == [store.now_playing] and seen[0]['name'] == "Two"
+
+def test_events_override_the_expected_fields_they_report(tmp_path):
+    store, executor, state = make(tmp_path)
+    # a skip expected to reach "Two", which shuffle turned into "Nine"
+    state.apply({'name': "Two", 'duration': 0, 'progress': 0, 'is_playing': True})
+    executor.run()
+    executor.finish()
+    state.event(lambda now_playing: (dict(now_playing.fields(), name="Nine", duration=240000, progress=0,
+                                          timestamp=time.time()), False))
+    now_playing = store.now_playing
+    assert (now_playing['name'], now_playing['duration'], now_playing['is_playing']) == ("Nine", 240000, True)
+    assert state.stats()["pending"] == 2 # progress and is_playing, the event left them as expected
+    state.event(lambda now_playing: (dict(now_playing.fields(), is_playing=False, progress=5000,
+                                          timestamp=time.time()), False))
+    assert store.now_playing['is_playing'] is False
+    assert state.stats() == dict(applied=1, confirmed=0, corrected=1, rolled_back=0, pending=0)
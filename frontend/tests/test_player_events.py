@@ -0,0 +1,83 @@
+import queue
+import threading
+import time
+import pytest
+import player_events
+from models import NowPlaying
+
+PLAYING = NowPlaying({'name': "One", 'track_uri': "spotify:track:1", 'artist': "A", 'album': "B",
+                      'duration': 200000, 'is_playing': True, 'progress': 10000, 'context_name': "List",
+                      'context_uri': "spotify:playlist:p", 'track_index': 1, 'track_total': 3,
+                      'timestamp': time.time()}, version=1)
+ALONE = NowPlaying(dict((key, value) for key, value in PLAYING.fields().items() if key != 'context_uri'), version=1)
+
+# Stands in for the stored track list of spotify:playlist:p
+def context_position(fields, context_uri, track_uri):
+    positions = {"spotify:track:1": 0, "spotify:track:2": 1}
+    if (track_uri in positions):
+        fields['track_index'] = positions[track_uri] + 1
+        fields['track_total'] = 3
+
+def apply(now_playing, **event):
+    return player_events.apply_event(event, now_playing, context_position)
+
+def test_track_change_with_details():
+    fields, poll = apply(PLAYING, PLAYER_EVENT="track_changed", URI="spotify:track:2", NAME="Two",
+                         ARTISTS="C\nD", ALBUM="E", DURATION_MS="180000", POSITION_MS="0")
+    assert not poll
+    assert (fields['name'], fields['track_uri'], fields['artist'], fields['album']) == ("Two", "spotify:track:2", "C", "E")
+    assert (fields['duration'], fields['progress'], fields['track_index']) == (180000, 0, 2)
+    assert fields['context_name'] == "List"
+
+def test_track_change_outside_the_context_polls():
+    fields, poll = apply(PLAYING, PLAYER_EVENT="track_changed", TRACK_ID="9", NAME="Nine")
+    assert poll and fields['track_uri'] == "spotify:track:9" and fields['track_index'] == -1
+    fields, poll = apply(ALONE, PLAYER_EVENT="track_changed", TRACK_ID="9", NAME="Nine")
+    assert not poll and fields['name'] == "Nine"
+
+@pytest.mark.parametrize("now_playing, event", [
+    (PLAYING, {"PLAYER_EVENT": "changed", "TRACK_ID": "2"}), # id only
+    (NowPlaying(), {"PLAYER_EVENT": "track_changed", "TRACK_ID": "2", "NAME": "Two"}),
+    (PLAYING, {"PLAYER_EVENT": "paused", "TRACK_ID": "2", "POSITION_MS": "5"}), # another track
+    (NowPlaying(), {"PLAYER_EVENT": "playing", "POSITION_MS": "5"}),
+])
+def test_what_an_event_cant_tell_is_polled(now_playing, event):
+    assert apply(now_playing, **event) == (None, True)
+
+@pytest.mark.parametrize("kind, is_playing", [("paused", False), ("playing", True), ("seeked", True),
+                                              ("position_correction", True)])
+def test_position_events(kind, is_playing):
+    fields, poll = apply(PLAYING, PLAYER_EVENT=kind, TRACK_ID="1", POSITION_MS="30000")
+    assert not poll
+    assert (fields['progress'], fields['is_playing'], fields['name']) == (30000, is_playing, "One")
+    assert time.time() - fields['timestamp'] < 1
+
+@pytest.mark.parametrize("kind", player_events.STOP_EVENTS)
+def test_stop_events_keep_the_position_reached(kind):
+    fields, poll = apply(PLAYING.replace(timestamp=time.time() - 5), PLAYER_EVENT=kind)
+    assert not poll and fields['is_playing'] is False
+    assert 14000 < fields['progress'] < 16000 # 10s at the poll, 5s ago
+    assert apply(NowPlaying(), PLAYER_EVENT=kind) == (None, False)
+
+def test_unknown_events_change_nothing():
+    assert apply(PLAYING, PLAYER_EVENT="volume_set", VOLUME="100") == (None, False)
+
+def test_listener_receives_what_the_hook_sends(tmp_path):
+    received = queue.Queue()
+    listener = player_events.PlayerEventListener(str(tmp_path / "events.sock"), received.put)
+    listener.start()
+    try:
+        player_events.send_event(listener.path, {"PLAYER_EVENT": "paused", "TRACK_ID": "1", "POSITION_MS": "5"})
+        player_events.send_event(listener.path, {"PLAYER_EVENT": "seeked", "POSITION_MS": "9"})
+        assert received.get(timeout=2) == {"PLAYER_EVENT": "paused", "TRACK_ID": "1", "POSITION_MS": "5"}
+        assert received.get(timeout=2)["POSITION_MS"] == "9"
+        assert listener.events == 2
+    finally:
+        listener.stop()
+
+def test_listener_reports_when_it_closes(tmp_path):
+    closed = threading.Event()
+    listener = player_events.PlayerEventListener(str(tmp_path / "events.sock"), lambda event: None, closed.set)
+    listener.start()
+    listener.stop()
+    assert closed.wait(timeout=2)
@@ -0,0 +1,41 @@
+import time
+import poller
+
+PLAYING = {'is_playing': True, 'progress': 0, 'duration': 200000, 'timestamp': time.time()}
+PAUSED = dict(PLAYING, is_playing=False)
+
+def make():
+    return poller.NowPlayingPoller(15, 20, 60, baseline_interval=4)
+
+def test_polling_adapts_to_playback():
+    now_playing = dict(PLAYING, timestamp=time.time())
+    assert make().interval(now_playing) == 15
+    assert 5 < make().interval(dict(now_playing, progress=195000)) <= 5.5 # the end of the track, plus BOUNDARY_DELAY
+    assert make().interval(PAUSED) == 20
+
+def test_events_stretch_the_polls_until_they_stop():
+    poll = make()
+    poll.follow_events(60, 600)
+    assert poll.interval(PLAYING) == poll.interval(PAUSED) == 60
+    poll.unfollow_events()
+    assert poll.interval(PAUSED) == 20
+
+def test_events_time_out():
+    poll = make()
+    poll.follow_events(60, 600)
+    poll.last_event = time.monotonic() - 601
+    assert poll.interval(PAUSED) == 20
+    poll.follow_events(60, 600) # the next event
+    assert poll.interval(PAUSED) == 60
+
+def test_commands_poll_once_while_events_arrive():
+    poll = make()
+    poll.follow_events(60, 600)
+    poll.polled(PAUSED)
+    poll.command()
+    assert poll.next_poll - time.monotonic() <= poller.COMMAND_DELAY
+    poll.polled(PAUSED)
+    assert poll.next_poll - time.monotonic() > 59
+    poll.unfollow_events()
+    poll.command()
+    assert poll.follow_ups == poller.FOLLOW_UP_POLLS
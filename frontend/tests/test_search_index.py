@@ -0,0 +1,44 @@
+import datastore
+import datastore_sqlite
+import search_index
+from models import *
+
+def library(tmp_path):
+    store = datastore.Datastore(datastore_sqlite.SqliteBackend(str(tmp_path / "library.db")))
+    store.setSavedTracks(0, [UserTrack("Jóga", "Björk", "Homogenic", "spotify:track:1"),
+                             UserTrack("Hunter", "Björk", "Homogenic", "spotify:track:2"),
+                             UserTrack("Windowlicker", "Aphex Twin", "Windowlicker", "spotify:track:3")])
+    store.setArtists(0, [UserArtist("Aphex Twin", "spotify:artist:a"), UserArtist("Björk", "spotify:artist:b")])
+    store.setAlbums(0, [(UserAlbum("Homogenic", "Björk", 10, "spotify:album:h"), [])])
+    store.setPlaylists(0, [(UserPlaylist("Bjork mix", 0, "spotify:playlist:p", 0), None)])
+    return store
+
+def search(store, index, query, limit = 5):
+    found = index.search(query, limit, lambda kind, key: search_index.resolve(store, kind, key))
+    return {kind: [record.uri for record in records] for kind, records in found.items() if len(records) > 0}
+
+def test_matches_resolve_from_the_datastore(tmp_path):
+    store = library(tmp_path)
+    index = search_index.build(store)
+    assert len(index) == 7
+    assert index.uris == ["spotify:album:h", "spotify:playlist:p"] # records themselves aren't kept
+    assert search(store, index, "bjo") == {"track": ["spotify:track:1", "spotify:track:2"], "artist": ["spotify:artist:b"],
+                                           "album": ["spotify:album:h"], "playlist": ["spotify:playlist:p"]}
+    assert search(store, index, "HOMO hun") == {"track": ["spotify:track:2"]}
+    assert search(store, index, "bjork", 1)["track"] == ["spotify:track:1"]
+    assert search(store, index, "nothing") == {}
+
+def test_records_moved_since_the_build_drop_out(tmp_path):
+    store = library(tmp_path)
+    index = search_index.build(store)
+    # a sync prepends a saved track: every stored position moves down one
+    store.prependSavedTracks([UserTrack("Roygbiv", "Boards of Canada", "Music Has the Right", "spotify:track:4")])
+    assert search(store, index, "windowlicker") == {}
+    assert search(store, index, "hunter") == {}
+    assert search(store, index, "joga") == {}
+
+def test_index_remembers_the_revision_it_was_built_from(tmp_path):
+    store = library(tmp_path)
+    assert search_index.build(store).revision == store.revision
+    store.publishGeneration(store)
+    assert search_index.build(store).revision == store.revision == 1
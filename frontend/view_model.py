@@ -85,6 +85,9 @@ class NowPlayingRendering(Rendering):
         self.callback = None
         self.after_id = None
         self.target_volume = SystemController.get_volume()
+        # the snapshot last handed to the callback, reused while nothing changed
+        self.rendered = None
+        self.rendered_key = None
 
     def subscribe(self, app, callback):
         if callback == self.callback:
@@ -106,9 +109,12 @@ class NowPlayingRendering(Rendering):
             if(SystemController.get_volume() != self.target_volume) :
                 SystemController.set_volume(self.target_volume)
         else :
-            now_playing = {'name':'', 'artist':'', 'album':'Volume', 'context_name':'', 'is_playing': 'volume', 'progress': self.target_volume, 'duration' : 100, 'track_index': -1}
-        now_playing['volume'] = str(self.target_volume)
-        self.callback(now_playing)
+            now_playing = spotify_manager.NowPlaying({'name':'', 'artist':'', 'album':'Volume', 'context_name':'', 'is_playing': 'volume', 'progress': self.target_volume, 'duration' : 100, 'track_index': -1})
+        key = (volume is not None, now_playing.version, self.target_volume)
+        if (key != self.rendered_key):
+            self.rendered_key = key
+            self.rendered = now_playing.replace(volume=str(self.target_volume)) if now_playing else now_playing
+        self.callback(self.rendered)
         self.after_id = self.app.after(500, lambda: self.refresh())
 
     def unsubscribe(self):
@@ -117,13 +123,18 @@ class NowPlayingRendering(Rendering):
         self.app = None
 
 class NowPlayingCommand():
-    def __init__(self, runnable = lambda:()):
+    def __init__(self, runnable = None, expected = None):
         self.has_run = False
         self.runnable = runnable
+        # returns the now playing fields the command is expected to bring
+        self.expected = expected
 
+    # Queued, so a newer play replaces one that hasn't started yet; what it
+    # is expected to play shows straight away
     def run(self):
         self.has_run = True
-        self.runnable()
+        if (self.runnable is not None):
+            spotify_manager.queue_play(self.runnable, self.expected() if self.expected else None)
 
 class SearchRendering(Rendering):
     def __init__(self, query, active_char):
@@ -192,15 +203,31 @@ class SearchPage():
             self.live_render.active_char = 26
         self.live_render.refresh()
 
+    # Library matches show straight away, also offline; Web API results are
+    # merged into them once they arrive, unless a newer search was submitted
+    # meanwhile
     def run_search(self, query):
-        self.live_render.loading = True
+        command = spotify_manager.SEARCH_COMMANDS.current()
+        results = spotify_manager.search_library(query)
+        if (results.is_empty()):
+            self.live_render.loading = True
+        else:
+            self.live_render.results = results
         self.live_render.refresh()
-        self.live_render.results = spotify_manager.search(query)
+        remote = spotify_manager.check_internet(lambda: spotify_manager.search(query))
+        if (command.cancelled):
+            return
+        if (not results.is_empty()):
+            if (remote is not None):
+                spotify_manager.merge_search_results(results, remote)
+            return
+        self.live_render.results = remote if remote is not None else results
         self.live_render.loading = False
         self.live_render.refresh()
 
     def nav_select(self):
-        spotify_manager.run_async(lambda: self.run_search(self.live_render.query))
+        query = self.live_render.query
+        spotify_manager.SEARCH_COMMANDS.submit(lambda: self.run_search(query), kind="search")
         return self
 
     def nav_back(self):
@@ -218,26 +245,19 @@ class NowPlayingPage():
         self.live_render = NowPlayingRendering()
         self.is_title = False
 
-    def play_previous(self):
-        spotify_manager.play_previous()
-        self.live_render.refresh()
-
-    def play_next(self):
-        spotify_manager.play_next()
-        self.live_render.refresh()
-
-    def toggle_play(self):
-        spotify_manager.toggle_play()
-        self.live_render.refresh()
-
+    # The expected state is published before these return, so refreshing
+    # right away draws it in the same frame
     def nav_prev(self):
-        spotify_manager.run_async(lambda: self.play_previous())
+        spotify_manager.queue_skip(-1)
+        self.live_render.refresh()
 
     def nav_next(self):
-        spotify_manager.run_async(lambda: self.play_next())
+        spotify_manager.queue_skip(1)
+        self.live_render.refresh()
 
     def nav_play(self):
-        spotify_manager.run_async(lambda: self.toggle_play())
+        spotify_manager.queue_toggle_play()
+        self.live_render.refresh()
 
     def nav_up(self):
         vol = self.live_render.target_volume
@@ -280,14 +300,19 @@ class MenuPage():
     def page_at(self, index):
         return None
 
+    # Pages for rows start..start+count, used by render to build a screen at
+    # once. Datastore-backed pages override this with a single ranged read.
+    def page_range(self, start, count):
+        return [self.page_at(i) for i in range(start, start + count)]
+
     def nav_prev(self):
-        spotify_manager.run_async(lambda: spotify_manager.play_previous())
+        spotify_manager.queue_skip(-1)
 
     def nav_next(self):
-        spotify_manager.run_async(lambda: spotify_manager.play_next())
+        spotify_manager.queue_skip(1)
 
     def nav_play(self):
-        spotify_manager.run_async(lambda: spotify_manager.toggle_play())
+        spotify_manager.queue_toggle_play()
 
     def get_index_jump_up(self):
         return 1
@@ -313,6 +338,11 @@ class MenuPage():
                 self.page_start = 0
         self.index = self.index - jump
 
+    # Moves the selection to index, scrolled so it's on screen
+    def jump_to(self, index):
+        self.index = index
+        self.page_start = max(0, min(index, self.total_size() - MENU_PAGE_SIZE))
+
     def nav_select(self):
         return self.page_at(self.index)
 
@@ -322,9 +352,11 @@ class MenuPage():
     def render(self):
         lines = []
         total_size = self.total_size()
+        visible = max(0, min(MENU_PAGE_SIZE, total_size - self.page_start))
+        pages = self.page_range(self.page_start, visible)
         for i in range(self.page_start, self.page_start + MENU_PAGE_SIZE):
             if (i < total_size):
-                page = self.page_at(i)
+                page = pages[i - self.page_start]
                 if (page is None) :
                     lines.append(EMPTY_LINE_ITEM)
                 else:
@@ -338,10 +370,18 @@ class MenuPage():
 class PlaylistsPage(MenuPage):
     def __init__(self, previous_page):
         super().__init__(self.get_title(), previous_page, has_sub_page=True)
+        self.load_content()
+
+    def load_content(self):
+        self.revision = spotify_manager.DATASTORE.revision
         self.playlists = self.get_content()
         self.num_playlists = len(self.playlists)
 
         self.playlists.sort(key=self.get_idx) # sort playlists to keep order as arranged in Spotify library
+        PlaylistsPage.page_at.cache_clear()
+        if (self.index >= self.num_playlists):
+            self.index = 0
+            self.page_start = 0
 
     def get_title(self):
         return "Playlists"
@@ -359,12 +399,21 @@ class PlaylistsPage(MenuPage):
             return 0
 
     def total_size(self):
+        # reload once a library sync has finished
+        if (self.revision != spotify_manager.DATASTORE.revision):
+            self.load_content()
         return self.num_playlists
 
     @lru_cache(maxsize=15)
     def page_at(self, index):
         return SinglePlaylistPage(self.playlists[index], self)
 
+    # The cached page is opened again each time, see SinglePlaylistPage.opened
+    def nav_select(self):
+        page = self.page_at(self.index)
+        page.opened()
+        return page
+
 class AlbumsPage(PlaylistsPage):
     def __init__(self, previous_page):
         super().__init__(previous_page)
@@ -376,41 +425,65 @@ class AlbumsPage(PlaylistsPage):
         return spotify_manager.DATASTORE.getAllSavedAlbums()
 
 class SearchResultsPage(MenuPage):
+    SECTIONS = [("TRACKS", "tracks"), ("ARTISTS", "artists"), ("PLAYLISTS", "playlists"), ("ALBUMS", "albums")]
+
     def __init__(self, previous_page, results):
         super().__init__("Search Results", previous_page, has_sub_page=True)
         self.results = results
-        tracks, albums, artists = len(results.tracks), len(results.albums), len(results.artists)
-        # Add 1 to each count (if > 0) to make room for section header line items
-        self.tracks = tracks + 1 if tracks > 0 else 0
-        self.artists = artists + 1 if artists > 0 else 0
-        self.albums = albums + 1 if albums > 0 else 0
-        self.total_count = self.tracks + self.albums + self.artists
-        self.index = 1
+        self.rows = []
+        self.load_rows()
+        # the first result, below its section title
+        self.index = min(1, len(self.rows) - 1)
+
+    # One row per result with a title row above each non-empty section, or a
+    # single "No results" row; rebuilt when more results are merged in, the
+    # selection staying on the same result
+    def load_rows(self):
+        selected = self.rows[self.index][1] if self.index < len(self.rows) else None
+        self.version = self.results.version
+        self.rows = []
+        for title, section in self.SECTIONS:
+            items = getattr(self.results, section)
+            if (len(items) > 0):
+                self.rows.append((title, None))
+                self.rows.extend((section, item) for item in items)
+        if (len(self.rows) == 0):
+            self.rows.append(("No results", None))
         # indices of the section header line items
-        self.header_indices = [0, self.tracks, self.artists + self.tracks]
+        self.header_indices = [i for i, (_, item) in enumerate(self.rows) if item is None]
+        for i, (_, item) in enumerate(self.rows):
+            if (selected is not None and item is selected):
+                self.jump_to(i)
 
     def total_size(self):
-        return self.total_count
+        if (self.version != self.results.version):
+            self.load_rows()
+        return len(self.rows)
 
     def page_at(self, index):
-        if self.tracks > 0 and index == 0:
-            return PlaceHolderPage("TRACKS", self, has_sub_page=False, is_title=True)
-        elif self.artists > 0 and index == self.header_indices[1]:
-            return PlaceHolderPage("ARTISTS", self, has_sub_page=False, is_title=True)
-        elif self.albums > 0 and index == self.header_indices[2]:
-            return PlaceHolderPage("ALBUMS", self, has_sub_page=False, is_title=True)
-        elif self.tracks > 0 and  index < self.header_indices[1]:
-            track = self.results.tracks[index - 1]
-            command = NowPlayingCommand(lambda: spotify_manager.play_track(track.uri))
-            return NowPlayingPage(self, track.title, command)
-        elif self.albums > 0 and  index < self.header_indices[2]:
-            artist = self.results.artists[index - (self.tracks + 1)]
-            command = NowPlayingCommand(lambda: spotify_manager.play_artist(artist.uri))
-            return NowPlayingPage(self, artist.name, command)
-        else:
-            album = self.results.albums[index - (self.artists + self.tracks + 1)]
-            tracks = self.results.album_track_map[album.uri]
-            return InMemoryPlaylistPage(album, tracks, self)
+        section, item = self.rows[index]
+        if (item is None):
+            return PlaceHolderPage(section, self, has_sub_page=False, is_title=True)
+        elif (section == "tracks"):
+            command = NowPlayingCommand(lambda: spotify_manager.play_track(item.uri),
+                                        lambda: spotify_manager.expected_play(item))
+            return NowPlayingPage(self, item.title, command)
+        elif (section == "artists"):
+            command = NowPlayingCommand(lambda: spotify_manager.play_artist(item.uri))
+            return NowPlayingPage(self, item.name, command)
+        elif (section == "playlists"):
+            return SinglePlaylistPage(item, self)
+        return InMemoryPlaylistPage(item, self.results.album_track_map[item.uri], self)
+
+    # Title rows (and "No results") lead nowhere
+    def nav_select(self):
+        section, item = self.rows[self.index]
+        if (item is None):
+            return self
+        page = self.page_at(self.index)
+        if (section in ("playlists", "albums")):
+            page.opened()
+        return page
 
     def get_index_jump_up(self):
         if self.index + 1 in self.header_indices:
@@ -439,13 +512,20 @@ class ArtistsPage(MenuPage):
     def total_size(self):
         return spotify_manager.DATASTORE.getArtistCount()
 
-    @lru_cache(maxsize=15)
-    def page_at(self, index):
-        # play track
-        artist = spotify_manager.DATASTORE.getArtist(index)
+    def artist_page(self, artist):
+        if (artist is None):
+            return None
         command = NowPlayingCommand(lambda: spotify_manager.play_artist(artist.uri))
         return NowPlayingPage(self, artist.name, command)
 
+    # Not cached: the read is a cheap ranged one, and a cached page would
+    # outlive the library generation it was read from
+    def page_at(self, index):
+        return self.artist_page(spotify_manager.DATASTORE.getArtist(index))
+
+    def page_range(self, start, count):
+        return [self.artist_page(artist) for artist in spotify_manager.DATASTORE.getArtists(start, count)]
+
 class SettingsPage(MenuPage):
     def __init__(self, previous_page):
         super().__init__("Settings", previous_page, has_sub_page=True)
@@ -662,19 +742,58 @@ class SinglePlaylistPage(MenuPage):
         self.playlist = playlist
         self.tracks = None
 
-    def get_tracks(self):
-        if self.tracks is None:
-            self.tracks = spotify_manager.DATASTORE.getPlaylistTracks(self.playlist.uri)
-        return self.tracks
+    # Called by the menu above each time the user opens this page, which may
+    # be built (and cached) long before
+    def opened(self):
+        self.jump_to_now_playing()
+        if (self.tracks is None):
+            spotify_manager.PLAYLIST_LOADER.mark_used(self.playlist.uri)
+
+    # Opens on the playing track when this playlist is the playing context
+    def jump_to_now_playing(self):
+        now_playing = spotify_manager.DATASTORE.now_playing
+        if (not now_playing or now_playing.get('context_uri') != self.playlist.uri):
+            return
+        position = spotify_manager.DATASTORE.getPlaylistTrackPosition(self.playlist.uri, now_playing['track_uri'])
+        if (position is not None and position < self.total_size()):
+            self.jump_to(position)
+
+    # None while the playlist's tracks are still being loaded
+    def get_tracks(self, start, count):
+        if self.tracks is not None:
+            return self.tracks[start:start + count]
+        if (not spotify_manager.PLAYLIST_LOADER.request(self.playlist.uri)):
+            return None
+        # only the stored pages covering the rows on screen are read
+        return spotify_manager.DATASTORE.getPlaylistTrackRange(self.playlist.uri, start, count)
 
     def total_size(self):
+        if self.tracks is None:
+            track_count = spotify_manager.DATASTORE.getPlaylistTrackCount(self.playlist.uri)
+            if (track_count is not None):
+                return track_count
         return self.playlist.track_count
 
-    def page_at(self, index):
-        track = self.get_tracks()[index]
-        command = NowPlayingCommand(lambda: spotify_manager.play_from_playlist(self.playlist.uri, track.uri, None))
+    def track_page(self, track):
+        command = NowPlayingCommand(lambda: spotify_manager.play_from_playlist(self.playlist.uri, track.uri, None),
+                                    lambda: spotify_manager.expected_play(track, self.playlist))
         return NowPlayingPage(self, track.title, command)
 
+    def page_at(self, index):
+        tracks = self.get_tracks(index, 1)
+        return self.track_page(tracks[0]) if tracks else None
+
+    def page_range(self, start, count):
+        tracks = self.get_tracks(start, count)
+        if (tracks is None):
+            loading = [PlaceHolderPage("Loading...", self, has_sub_page=False)] + [None] * (count - 1)
+            return loading[:count]
+        return [self.track_page(track) for track in tracks] + [None] * (count - len(tracks))
+
+    def nav_select(self):
+        # nothing to open while the tracks are loading
+        return self.page_at(self.index) or self
+
 class InMemoryPlaylistPage(SinglePlaylistPage):
     def __init__(self, playlist, tracks, previous_page):
         super().__init__(playlist, previous_page)
@@ -705,6 +824,10 @@ class SavedTracksPage(MenuPage):
         # play track
         return SingleTrackPage(spotify_manager.DATASTORE.getSavedTrack(index), self)
 
+    def page_range(self, start, count):
+        tracks = spotify_manager.DATASTORE.getSavedTracks(start, count)
+        return [SingleTrackPage(track, self) if track else None for track in tracks]
+
 class PlaceHolderPage(MenuPage):
     def __init__(self, header, previous_page, has_sub_page=True, is_title = False):
         super().__init__(header, previous_page, has_sub_page, is_title)